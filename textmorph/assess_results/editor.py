@@ -1,9 +1,8 @@
 import torch
+from gtd.ml.torch.decoder import BeamDuplicator
 from gtd.ml.torch.utils import GPUVariable
 from gtd.ml.torch.seq_batch import SequenceBatch
-from itertools import izip
 from gtd.utils import chunks
-from textmorph.edit_model.editor import EditTrace
 from textmorph.edit_model.encoder import EncoderOutput
 import logging
 from prettytable import PrettyTable
@@ -20,63 +19,154 @@ class GrllNeuralEditor():
         logging.info("Initialize the modified Editor.")
         self.editor = editor
 
-    def edit(self, examples, max_seq_length=35, beam_size=5, batch_size=1024):
-        """Add one argument random_edit_vector wich enforce edition with a random vector."""
+    def edit(self, examples, max_seq_length=35, beam_size=5, batch_size=1024, length_penalty=0., vocab_shortlist=0,
+             traces='final'):
+        """Add one argument random_edit_vector wich enforce edition with a random vector.
+
+        traces is one of 'none', 'final' or 'full', see Editor.edit.
+        """
         logging.debug("Performing an edit on {} examples:\n {}".format(len(examples), examples))
         beam_list = []
-        edit_traces = []
+        edit_traces = None if traces == 'none' else []
         for batch in chunks(examples, batch_size / beam_size):
-            beams, traces = self._edit_batch(batch, max_seq_length, beam_size)
+            beams, batch_traces = self._edit_batch(batch, max_seq_length, beam_size, length_penalty, vocab_shortlist,
+                                                   traces)
             beam_list.extend(beams)
-            edit_traces.extend(traces)
+            if edit_traces is not None:
+                edit_traces.extend(batch_traces)
         return beam_list, edit_traces
 
     # add sampling from random vector
-    def _edit_batch(self, examples, max_seq_length, beam_size):
+    def _edit_batch(self, examples, max_seq_length, beam_size, length_penalty=0., vocab_shortlist=0,
+                    traces='final'):
         """Add one argument random_edit_vector wich enforce edition with a random vector."""
-        source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, _, edit_embed = self.editor._batch_editor_examples(
-            examples)
-        encoder_input = self.editor.encoder.preprocess(source_words, insert_words, insert_exact_words, delete_words,
-                                                       delete_exact_words, edit_embed)
-        encoder_output = self.encoder_generate_edits(encoder_input)
+        encoder_output = self.encoder_generate_edits(self._encoder_input(examples))
+        if vocab_shortlist > 0:
+            encoder_output = encoder_output._replace(
+                vocab_shortlist=self.editor._vocab_shortlist(examples, vocab_shortlist))
 
         beams, decoder_traces = self.editor.test_decoder_beam.decode(examples, encoder_output,
                                                                      weighted_value_estimators=[]
                                                                      , beam_size=beam_size, prefix_hints=[[]]
-                                                                     , sibling_penalty=0, max_seq_length=max_seq_length)
+                                                                     , sibling_penalty=0, max_seq_length=max_seq_length
+                                                                     , length_penalty=length_penalty
+                                                                     , traces=traces)
 
-        return beams, [EditTrace(ex, d_trace.beam_traces[-1]) for ex, d_trace in izip(examples, decoder_traces)]
+        return beams, self.editor._edit_traces(examples, decoder_traces, traces)
 
-    def encoder_generate_edits(self, encoder_input):
-        """ Draw uniform random vectors with given norm, and use as edit vector """
-        source_words = encoder_input.source_words
-        source_word_embeds = self.editor.encoder.token_embedder.embed_seq_batch(source_words)
-        insert_embeds = self.editor.encoder.token_embedder.embed_seq_batch(encoder_input.insert_words)
-        delete_embeds = self.editor.encoder.token_embedder.embed_seq_batch(encoder_input.delete_words)
+    def _encoder_input(self, examples):
+        """Preprocess a batch of EditExamples into an EncoderInput."""
+        source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, _, edit_embed = self.editor._batch_editor_examples(
+            examples)
+        return self.editor.encoder.preprocess(source_words, insert_words, insert_exact_words, delete_words,
+                                              delete_exact_words, edit_embed)
 
-        insert_embeds_exact = self.editor.encoder.token_embedder.embed_seq_batch(encoder_input.insert_exact_words)
-        delete_embeds_exact = self.editor.encoder.token_embedder.embed_seq_batch(encoder_input.delete_exact_words)
+    def _encode_sources(self, encoder_input):
+        """Encode the sources of a batch, and embed the exact inserted and deleted words.
 
-        source_encoder_output = self.editor.encoder.source_encoder(source_word_embeds.split())
-        source_embeds_list = source_encoder_output.combined_states
-        source_embeds = SequenceBatch.cat(source_embeds_list)
+        Used by both `encoder_generate_edits` and `_edit_sweep_batch`, which only differ in their edit vectors.
+
+        Args:
+            encoder_input (EncoderInput)
+
+        Returns:
+            source_embeds (SequenceBatch): of shape (batch_size, seq_length, hidden_dim)
+            source_embeds_final (Variable): of shape (batch_size, hidden_dim)
+            insert_embeds_exact (SequenceBatch)
+            delete_embeds_exact (SequenceBatch)
+        """
+        encoder = self.editor.encoder
+        source_word_embeds = encoder.token_embedder.embed_seq_batch(encoder_input.source_words)
+        insert_embeds_exact = encoder.token_embedder.embed_seq_batch(encoder_input.insert_exact_words)
+        delete_embeds_exact = encoder.token_embedder.embed_seq_batch(encoder_input.delete_exact_words)
+
+        source_encoder_output = encoder.source_encoder(source_word_embeds.split())
+        source_embeds = SequenceBatch.cat(source_encoder_output.combined_states)
         # the final hidden states in both the forward and backward direction, concatenated
         source_embeds_final = torch.cat(source_encoder_output.final_states, 1)  # (batch_size, hidden_dim)
+        return source_embeds, source_embeds_final, insert_embeds_exact, delete_embeds_exact
+
+    def encoder_generate_edits(self, encoder_input):
+        """ Draw uniform random vectors with given norm, and use as edit vector """
+        source_embeds, source_embeds_final, insert_embeds_exact, delete_embeds_exact = self._encode_sources(
+            encoder_input)
+
+        batch_size = source_embeds_final.size()[0]
+        edit_embed = self.random_edit_embeds(batch_size, self.editor.encoder.edit_dim)
+
+        agenda = self.editor.encoder.agenda_maker(source_embeds_final, edit_embed)
+        return EncoderOutput(source_embeds, insert_embeds_exact, delete_embeds_exact, agenda)
 
-        edit_encoded = self.editor.encoder.edit_encoder(insert_embeds, insert_embeds_exact, delete_embeds,
-                                                        delete_embeds_exact)
+    def random_edit_embeds(self, num_edits, edit_dim):
+        """ Draw num_edits random edit vectors, uniformly in direction and norm (up to norm_max).
 
+        Returns:
+            Variable: of shape (num_edits, edit_dim)
+        """
         # the random vector is computed as in rand_p_noise (see in edit_encoder)
         torch.manual_seed(7)
-        batch_size, edit_dim = edit_encoded.size()
-        rand_draw = GPUVariable(torch.randn(batch_size, edit_dim))
-        rand_draw = rand_draw / torch.norm(rand_draw, p=2, dim=1).expand(batch_size, edit_dim)
-        rand_norms = (torch.rand(batch_size, 1) * self.editor.encoder.edit_encoder.norm_max).expand(batch_size,
+        rand_draw = GPUVariable(torch.randn(num_edits, edit_dim))
+        rand_draw = rand_draw / torch.norm(rand_draw, p=2, dim=1).expand(num_edits, edit_dim)
+        rand_norms = (torch.rand(num_edits, 1) * self.editor.encoder.edit_encoder.norm_max).expand(num_edits,
                                                                                                     edit_dim)
-        edit_embed = rand_draw * GPUVariable(rand_norms)
+        return rand_draw * GPUVariable(rand_norms)
 
-        agenda = self.editor.encoder.agenda_maker(source_embeds_final, edit_embed)
-        return EncoderOutput(source_embeds, insert_embeds_exact, delete_embeds_exact, agenda)
+    def edit_sweep(self, examples, num_edit_vectors, max_seq_length=35, beam_size=5, batch_size=1024,
+                   length_penalty=0., vocab_shortlist=0, traces='final'):
+        """Edit each example with num_edit_vectors random edit vectors.
+
+        Equivalent to calling `edit` on each example repeated num_edit_vectors times, but each source is only
+        encoded once: the encoder output is tiled num_edit_vectors ways and all num_edit_vectors * beam_size
+        hypotheses of an example are decoded in one batch. Every example is edited with the same
+        num_edit_vectors edit vectors, as with `edit`.
+
+        Args:
+            examples (list[EditExample])
+            num_edit_vectors (int)
+            batch_size (int): max number of hypotheses to decode in parallel. At least one example (all of its
+                num_edit_vectors * beam_size hypotheses) is decoded at a time.
+            See `edit` for the other arguments.
+
+        Returns:
+            beam_list (list[list[list[unicode]]]): num_edit_vectors beams for each example, grouped by example.
+            edit_traces (list[EditTrace]): aligned with beam_list, or None if traces == 'none'.
+        """
+        beam_list = []
+        edit_traces = None if traces == 'none' else []
+        examples_per_batch = max(1, batch_size / (beam_size * num_edit_vectors))
+        for batch in chunks(examples, examples_per_batch):
+            beams, batch_traces = self._edit_sweep_batch(batch, num_edit_vectors, max_seq_length, beam_size,
+                                                         length_penalty, vocab_shortlist, traces)
+            beam_list.extend(beams)
+            if edit_traces is not None:
+                edit_traces.extend(batch_traces)
+        return beam_list, edit_traces
+
+    def _edit_sweep_batch(self, examples, num_edit_vectors, max_seq_length, beam_size, length_penalty=0.,
+                          vocab_shortlist=0, traces='final'):
+        encoder = self.editor.encoder
+
+        # encode each source once
+        source_embeds, source_embeds_final, insert_embeds_exact, delete_embeds_exact = self._encode_sources(
+            self._encoder_input(examples))
+        shortlist = self.editor._vocab_shortlist(examples, vocab_shortlist) if vocab_shortlist > 0 else None
+
+        # then tile it across the edit vectors: row i * num_edit_vectors + k pairs example i with edit vector k
+        tile = BeamDuplicator(num_edit_vectors)
+        edit_embed = self.random_edit_embeds(num_edit_vectors, encoder.edit_dim).repeat(len(examples), 1)
+        agenda = encoder.agenda_maker(tile(source_embeds_final), edit_embed)
+        encoder_output = EncoderOutput(tile(source_embeds), tile(insert_embeds_exact), tile(delete_embeds_exact),
+                                       agenda, tile(shortlist))
+
+        tiled_examples = [ex for ex in examples for _ in range(num_edit_vectors)]
+        beams, decoder_traces = self.editor.test_decoder_beam.decode(tiled_examples, encoder_output,
+                                                                     weighted_value_estimators=[]
+                                                                     , beam_size=beam_size, prefix_hints=[[]]
+                                                                     , sibling_penalty=0, max_seq_length=max_seq_length
+                                                                     , length_penalty=length_penalty
+                                                                     , traces=traces)
+
+        return beams, self.editor._edit_traces(tiled_examples, decoder_traces, traces)
 
     def run_model(self, config_run_edit_model, dataloader, postprocessor):
         """ Run the editor model previously saved as attribute
@@ -106,14 +196,15 @@ class GrllNeuralEditor():
                                 original_sentence=original_sentence,
                                 preprocessed_sentence=preprocessed_sentence)
 
-            batch = [sentence] * config_run_edit_model.random_edit_vector_number
+            num_edit_vectors = config_run_edit_model.random_edit_vector_number
 
-            _, edit_traces = self.edit(batch)
+            # the source is encoded once and shared across all of the random edit vectors
+            _, edit_traces = self.edit_sweep([sentence], num_edit_vectors)
             filtered_candidates = postprocessor.postprocess_filter(edit_traces,
                                                                    min_number_of_token=config_run_edit_model.min_number_of_token)
             results.add_candidates(filtered_candidates)
 
-            log_data["batches_len"].append(len(batch))
+            log_data["batches_len"].append(num_edit_vectors)
             log_data["edit_traces_len"].append(len(edit_traces))
             log_data["filtered_candidates_len"].append(len(filtered_candidates))
             log_data["cum_results_len"].append(len(results))
@@ -69,7 +69,7 @@ for idx, config_run in enumerate(configs):
         generated_sentences, original_sentences = postprocessor.generate_n_sentences(results, n=dataset_size)
 
         bleu_score = GrllMetrics.compute_bleu_score(generated_sentences, original_sentences)
-        perplexity = GrllMetrics.compute_perplexity([result["prob"] for result in results[:dataset_size]],
+        perplexity = GrllMetrics.compute_perplexity([result["log_prob"] for result in results[:dataset_size]],
                                                     [len(result["sequence"]) for result in results[:dataset_size]])
 
         metrics.append({"size": len(generated_sentences), "bleu_score": bleu_score, "perplexity": perplexity})
@@ -1,4 +1,4 @@
-from gtd.utils import bleu
+from gtd.utils import batch_bleu, index_tokens
 import numpy as np
 import logging
 
@@ -13,29 +13,30 @@ class GrllMetrics:
             original_sentences: A list of str representing the original sentence
 
         Returns
-            avg_bleu: the average bleu score for the given dataset.
+            avg_bleu: the average (sentence-level) bleu score for the given dataset.
         """
-        bleus = []
-        for original_sentence, generated_sentence in zip(original_sentences, generated_sentences):
-            bleus.append(bleu(original_sentence.split(" "), generated_sentence.split(" ")))
-        avg_bleu = np.mean(bleus)
+        references, predictions = index_tokens([sentence.split(" ") for sentence in original_sentences],
+                                               [sentence.split(" ") for sentence in generated_sentences])
+        scores = batch_bleu(references, predictions)
+        avg_bleu = np.mean(scores.sentence)
         logging.info("BLEU score reported on this dataset: {}".format(avg_bleu))
+        logging.info("Corpus BLEU score reported on this dataset: {}".format(scores.corpus))
         return avg_bleu
 
     @classmethod
-    def compute_perplexity(cls, sentence_probs, n_list):
+    def compute_perplexity(cls, sentence_log_probs, n_list):
         """Compute the perplexity of a generated dataset.
 
         Args
-            sentence_probs: a list of probs for each sentences in a dataset
+            sentence_log_probs: a list of natural log probs for each sentences in a dataset
             n_list: a list of number of token for each sentences in a dataset
 
         Returns
             pp: the perplexity value of the generated dataset
         """
         logq_list = []
-        for sentence_prob in sentence_probs:
-            logq_list.append(np.log2(sentence_prob) + 1e-45)
+        for sentence_log_prob in sentence_log_probs:
+            logq_list.append(sentence_log_prob / np.log(2))
 
         entropy = - np.sum(logq_list) / np.sum(n_list)
         perplexity = 2.0 ** entropy
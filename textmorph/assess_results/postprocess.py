@@ -45,7 +45,8 @@ class GrllPostprocessor:
 
                 if new_sequence not in sequences and new_sequence != edit_trace.example.source_words:
                     if self.entities_check(new_sequence, edit_trace.example.entities):
-                        new_candidate = {"sentence": edit_trace.example, "sequence": new_sequence, "prob": candidate.prob}
+                        new_candidate = {"sentence": edit_trace.example, "sequence": new_sequence,
+                                         "prob": candidate.prob, "log_prob": candidate.log_prob}
                         new_candidates.append(new_candidate)
                         sequences.append(new_sequence)
                         logging.debug("The candidate sequence was successfully added to the new_candidates.")
@@ -19,4 +19,4 @@ class GrllResults:
 
     def sort(self,):
         """ Sort the candidates stored in results"""
-        self.candidates = sorted(self.candidates, key=lambda x: x["prob"], reverse=True)
+        self.candidates = sorted(self.candidates, key=lambda x: x["log_prob"], reverse=True)
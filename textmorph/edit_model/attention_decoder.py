@@ -2,20 +2,23 @@ from itertools import izip
 
 import numpy as np
 import torch
+from torch.autograd import Variable
 from torch.nn import LSTMCell, Linear, Parameter, Softmax
 
 from collections import namedtuple
-from gtd.ml.torch.attention import Attention, AttentionOutput, DummyAttention
+from gtd.ml.torch.attention import Attention, AttentionOutput, DummyAttention, MultiAttention
 from gtd.ml.torch.decoder_cell import DecoderCell, DecoderCellOutput, RNNState, RNNInput
 from gtd.ml.torch.recurrent import gated_update, tile_state
-from gtd.ml.torch.utils import GPUVariable
+from gtd.ml.torch.utils import GPUVariable, NamedTupleLike
 from gtd.utils import UnicodeMixin
-from gtd.ml.torch.decoder import RNNContextCombiner
+from gtd.ml.torch.decoder import RNNContextCombiner, BatchShared
 
 
 class AttentionContextCombiner(RNNContextCombiner):
     def __call__(self, encoder_output, x):
-        return AttentionRNNInput(x=x, agenda=encoder_output.agenda, source_embeds=encoder_output.source_embeds, insert_embeds=encoder_output.insert_embeds, delete_embeds=encoder_output.delete_embeds)
+        return AttentionRNNInput(x=x, agenda=encoder_output.agenda, source_embeds=encoder_output.source_embeds, insert_embeds=encoder_output.insert_embeds, delete_embeds=encoder_output.delete_embeds,
+                                 vocab_shortlist=encoder_output.vocab_shortlist,
+                                 attention_memories=encoder_output.attention_memories)
 
 class AttentionDecoderCell(DecoderCell):
     def __init__(self, token_embedder, agenda_dim, decoder_dim, encoder_dim, attn_dim, no_insert_delete_attn, num_layers):
@@ -54,9 +57,12 @@ class AttentionDecoderCell(DecoderCell):
         if not no_insert_delete_attn:
             self.insert_attention = Attention(input_dim, decoder_dim, attn_dim)
             self.delete_attention = Attention(input_dim, decoder_dim, attn_dim)
+            self.multi_attention = MultiAttention([self.source_attention, self.insert_attention,
+                                                   self.delete_attention])
         else:
             self.insert_attention = DummyAttention(input_dim, decoder_dim, attn_dim)
             self.delete_attention = DummyAttention(input_dim, decoder_dim, attn_dim)
+            self.multi_attention = MultiAttention([self.source_attention])
 
         self.token_embedder = token_embedder
         self.no_insert_delete_attn = no_insert_delete_attn
@@ -71,7 +77,55 @@ class AttentionDecoderCell(DecoderCell):
         return AttentionRNNState([h] * self.num_layers, [c] * self.num_layers, init_attn(self.source_attention),
                         init_attn(self.insert_attention), init_attn(self.delete_attention))
 
+    def prepare(self, encoder_output):
+        """Precompute the memory projections and masks of all attentions (see MultiAttention), and the vocab
+        shortlist (see VocabShortlist).
+        """
+        memories = self._attention_memories(encoder_output)
+        encoder_output = encoder_output._replace(attention_memories=self.multi_attention.precompute(memories))
+        if encoder_output.vocab_shortlist is not None:
+            encoder_output = encoder_output._replace(
+                vocab_shortlist=self._prepare_shortlist(encoder_output.vocab_shortlist))
+        return encoder_output
+
+    def _prepare_shortlist(self, vocab_shortlist):
+        """Convert a shortlist mask into a VocabShortlist (unless it already is one).
+
+        Args:
+            vocab_shortlist (Variable | VocabShortlist): ByteTensor of shape (batch_size, vocab_size)
+
+        Returns:
+            VocabShortlist
+        """
+        if isinstance(vocab_shortlist, VocabShortlist):
+            return vocab_shortlist
+        candidate_ids = torch.nonzero(vocab_shortlist.data.max(0)[0].view(-1)).view(-1)  # (num_candidates,)
+        candidates = GPUVariable(candidate_ids)
+        candidate_embeds = self.token_embedder.embeds.index_select(0, candidates)  # (num_candidates, input_dim)
+        log_mask = torch.log(vocab_shortlist.index_select(1, candidates).float())  # 0 if on the shortlist, else -inf
+        return VocabShortlist(BatchShared(candidate_ids.cpu().numpy()), BatchShared(candidates),
+                              BatchShared(candidate_embeds), log_mask)
+
+    def _attention_memories(self, encoder_output):
+        """The memories attended to by multi_attention."""
+        if self.no_insert_delete_attn:
+            return [encoder_output.source_embeds]
+        return [encoder_output.source_embeds, encoder_output.insert_embeds, encoder_output.delete_embeds]
+
     def forward(self, rnn_state, decoder_cell_input, advance):
+        rnn_state, z = self.step(rnn_state, decoder_cell_input, advance)
+        word_vocab = self.token_embedder.vocab
+        if decoder_cell_input.vocab_shortlist is None:
+            vocab_probs = self.vocab_softmax(self.vocab_logits(z))
+        else:
+            shortlist = self._prepare_shortlist(decoder_cell_input.vocab_shortlist)
+            vocab_probs = self._shortlist_vocab_probs(self.vocab_projection_pos(z), self.vocab_projection_neg(z),
+                                                      shortlist)
+        # TODO(kelvin): prevent model from putting probability on UNK
+
+        return DecoderCellOutput(rnn_state, vocab=word_vocab, vocab_probs=vocab_probs)
+
+    def step(self, rnn_state, decoder_cell_input, advance):
         dci = decoder_cell_input
         mask = advance
 
@@ -100,9 +154,19 @@ class AttentionDecoderCell(DecoderCell):
                 x = x + h
 
         # compute attention using bottom layer
-        source_attn = self.source_attention(dci.source_embeds, hs[0])
-        insert_attn = self.insert_attention(dci.insert_embeds, hs[0])
-        delete_attn = self.delete_attention(dci.delete_embeds, hs[0])
+        if dci.attention_memories is not None:
+            # all attentions at once, with precomputed memory projections
+            attn_outputs = self.multi_attention(dci.attention_memories, self._attention_memories(dci), hs[0])
+            if self.no_insert_delete_attn:
+                source_attn, = attn_outputs
+                insert_attn = self.insert_attention(dci.insert_embeds, hs[0])
+                delete_attn = self.delete_attention(dci.delete_embeds, hs[0])
+            else:
+                source_attn, insert_attn, delete_attn = attn_outputs
+        else:
+            source_attn = self.source_attention(dci.source_embeds, hs[0])
+            insert_attn = self.insert_attention(dci.insert_embeds, hs[0])
+            delete_attn = self.delete_attention(dci.delete_embeds, hs[0])
         if not self.no_insert_delete_attn:
             z = torch.cat([x, source_attn.context, insert_attn.context, delete_attn.context], 1)
         else:
@@ -110,18 +174,41 @@ class AttentionDecoderCell(DecoderCell):
 
         # has shape (batch_size, decoder_dim + encoder_dim + input_dim + input_dim)
 
-        vocab_query_pos = self.vocab_projection_pos(z)
-        vocab_query_neg = self.vocab_projection_neg(z)
-        word_vocab = self.token_embedder.vocab
+        rnn_state = AttentionRNNState(hs, cs, source_attn, insert_attn, delete_attn)
+        return rnn_state, z
+
+    def vocab_logits(self, z, candidates=None):
         word_embeds = self.token_embedder.embeds
-        vocab_logit_pos = self.relu(torch.mm(vocab_query_pos, word_embeds.t())) # (batch_size, vocab_size)
-        vocab_logit_neg = self.relu(torch.mm(vocab_query_neg, word_embeds.t()))  # (batch_size, vocab_size)
-        vocab_probs = self.vocab_softmax(vocab_logit_pos - vocab_logit_neg)
-        # TODO(kelvin): prevent model from putting probability on UNK
+        if candidates is not None:
+            word_embeds = word_embeds.index_select(0, candidates)  # only project onto the candidate words
+        vocab_logit_pos = self.relu(torch.mm(self.vocab_projection_pos(z), word_embeds.t()))  # (num_queries, vocab_size)
+        vocab_logit_neg = self.relu(torch.mm(self.vocab_projection_neg(z), word_embeds.t()))  # (num_queries, vocab_size)
+        return vocab_logit_pos - vocab_logit_neg
 
-        rnn_state = AttentionRNNState(hs, cs, source_attn, insert_attn, delete_attn)
+    def _shortlist_vocab_probs(self, vocab_query_pos, vocab_query_neg, vocab_shortlist):
+        """Compute vocab probs, restricted to a shortlist of words for each example.
 
-        return DecoderCellOutput(rnn_state, vocab=word_vocab, vocab_probs=vocab_probs)
+        Only the words which are on the shortlist of some example in the batch are projected.
+
+        Args:
+            vocab_query_pos (Variable): of shape (batch_size, input_dim)
+            vocab_query_neg (Variable): of shape (batch_size, input_dim)
+            vocab_shortlist (VocabShortlist)
+
+        Returns:
+            vocab_probs (Variable): of shape (batch_size, vocab_size). Zero for words off the shortlist.
+        """
+        candidates, candidate_embeds = vocab_shortlist.candidates.value, vocab_shortlist.candidate_embeds.value
+        batch_size, num_candidates = vocab_shortlist.log_mask.size()
+
+        candidate_logit_pos = self.relu(torch.mm(vocab_query_pos, candidate_embeds.t()))  # (batch_size, num_candidates)
+        candidate_logit_neg = self.relu(torch.mm(vocab_query_neg, candidate_embeds.t()))  # (batch_size, num_candidates)
+        candidate_probs = self.vocab_softmax(candidate_logit_pos - candidate_logit_neg + vocab_shortlist.log_mask)
+
+        # decoders take probs over the full vocab (see DecoderCellOutput)
+        vocab_probs = Variable(candidate_probs.data.new(batch_size, len(self.token_embedder.vocab)).zero_(),
+                               volatile=candidate_probs.volatile)
+        return vocab_probs.scatter(1, candidates.unsqueeze(0).expand(batch_size, num_candidates), candidate_probs)
 
     def rnn_state_type(self):
         return AttentionRNNState
@@ -129,6 +216,55 @@ class AttentionDecoderCell(DecoderCell):
     def rnn_input_type(self):
         return AttentionRNNInput
 
+class VocabShortlist(namedtuple('VocabShortlist', ['candidate_ids', 'candidates', 'candidate_embeds', 'log_mask']),
+                     NamedTupleLike):
+    """The words which the decoder may generate for each example, precomputed once per batch by
+    AttentionDecoderCell.prepare.
+
+    Only the log_mask is aligned with the batch. The candidates are shared by all of its rows (see BatchShared).
+
+    Attributes:
+        candidate_ids (BatchShared): np.ndarray of the words on the shortlist of some example (sorted ascending)
+        candidates (BatchShared): the same word indices, as a LongTensor Variable of shape (num_candidates,)
+        candidate_embeds (BatchShared): Variable of shape (num_candidates, input_dim)
+        log_mask (Variable): of shape (batch_size, num_candidates). 0 if the candidate is on the example's
+            shortlist, else -inf.
+    """
+
+    @classmethod
+    def concatenate_batches(cls, shortlists):
+        """Concatenate VocabShortlists along the batch dimension, merging their candidates (see BatchConcatenator).
+
+        Args:
+            shortlists (list[VocabShortlist])
+
+        Returns:
+            VocabShortlist
+        """
+        all_ids = np.concatenate([shortlist.candidate_ids.value for shortlist in shortlists])
+        candidate_ids, first = np.unique(all_ids, return_index=True)
+        num_candidates = len(candidate_ids)
+
+        # take each candidate's embedding from the first shortlist which has it
+        all_embeds = torch.cat([shortlist.candidate_embeds.value for shortlist in shortlists], 0)
+        candidate_embeds = all_embeds.index_select(0, GPUVariable(torch.from_numpy(first)))
+
+        # move the columns of each log_mask to the positions of their candidates. The other columns are -inf.
+        log_masks = []
+        for shortlist in shortlists:
+            log_mask = shortlist.log_mask
+            batch_size, old_num_candidates = log_mask.size()
+            positions = GPUVariable(torch.from_numpy(np.searchsorted(candidate_ids, shortlist.candidate_ids.value)))
+            merged = Variable(log_mask.data.new(batch_size, num_candidates).fill_(float('-inf')),
+                              volatile=log_mask.volatile)
+            log_masks.append(merged.scatter(1, positions.unsqueeze(0).expand(batch_size, old_num_candidates),
+                                            log_mask))
+
+        candidates = GPUVariable(torch.from_numpy(candidate_ids))
+        return VocabShortlist(BatchShared(candidate_ids), BatchShared(candidates), BatchShared(candidate_embeds),
+                              torch.cat(log_masks, 0))
+
+
 class AttentionRNNState(namedtuple('AttentionRNNState', ['hs','cs','source_attn','insert_attn','delete_attn']), RNNState):
     """
     Attributes:
@@ -142,7 +278,8 @@ class AttentionRNNState(namedtuple('AttentionRNNState', ['hs','cs','source_attn'
     """
     pass
 
-class AttentionRNNInput(namedtuple('AttentionRNNInput', ['x','agenda','source_embeds','insert_embeds','delete_embeds']), RNNInput):
+class AttentionRNNInput(namedtuple('AttentionRNNInput', ['x','agenda','source_embeds','insert_embeds','delete_embeds','vocab_shortlist',
+                                                       'attention_memories']), RNNInput):
     """
 Attributes:
     x (Variable): of shape (batch_size, word_dim), embedding of word generated at previous time step
@@ -150,8 +287,15 @@ Attributes:
     source_embeds (SequenceBatch): of shape (batch_size, source_seq_length, hidden_size)
     insert_embeds (SequenceBatch): of shape (batch_size, max_edits, embed_dim)
     delete_embeds (SequenceBatch): of shape (batch_size, max_edits, embed_dim)
+    vocab_shortlist (Variable | VocabShortlist): ByteTensor of shape (batch_size, vocab_size) (or a VocabShortlist,
+        once prepared by AttentionDecoderCell.prepare), or None to predict over the full vocab
+    attention_memories (AttentionMemories): precomputed by AttentionDecoderCell.prepare, or None to compute each
+        attention separately
     """
-    pass
+    def __new__(cls, x, agenda, source_embeds, insert_embeds, delete_embeds, vocab_shortlist=None,
+                attention_memories=None):
+        return super(AttentionRNNInput, cls).__new__(cls, x, agenda, source_embeds, insert_embeds, delete_embeds,
+                                                     vocab_shortlist, attention_memories)
 
         
 
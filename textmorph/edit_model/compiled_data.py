@@ -0,0 +1,361 @@
+"""A pre-tokenized, memory-mapped storage format for EditDataSplits.
+
+Compiling a dataset parses each split once. For every split and every field of EditExample that the data files
+determine, it stores a flat int32 array of token ids and an int64 array of offsets into it. The insert and delete
+sets are computed at compile time. Token ids index into a token list shared by all splits of the dataset.
+
+The compiled arrays are loaded with mmap_mode='r', and examples are only decoded when they are accessed.
+
+A compiled dataset records the modification times and sizes of the TSV files it was compiled from, and the vocab
+size it was compiled for (see is_stale).
+"""
+import array
+import codecs
+import json
+import os
+import random
+from collections import Sequence
+from itertools import izip
+from os.path import join, exists
+
+import numpy as np
+
+from gtd.chrono import verboserate
+from gtd.io import num_lines
+from gtd.utils import chunks
+from textmorph.edit_model.editor import EditExample
+
+
+SPLITS = ('train', 'valid', 'test')
+FIELDS = ('source_words', 'insert_exact_words', 'delete_exact_words', 'target_words')
+
+
+def compiled_dir(data_dir, use_diff):
+    """Directory holding the compiled version of a dataset.
+
+    The insert and delete sets depend on use_diff, so each setting has its own directory.
+    """
+    return join(data_dir, 'compiled_diff' if use_diff else 'compiled_whitelist')
+
+
+def read_examples(path, use_diff, free_set=frozenset()):
+    """Parse a TSV file of (source, target) pairs.
+
+    NOTE: this converts everything to lower case.
+
+    Args:
+        path (str)
+        use_diff (bool): compute edit sets with EditExample.salient_diff, rather than EditExample.whitelist_blacklist
+        free_set (set[unicode]): words excluded from insertions and deletions, if use_diff
+
+    Returns:
+        Iterable[EditExample]
+    """
+    total_lines = num_lines(path)  # count total lines before loading
+
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        for line in verboserate(f, desc='Reading data file.', total=total_lines):
+            src, trg = line.strip().lower().split("\t")
+            src_words = src.split(' ')
+            trg_words = trg.split(' ')
+            assert len(src_words) > 0
+            assert len(trg_words) > 0
+
+            if use_diff:
+                yield EditExample.salient_diff(src_words, trg_words, free_set)
+            else:
+                yield EditExample.whitelist_blacklist(src_words, trg_words)
+
+
+class _ArrayFileWriter(object):
+    """Write a 1D integer .npy file, appending values without holding the whole array in memory.
+
+    Values are buffered in an array.array, which is flushed to a raw temporary file whenever it is full.
+    close() copies the raw file into the .npy file, one chunk at a time.
+    """
+
+    def __init__(self, path, typecode, buffer_size=1 << 20):
+        """
+
+        Args:
+            path (str): the .npy file
+            typecode (str): see array.array. Also the numpy dtype of the file.
+            buffer_size (int): number of values buffered in memory
+        """
+        self.path = path
+        self._raw_path = path + '.raw'
+        self._raw_file = open(self._raw_path, 'wb')
+        self._buffer = array.array(typecode)
+        self._buffer_size = buffer_size
+        self._num_written = 0
+
+    def __len__(self):
+        return self._num_written + len(self._buffer)
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        self._buffer.tofile(self._raw_file)
+        self._num_written += len(self._buffer)
+        del self._buffer[:]
+
+    def close(self):
+        self._flush()
+        self._raw_file.close()
+
+        dtype = np.dtype(self._buffer.typecode)
+        length = self._num_written
+        if length == 0:
+            np.save(self.path, np.zeros(0, dtype=dtype))  # an empty file cannot be memory-mapped
+        else:
+            raw = np.memmap(self._raw_path, dtype=dtype, mode='r', shape=(length,))
+            out = np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype, shape=(length,))
+            for start in xrange(0, length, self._buffer_size):
+                out[start:start + self._buffer_size] = raw[start:start + self._buffer_size]
+            out.flush()
+            del raw, out  # close the memory maps
+        os.remove(self._raw_path)
+
+
+def _compile_metadata(data_dir, vocab_size):
+    """Describe the inputs of a compilation: the (mtime, size) of each split's TSV file, and the vocab size."""
+    sources = {}
+    for split in SPLITS:
+        stat = os.stat(join(data_dir, '{}.tsv'.format(split)))
+        sources[split] = [stat.st_mtime, stat.st_size]
+    return {'sources': sources, 'vocab_size': vocab_size}
+
+
+def compile_data(data_dir, use_diff, vocab_size=None):
+    """Compile the train, valid and test TSV files of a dataset (see CompiledEditSplit).
+
+    Recompiling overwrites an existing compiled dataset.
+
+    Args:
+        data_dir (str): absolute path to dataset
+        use_diff (bool): see read_examples
+        vocab_size (int): vocab size of the models that will train on the dataset, recorded for is_stale
+    """
+    out_dir = compiled_dir(data_dir, use_diff)
+    if not exists(out_dir):
+        os.makedirs(out_dir)
+
+    tokens_path = join(out_dir, 'tokens.txt')
+    if exists(tokens_path):
+        os.remove(tokens_path)  # the dataset is incomplete until it is rewritten
+    # recorded before reading, so that files which change during compilation make the result stale
+    metadata = _compile_metadata(data_dir, vocab_size)
+
+    token_ids = {}  # shared by all splits
+    for split in SPLITS:
+        # ids and offsets are streamed to disk, so that large datasets fit in memory
+        path = lambda field, kind: join(out_dir, '{}.{}.{}.npy'.format(split, field, kind))
+        ids = {field: _ArrayFileWriter(path(field, 'ids'), 'i') for field in FIELDS}  # int32
+        offsets = {field: _ArrayFileWriter(path(field, 'offsets'), 'l') for field in FIELDS}  # int64 (C long)
+        for field in FIELDS:
+            offsets[field].append(0)
+
+        for ex in read_examples(join(data_dir, '{}.tsv'.format(split)), use_diff):
+            for field in FIELDS:
+                field_ids = ids[field]
+                for word in getattr(ex, field):
+                    field_ids.append(token_ids.setdefault(word, len(token_ids)))
+                offsets[field].append(len(field_ids))
+
+        for field in FIELDS:
+            ids[field].close()
+            offsets[field].close()
+
+    with open(join(out_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    tokens = sorted(token_ids, key=token_ids.get)
+    # the token list is written last, so that its presence marks a complete compilation
+    with codecs.open(tokens_path, 'w', encoding='utf-8') as f:
+        for token in tokens:
+            f.write(token)
+            f.write(u'\n')
+
+
+def is_compiled(data_dir, use_diff):
+    return exists(join(compiled_dir(data_dir, use_diff), 'tokens.txt'))
+
+
+def is_stale(data_dir, use_diff, vocab_size=None):
+    """Return True if a compiled dataset no longer matches its TSV files or vocab size, and should be recompiled.
+
+    Datasets compiled before this was recorded are stale.
+
+    Args:
+        data_dir (str)
+        use_diff (bool)
+        vocab_size (int): see compile_data
+    """
+    path = join(compiled_dir(data_dir, use_diff), 'metadata.json')
+    if not exists(path):
+        return True
+    with open(path, 'r') as f:
+        metadata = json.load(f)
+    return metadata != _compile_metadata(data_dir, vocab_size)
+
+
+def load_tokens(data_dir, use_diff):
+    """Load the token list of a compiled dataset.
+
+    Returns:
+        list[unicode]
+    """
+    with codecs.open(join(compiled_dir(data_dir, use_diff), 'tokens.txt'), 'r', encoding='utf-8') as f:
+        return [line[:-1] for line in f]  # strip newline
+
+
+class CompiledEditSplit(Sequence):
+    """A list[EditExample] backed by the memory-mapped arrays of a compiled split.
+
+    Examples are decoded from token ids each time they are accessed.
+    """
+
+    def __init__(self, directory, split, tokens):
+        """Load a compiled split.
+
+        Args:
+            directory (str): see compiled_dir
+            split (str): one of SPLITS
+            tokens (list[unicode]): the token list of the dataset (see load_tokens)
+        """
+        self._tokens = tokens
+        self._vocab_table = None  # (WordVocab, lookup table), see vocab_table
+        self._ids = {}
+        self._offsets = {}
+        for field in FIELDS:
+            path = lambda kind: join(directory, '{}.{}.{}.npy'.format(split, field, kind))
+            self._ids[field] = np.load(path('ids'), mmap_mode='r')
+            self._offsets[field] = np.load(path('offsets'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._offsets['source_words']) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Example index out of range: {}'.format(i))
+
+        tokens = self._tokens
+        src, insert, delete, trg = [[tokens[t] for t in self.token_ids(field, i).tolist()] for field in FIELDS]
+        return EditExample(source_words=src, insert_words=[], insert_exact_words=insert,
+                           delete_words=[], delete_exact_words=delete, target_words=trg)
+
+    def token_ids(self, field, i):
+        """Token ids of one field of the i-th example.
+
+        Args:
+            field (str): one of FIELDS
+            i (int)
+
+        Returns:
+            np.ndarray: int32 array
+        """
+        offsets = self._offsets[field]
+        return self._ids[field][offsets[i]:offsets[i + 1]]
+
+    def vocab_table(self, word_vocab):
+        """Lookup table from the token ids of this split to word indices of word_vocab.
+
+        The table is built on first use (the model vocab is only known once the model is loaded), and reused as long
+        as word_vocab is the same object.
+
+        Returns:
+            np.ndarray: int64 array of shape (len(tokens),)
+        """
+        if self._vocab_table is None or self._vocab_table[0] is not word_vocab:
+            table = np.array(word_vocab.words2indices(self._tokens), dtype=np.int64)
+            self._vocab_table = (word_vocab, table)
+        return self._vocab_table[1]
+
+    def lengths(self, field):
+        """Length of one field for all examples.
+
+        Returns:
+            np.ndarray: int64 array of shape (len(self),)
+        """
+        return np.diff(self._offsets[field])
+
+    def similar_size_batches(self, batch_size):
+        """Like gtd.ml.torch.utils.similar_size_batches (sizes examples by their target length), without decoding
+        any examples.
+
+        Returns:
+            list[CompiledEditBatch]
+        """
+        assert batch_size >= 1
+        order = np.argsort(self.lengths('target_words'), kind='mergesort')  # stable, like sorted
+        batches = [CompiledEditBatch(self, indices) for indices in chunks(order, batch_size)]
+        random.shuffle(batches)  # in-place
+        return batches
+
+
+class CompiledEditBatch(Sequence):
+    """A batch of examples from a CompiledEditSplit, decoded when accessed.
+
+    Call list() on it to decode all examples once, before using them repeatedly.
+    """
+
+    def __init__(self, split, indices):
+        """
+
+        Args:
+            split (CompiledEditSplit)
+            indices (np.ndarray): example indices into split
+        """
+        self.split = split
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.split[j] for j in self.indices[i]]
+        return self.split[self.indices[i]]
+
+    def vocab_examples(self, word_vocab):
+        """The examples of this batch, where each word is replaced by its index in word_vocab.
+
+        Token ids are mapped with the split's vocab_table, so no words are decoded or looked up.
+        See Editor.index_batch(indexed=True).
+
+        Args:
+            word_vocab (WordVocab)
+
+        Returns:
+            list[EditExample]: with lists of word indices in place of lists of words
+        """
+        split = self.split
+        table = split.vocab_table(word_vocab)
+        fields = [[np.take(table, split.token_ids(field, i)).tolist() for i in self.indices] for field in FIELDS]
+        return [EditExample(source_words=src, insert_words=[], insert_exact_words=insert, delete_words=[],
+                            delete_exact_words=delete, target_words=trg)
+                for src, insert, delete, trg in izip(*fields)]
+
+
+if __name__ == '__main__':
+    import argparse
+    from textmorph import data
+
+    arg_parser = argparse.ArgumentParser(description='Compile a dataset for fast loading by EditDataSplits.')
+    arg_parser.add_argument('path', help='dataset path, relative to the data directory (see config.dataset.path)')
+    arg_parser.add_argument('-w', '--whitelist', action='store_true',
+                            help='compile whitelist/blacklist edit sets (config.dataset.use_diff = False)')
+    arg_parser.add_argument('-v', '--vocab_size', type=int, default=None,
+                            help='vocab size of the models that will train on the dataset (config.editor.vocab_size)')
+    args = arg_parser.parse_args()
+
+    compile_data(join(data.workspace.root, args.path), use_diff=not args.whitelist, vocab_size=args.vocab_size)
@@ -0,0 +1,144 @@
+"""Prepare upcoming training batches in background worker processes.
+
+Workers apply the EditNoiser and convert batches into CPU tensors of word indices (see Editor.index_batch).
+Batches of a compiled dataset are mapped to word indices with a lookup table, without decoding their words. The
+tensors travel back through a torch.multiprocessing queue, which moves them into shared memory instead of copying
+them through a pipe. Workers never touch the GPU.
+"""
+import traceback
+
+import numpy as np
+import torch.multiprocessing as multiprocessing
+
+from textmorph.edit_model.compiled_data import CompiledEditBatch
+from textmorph.edit_model.editor import Editor
+
+
+def prepare_batch(batch, noiser, word_vocab, seed):
+    """Noise and index one batch.
+
+    The noise only depends on the seed, so a batch gets the same noise whichever process prepares it.
+    The global numpy RNG (used by EditNoiser) is restored afterwards.
+
+    Args:
+        batch (Sequence[EditExample])
+        noiser (EditNoiser | None): if None, examples are not noised
+        word_vocab (WordVocab)
+        seed (list[int]): see np.random.seed
+
+    Returns:
+        (list[EditExample], IndexedEditorInput): the noised batch and its indexed version. For a CompiledEditBatch,
+            the noised examples hold word indices rather than words (see CompiledEditBatch.vocab_examples).
+    """
+    indexed = isinstance(batch, CompiledEditBatch)
+    batch = batch.vocab_examples(word_vocab) if indexed else list(batch)
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        noised_batch = noiser(batch) if noiser is not None else batch
+    finally:
+        np.random.set_state(state)
+    return noised_batch, Editor.index_batch(noised_batch, word_vocab, indexed)
+
+
+def _worker_loop(batches, noiser, word_vocab, tasks, results):
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        position, batch_idx, seed = task
+        try:
+            noised_batch, indexed = prepare_batch(batches[batch_idx], noiser, word_vocab, seed)
+            results.put((position, noised_batch, indexed, None))
+        except Exception:
+            results.put((position, None, None, traceback.format_exc()))
+
+
+class EditBatchPipeline(object):
+    """Yields prepared training batches in the order of a BatchSchedule, preparing them ahead of time.
+
+    Each batch is noised with a seed derived from (seed, epoch, position in the epoch), rather than with a
+    per-worker RNG stream. So the noise does not depend on num_workers, nor on which worker prepares a batch.
+    """
+
+    def __init__(self, batches, schedule, noiser, word_vocab, seed, num_workers=0, prefetch=8):
+        """Start the worker processes.
+
+        Args:
+            batches (list[Sequence[EditExample]])
+            schedule (BatchSchedule): order in which batches are visited. Advanced as batches are yielded.
+            noiser (EditNoiser | None): if None, examples are not noised
+            word_vocab (WordVocab)
+            seed (int)
+            num_workers (int): number of worker processes. If 0, batches are prepared in this process, when needed.
+            prefetch (int): max number of batches prepared ahead of the one being trained on. Bounds the queue.
+        """
+        assert prefetch >= 1
+        self.batches = batches
+        self.schedule = schedule
+        self.noiser = noiser
+        self.word_vocab = word_vocab
+        self.seed = seed
+        self.prefetch = prefetch
+
+        self._workers = []
+        if num_workers > 0:
+            # build the vocab lookup table of a compiled dataset once, rather than in every worker
+            if len(batches) > 0 and isinstance(batches[0], CompiledEditBatch):
+                batches[0].split.vocab_table(word_vocab)
+
+            self._tasks = multiprocessing.Queue()
+            self._results = multiprocessing.Queue(maxsize=prefetch)
+            for _ in range(num_workers):
+                # workers are forked, so batches are shared with them rather than pickled
+                worker = multiprocessing.Process(target=_worker_loop,
+                                                 args=(batches, noiser, word_vocab, self._tasks, self._results))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def epoch_batches(self):
+        """Yield the remaining batches of the schedule's current epoch, then move the schedule to the next epoch.
+
+        Yields:
+            (list[EditExample], IndexedEditorInput): the noised batch and its indexed version (see Editor.indexed_loss)
+        """
+        schedule = self.schedule
+        epoch = schedule.epoch
+        order = schedule.order(epoch)
+        seed = lambda position: [self.seed, epoch, position]
+
+        if not self._workers:
+            for position in xrange(schedule.cursor, schedule.num_batches):
+                prepared = prepare_batch(self.batches[order[position]], self.noiser, self.word_vocab, seed(position))
+                schedule.cursor = position + 1
+                yield prepared
+        else:
+            next_task = schedule.cursor
+            prepared = {}  # position -> (noised batch, indexed batch), for batches that arrived out of order
+            for position in xrange(schedule.cursor, schedule.num_batches):
+                # keep up to `prefetch` batches in flight
+                while next_task < min(position + self.prefetch, schedule.num_batches):
+                    self._tasks.put((next_task, order[next_task], seed(next_task)))
+                    next_task += 1
+
+                while position not in prepared:
+                    done_position, noised_batch, indexed, error = self._results.get()
+                    if error is not None:
+                        raise RuntimeError('Data loading worker failed:\n{}'.format(error))
+                    prepared[done_position] = (noised_batch, indexed)
+
+                schedule.cursor = position + 1
+                yield prepared.pop(position)
+
+        schedule.epoch += 1
+        schedule.cursor = 0
+
+    def close(self):
+        """Stop the worker processes."""
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
@@ -8,7 +8,13 @@ class EditEncoder(Module):
     """
     EditEncoder maps insert / delete embeddings into a single edit vector of dimensionality edit_dim
     """
-    def __init__(self, word_dim, edit_dim, kappa_init, norm_eps, norm_max):
+    def __init__(self, word_dim, edit_dim, kappa_init, norm_eps, norm_max, w_table_size=0):
+        """
+
+        Args:
+            w_table_size (int): if > 0, the vMF sampler draws its weights w from a precomputed table of this many
+                samples for each (kappa, dim), instead of rejection sampling them at every call.
+        """
         super(EditEncoder, self).__init__()
         self.linear = Linear(edit_dim, edit_dim)
         self.linear_prenoise = Linear(word_dim, edit_dim/2, bias=False)
@@ -16,6 +22,8 @@ class EditEncoder(Module):
         self.norm_eps = norm_eps
         self.norm_max = norm_max
         self.normclip = Hardtanh(0, self.norm_max - norm_eps)
+        self.w_table_size = w_table_size
+        self._w_tables = {}  # (kappa, dim) -> np.ndarray of w samples
 
     def forward(self, insert_embeds, insert_embeds_exact, delete_embeds, delete_embeds_exact, draw_samples = False, draw_p = False):
         """Create agenda vector.
@@ -56,15 +64,17 @@ class EditEncoder(Module):
         mask = seq_batch.mask
 
         batch_size, max_edits, w_embed_size = values.size()
-        new_values = GPUVariable(torch.from_numpy(np.zeros((batch_size, max_edits, w_embed_size),dtype=np.float32)))
-        m_expand = mask.unsqueeze(2).expand(batch_size, max_edits, w_embed_size)
+        if not draw_noise:
+            return SequenceBatch(values=GPUVariable(torch.zeros(batch_size, max_edits, w_embed_size)), mask=mask)
 
-        for max_edit in range(max_edits):
-            phint = self.sample_vMF(values[:, max_edit, :], self.noise_scaler)
-            prand = self.draw_p_noise(batch_size, w_embed_size)
-            new_values[:, max_edit, :] = phint*m_expand[:, max_edit, :]+ prand*(1-m_expand[:, max_edit, :])
+        # sample all edits at once
+        num_edits = batch_size * max_edits
+        phint = self.sample_vMF(values.contiguous().view(num_edits, w_embed_size), self.noise_scaler)
+        prand = self.draw_p_noise(num_edits, w_embed_size)
+        m_expand = mask.contiguous().view(num_edits, 1).expand(num_edits, w_embed_size)
+        new_values = phint * m_expand + prand * (1 - m_expand)
 
-        return SequenceBatch(values=new_values*draw_noise, mask=mask)
+        return SequenceBatch(values=new_values.view(batch_size, max_edits, w_embed_size), mask=mask)
 
     def draw_p_noise(self, batch_size, edit_dim):
         rand_draw = GPUVariable(torch.randn(batch_size, edit_dim))
@@ -78,7 +88,7 @@ class EditEncoder(Module):
         KL loss is - log(maxvalue/eps)
         cut at maxvalue-eps, and add [0,eps] noise.
         """
-        trand = torch.rand(1).expand(munorm.size())*eps
+        trand = torch.rand(munorm.size()[0], 1).expand(munorm.size())*eps  # one draw per row
         return (self.normclip(munorm) + GPUVariable(trand))
 
     def sample_vMF(self, mu, kappa):
@@ -86,61 +96,103 @@ class EditEncoder(Module):
 
         http://stats.stackexchange.com/questions/156729/sampling-from-von-mises-fisher-distribution-in-python
 
+        All rows are sampled at once, with a single host-to-device transfer for the sampled weights.
+
         Args:
             mu (Tensor): of shape (batch_size, 2*word_dim)
             kappa (Float): controls dispersion. kappa of zero is no dispersion.
         """
         batch_size, id_dim = mu.size()
-        result_list = []
-        for i in range(batch_size):
-            munorm = mu[i].norm().expand(id_dim)
-            munoise = self.add_norm_noise(munorm, self.norm_eps)
-            if float(mu[i].norm().data.cpu().numpy()) > 1e-10:
-                # sample offset from center (on sphere) with spread kappa
-                w = self._sample_weight(kappa, id_dim)
-                wtorch = GPUVariable(w*torch.ones(id_dim))
-
-                # sample a point v on the unit sphere that's orthogonal to mu
-                v = self._sample_orthonormal_to(mu[i]/munorm, id_dim)
-
-                # compute new point
-                scale_factr = torch.sqrt(GPUVariable(torch.ones(id_dim)) - torch.pow(wtorch,2))
-                orth_term = v * scale_factr
-                muscale = mu[i] * wtorch / munorm
-                sampled_vec = (orth_term + muscale)*munoise
-            else:
-                rand_draw = GPUVariable(torch.randn(id_dim))
-                rand_draw = rand_draw / torch.norm(rand_draw, p=2).expand(id_dim)
-                rand_norms = (torch.rand(1) * self.norm_eps).expand(id_dim)
-                sampled_vec = rand_draw*GPUVariable(rand_norms)#mu[i]
-            result_list.append(sampled_vec)
+        expand = lambda v: v.expand(batch_size, id_dim)
+
+        # rows with a norm of (almost) zero have no direction, so they are replaced with a small random vector.
+        # They are offset before taking the norm, since the gradient of the norm of a zero vector is NaN.
+        is_zero_mask = (mu.data.norm(2, 1).view(batch_size, 1) <= 1e-10).type_as(mu.data)
+        offset = mu.data.new(batch_size, id_dim).zero_()
+        offset.narrow(1, 0, 1).copy_(is_zero_mask)
+        mu = mu + GPUVariable(offset)  # these rows are replaced anyway
+        is_zero = GPUVariable(is_zero_mask)
+
+        munorm = mu.norm(2, 1).view(batch_size, 1)
+        munoise = self.add_norm_noise(expand(munorm), self.norm_eps)
+        mu_unit = mu / expand(munorm)
+
+        # sample offset from center (on sphere) with spread kappa
+        w = GPUVariable(torch.from_numpy(self._sample_weights(kappa, id_dim, batch_size))).view(batch_size, 1)
+
+        # sample points v on the unit sphere that are orthogonal to mu
+        v = self._sample_orthonormal_to(mu_unit, id_dim)
+
+        # compute new points
+        orth_term = v * expand(torch.sqrt(1 - torch.pow(w, 2)))
+        muscale = mu_unit * expand(w)
+        sampled_vecs = (orth_term + muscale) * munoise
+
+        rand_draw = GPUVariable(torch.randn(batch_size, id_dim))
+        rand_draw = rand_draw / expand(torch.norm(rand_draw, 2, 1).view(batch_size, 1))
+        rand_norms = (torch.rand(batch_size, 1) * self.norm_eps).expand(batch_size, id_dim)
+        small_vecs = rand_draw * GPUVariable(rand_norms)
 
-        return torch.stack(result_list,0)
+        is_zero = expand(is_zero)
+        return sampled_vecs * (1 - is_zero) + small_vecs * is_zero
 
-    def _sample_weight(self, kappa, dim):
+    def _sample_weights(self, kappa, dim, num_samples):
+        """Sample num_samples weights w, either by rejection sampling or from the precomputed table.
+
+        Returns:
+            np.ndarray: float32 array of shape (num_samples,)
+        """
+        if self.w_table_size <= 0:
+            return self._sample_weight(kappa, dim, num_samples)
+
+        key = (kappa, dim)
+        if key not in self._w_tables:
+            self._w_tables[key] = self._sample_weight(kappa, dim, self.w_table_size)
+        table = self._w_tables[key]
+        return table[np.random.randint(len(table), size=num_samples)]
+
+    @classmethod
+    def _sample_weight(cls, kappa, dim, num_samples):
         """Rejection sampling scheme for sampling distance from center on
         surface of the sphere.
+
+        Rejected proposals are redrawn for all samples at once, until every sample is accepted.
+
+        Returns:
+            np.ndarray: float32 array of shape (num_samples,)
         """
         dim = dim - 1  # since S^{n-1}
         b = dim / (np.sqrt(4. * kappa ** 2 + dim ** 2) + 2 * kappa) # b= 1/(sqrt(4.* kdiv**2 + 1) + 2 * kdiv)
         x = (1. - b) / (1. + b)
         c = kappa * x + dim * np.log(1 - x ** 2)  # dim * (kdiv *x + np.log(1-x**2))
 
-        while True:
-            z = np.random.beta(dim / 2., dim / 2.)  #concentrates towards 0.5 as d-> inf
-            w = (1. - (1. + b) * z) / (1. - (1. - b) * z)
-            u = np.random.uniform(low=0, high=1)
-            if kappa * w + dim * np.log(1. - x * w) - c >= np.log(u): #thresh is dim *(kdiv * (w-x) + log(1-x*w) -log(1-x**2))
-                return w
+        w = np.zeros(num_samples, dtype=np.float32)
+        pending = np.arange(num_samples)
+        while len(pending) > 0:
+            z = np.random.beta(dim / 2., dim / 2., size=len(pending))  #concentrates towards 0.5 as d-> inf
+            proposal = (1. - (1. + b) * z) / (1. - (1. - b) * z)
+            u = np.random.uniform(low=0, high=1, size=len(pending))
+            #thresh is dim *(kdiv * (w-x) + log(1-x*w) -log(1-x**2))
+            accept = kappa * proposal + dim * np.log(1. - x * proposal) - c >= np.log(u)
+            w[pending[accept]] = proposal[accept]
+            pending = pending[~accept]
+        return w
 
     def _sample_orthonormal_to(self, mu, dim):
-        """Sample point on sphere orthogonal to mu.
+        """Sample points on sphere orthogonal to each row of mu.
+
+        Args:
+            mu (Variable): unit vectors of shape (batch_size, dim)
+
+        Returns:
+            Variable: of shape (batch_size, dim)
         """
-        v = GPUVariable(torch.randn(dim))
-        rescale_value = mu.dot(v) / mu.norm()
-        proj_mu_v = mu * rescale_value.expand(dim)
+        batch_size = mu.size()[0]
+        v = GPUVariable(torch.randn(batch_size, dim))
+        rescale_value = (mu * v).sum(1).view(batch_size, 1)  # mu has unit norm
+        proj_mu_v = mu * rescale_value.expand(batch_size, dim)
         ortho = v - proj_mu_v
-        ortho_norm = torch.norm(ortho)
+        ortho_norm = torch.norm(ortho, 2, 1).view(batch_size, 1)
         return ortho / ortho_norm.expand_as(ortho)
 
 def test_sample_weight(kappa, dim):
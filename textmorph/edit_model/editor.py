@@ -2,12 +2,17 @@ from collections import namedtuple
 from itertools import izip
 
 import numpy as np
+import torch
 from nltk import word_tokenize
 from torch.nn import Module, LSTMCell
 
 from gtd.utils import UnicodeMixin, chunks
-from gtd.ml.torch.decoder import TrainDecoder, BeamDecoder, TrainDecoderInput
-from textmorph.edit_model.encoder import Encoder
+from gtd.ml.torch.utils import GPUVariable
+from gtd.ml.vocab import WordVocab
+from gtd.ml.torch.decoder import TrainDecoder, BeamDecoder, TrainDecoderInput, ContinuousBeamDecoder
+from gtd.ml.torch.seq_batch import SequenceBatch
+from gtd.ml.torch.source_encoder import MultiLayerSourceEncoder
+from textmorph.edit_model.encoder import Encoder, EncoderInput
 from textmorph.edit_model.attention_decoder import AttentionContextCombiner
 
 class Editor(Module):
@@ -18,7 +23,8 @@ class Editor(Module):
         train_decoder (TrainDecoder)
     """
 
-    def __init__(self, token_embedder, hidden_dim, agenda_dim, edit_dim, lamb_reg, norm_eps, norm_max, kill_edit, decoder_cell, encoder_layers):
+    def __init__(self, token_embedder, hidden_dim, agenda_dim, edit_dim, lamb_reg, norm_eps, norm_max, kill_edit, decoder_cell, encoder_layers,
+                 fused_encoder=False, num_sampled=0, vmf_table_size=0):
         """Construct Editor.
 
         Args:
@@ -28,13 +34,48 @@ class Editor(Module):
             edit_dim (int)
             decoder_cell (DecoderCell)
             encoder_layers (int)
+            fused_encoder (bool): encode sources with a fused (cuDNN) LSTM, see MultiLayerSourceEncoder
+            num_sampled (int): if > 0, train with a sampled softmax over this many sampled words (see TrainDecoder).
+                The loss is exact in eval mode.
+            vmf_table_size (int): if > 0, draw vMF weights from a precomputed table of this size (see EditEncoder)
         """
         super(Editor, self).__init__()
         self.encoder = Encoder(token_embedder, agenda_dim, edit_dim, hidden_dim, lamb_reg, norm_eps, norm_max, kill_edit, encoder_layers,
-                                   rnn_cell_factory=LSTMCell)
+                                   rnn_cell_factory=LSTMCell, fused=fused_encoder, vmf_table_size=vmf_table_size)
         context_combiner = AttentionContextCombiner()
-        self.train_decoder = TrainDecoder(decoder_cell, token_embedder, context_combiner)
-        self.test_decoder_beam = BeamDecoder(decoder_cell, token_embedder, context_combiner)
+        self.train_decoder = TrainDecoder(decoder_cell, token_embedder, context_combiner, num_sampled=num_sampled)
+        self.test_decoder_beam = BeamDecoder(decoder_cell, token_embedder, context_combiner, tensorized=True)
+
+    def load_state_dict(self, state_dict):
+        """Load parameters, converting the source encoder weights of non-fused checkpoints if needed."""
+        if self.encoder.source_encoder.fused:
+            state_dict = MultiLayerSourceEncoder.fuse_state_dict(state_dict)
+        super(Editor, self).load_state_dict(state_dict)
+
+    def fuse_optimizer_state_dict(self, optimizer_state_dict, state_dict):
+        """Convert the state of an optimizer over a checkpoint's parameters to this editor's parameters, if needed.
+
+        Converts the optimizer state when this editor has a fused source encoder, but the checkpoint does not
+        (see MultiLayerSourceEncoder.fuse_optimizer_state_dict).
+
+        Args:
+            optimizer_state_dict (dict): Optimizer.state_dict() of an optimizer over the checkpoint's parameters
+            state_dict (dict[str, Tensor]): the checkpoint's Editor.state_dict()
+
+        Returns:
+            dict
+        """
+        source_encoder = self.encoder.source_encoder
+        if not source_encoder.fused or not MultiLayerSourceEncoder.is_unfused_state_dict(state_dict):
+            return optimizer_state_dict
+
+        # the parameters of the source encoder are contiguous in parameters(); swap in their non-fused names
+        prefix = 'encoder.source_encoder.'
+        names = [name for name, _ in self.named_parameters()]
+        start = next(i for i, name in enumerate(names) if name.startswith(prefix))
+        end = start + len(list(source_encoder.parameters()))
+        unfused_names = names[:start] + [prefix + name for name in source_encoder.unfused_parameter_names()] + names[end:]
+        return MultiLayerSourceEncoder.fuse_optimizer_state_dict(optimizer_state_dict, unfused_names, names)
 
     @classmethod
     def _batch_editor_examples(cls, examples):
@@ -67,11 +108,51 @@ class Editor(Module):
         Returns:
             EditorInput
         """
-        source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, target_words, edit_embed = self._batch_editor_examples(
+        return self.preprocess_indexed(self.index_batch(examples, self.train_decoder.word_vocab))
+
+    @classmethod
+    def index_batch(cls, examples, word_vocab, indexed=False):
+        """Convert a batch of EditExamples into CPU tensors of word indices.
+
+        This is the part of preprocess that does not touch the GPU, so it can run in a data loading process.
+
+        Args:
+            examples (list[EditExample])
+            word_vocab (WordVocab)
+            indexed (bool): if True, the examples hold word indices of word_vocab rather than words
+                (see CompiledEditBatch.vocab_examples)
+
+        Returns:
+            IndexedEditorInput
+        """
+        source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, target_words, edit_embed = cls._batch_editor_examples(
             examples)
-        encoder_input = self.encoder.preprocess(source_words, insert_words, insert_exact_words, delete_words,
-                                                delete_exact_words, edit_embed)
-        train_decoder_input = TrainDecoderInput(target_words, self.train_decoder.word_vocab)
+        # insert_words and delete_words will often be empty, but we still enforce a min_seq_length of 1 (see
+        # Encoder.preprocess)
+        to_indices = list if indexed else word_vocab.words2indices
+        index = lambda sequences, min_seq_length=0: SequenceBatch.index_tensors(
+            [to_indices(seq) for seq in sequences], min_seq_length)
+        decoder_input_words, decoder_target_words = TrainDecoderInput.index_tensors(target_words, word_vocab,
+                                                                                    indexed)
+        return IndexedEditorInput(index(source_words), index(insert_words, 1), index(insert_exact_words, 1),
+                                  index(delete_words, 1), index(delete_exact_words, 1), edit_embed,
+                                  decoder_input_words, decoder_target_words)
+
+    def preprocess_indexed(self, indexed):
+        """Finish preprocessing a batch indexed by index_batch.
+
+        Args:
+            indexed (IndexedEditorInput)
+
+        Returns:
+            EditorInput
+        """
+        seq_batch = SequenceBatch.from_index_tensors
+        encoder_input = EncoderInput(seq_batch(indexed.source_words), seq_batch(indexed.insert_words),
+                                     seq_batch(indexed.insert_exact_words), seq_batch(indexed.delete_words),
+                                     seq_batch(indexed.delete_exact_words), indexed.edit_embed)
+        train_decoder_input = TrainDecoderInput.from_index_tensors(indexed.decoder_input_words,
+                                                                   indexed.decoder_target_words)
         return EditorInput(encoder_input, train_decoder_input)
 
     def forward(self, editor_input, draw_samples, draw_p=False):
@@ -98,12 +179,59 @@ class Editor(Module):
         Returns:
             loss (Variable): of shape 1
         """
-        editor_input = self.preprocess(examples)
+        return self.indexed_loss(self.index_batch(examples, self.train_decoder.word_vocab), draw_samples, draw_p)
+
+    def indexed_loss(self, indexed, draw_samples=False, draw_p=False):
+        """Compute loss Variable for a batch indexed by index_batch.
+
+        Args:
+            indexed (IndexedEditorInput)
+            draw_samples (bool) : flag for whether to add noise for variational approx. disable at test time.
+
+        Returns:
+            loss (Variable): of shape 1
+        """
+        editor_input = self.preprocess_indexed(indexed)
         total_loss = self(editor_input, draw_samples, draw_p)
         if draw_samples:
             total_loss += self.encoder.regularizer(editor_input.encoder_input)
         return total_loss
 
+    def loss_and_edit(self, examples, draw_samples=False, max_seq_length=35, beam_size=5, length_penalty=0.,
+                      traces='final'):
+        """Compute the loss of a batch and beam decode it, in one pass.
+
+        The batch is indexed and preprocessed once, for both. If not draw_samples, the encoding is shared too.
+        Otherwise, the loss uses a noisy encoding, and decoding uses the noiseless one (as in `edit`).
+
+        Args:
+            examples (list[EditExample])
+            draw_samples (bool): flag for whether to add noise for variational approx. to the loss.
+            max_seq_length (int): max # timesteps to generate for
+            beam_size (int): for beam decoding
+            length_penalty (float): see `edit`
+            traces (str): see `edit`
+
+        Returns:
+            loss (Variable): of shape 1
+            beam_list (list[list[list[unicode]]])
+            edit_traces (list[EditTrace]): see `edit`
+        """
+        editor_input = self.preprocess(examples)
+        encoder_input = editor_input.encoder_input
+
+        encoder_output = self.encoder(encoder_input, draw_samples)
+        loss = self.train_decoder.loss(encoder_output, editor_input.train_decoder_input)
+        if draw_samples:
+            loss += self.encoder.regularizer(encoder_input)
+            encoder_output = self.encoder(encoder_input)
+
+        beams, decoder_traces = self.test_decoder_beam.decode(examples, encoder_output, weighted_value_estimators=[],
+                                                              beam_size=beam_size, prefix_hints=[[]],
+                                                              sibling_penalty=0, max_seq_length=max_seq_length,
+                                                              length_penalty=length_penalty, traces=traces)
+        return loss, beams, self._edit_traces(examples, decoder_traces, traces)
+
     def per_instance_losses(self, examples, draw_samples=False, batch_size=128):
         """Compute per-instance losses."""
         per_instance_loss_list = []
@@ -130,7 +258,8 @@ class Editor(Module):
             raise Exception('test_batch called with example list of length < 2')
         print 'Passed batching test'
 
-    def edit(self, examples, max_seq_length=35, beam_size=5, batch_size=256):
+    def edit(self, examples, max_seq_length=35, beam_size=5, batch_size=256, length_penalty=0., vocab_shortlist=0,
+             traces='final'):
         """Performs edits on a batch of source sentences.
 
         Args:
@@ -139,31 +268,115 @@ class Editor(Module):
             beam_size (int): for beam decoding
             batch_size (int): max number of examples to pass into the RNN decoder at a time.
                 The total # examples decoded in parallel = batch_size / beam_size.
+            length_penalty (float): length normalization strength for beam decoding (see BeamDecoder.decode)
+            vocab_shortlist (int): if > 0, restrict the output vocab of each example to its source and insert words,
+                plus this many of the most frequent words. This speeds up decoding with large vocabs.
+                If 0 (default), decode over the full vocab.
+            traces (str): 'none' to skip building traces, 'final' (default) to trace the final beams, or 'full' to
+                also trace every decoding step (for debugging, see BeamDecoder.decode).
 
         Returns:
             beam_list (list[list[list[unicode]]]): a batch of beams.
-            edit_traces (list[EditTrace])
+            edit_traces (list[EditTrace]): None if traces == 'none'. If traces == 'full', each
+                EditTrace.decoder_trace is a BeamDecoderTrace, otherwise it is the final BeamTrace.
         """
         beam_list = []
-        edit_traces = []
+        edit_traces = None if traces == 'none' else []
         for batch in chunks(examples, batch_size / beam_size):
-            beams, traces = self._edit_batch(batch, max_seq_length, beam_size)
+            beams, batch_traces = self._edit_batch(batch, max_seq_length, beam_size, length_penalty, vocab_shortlist,
+                                                   traces)
             beam_list.extend(beams)
-            edit_traces.extend(traces)
+            if edit_traces is not None:
+                edit_traces.extend(batch_traces)
         return beam_list, edit_traces
 
-    def _edit_batch(self, examples, max_seq_length, beam_size):
+    def edit_stream(self, examples, max_seq_length=35, beam_size=5, batch_size=256, length_penalty=0.,
+                    vocab_shortlist=0):
+        """Performs edits on a stream of source sentences, with continuous batching.
+
+        Unlike `edit`, examples join the batch as soon as others finish, so results are yielded in the order
+        that they finish, rather than the order of examples.
+
+        Args:
+            examples (Iterable[EditExample])
+            max_seq_length (int): max # timesteps to generate for
+            beam_size (int): for beam decoding
+            batch_size (int): max number of examples to pass into the RNN decoder at a time.
+                The total # examples decoded in parallel = batch_size / beam_size.
+            length_penalty (float): length normalization strength for beam decoding (see BeamDecoder.decode)
+            vocab_shortlist (int): see `edit`
+
+        Returns:
+            Iterable[(EditExample, list[list[unicode]], EditTrace)]
+        """
+        decoder = self.continuous_decoder(max_seq_length, beam_size, batch_size, length_penalty, vocab_shortlist)
+        for ex, beam, d_trace in decoder.decode(examples):
+            yield ex, beam, EditTrace(ex, d_trace.beam_traces[-1])
+
+    def continuous_decoder(self, max_seq_length=35, beam_size=5, batch_size=256, length_penalty=0., vocab_shortlist=0):
+        """Create a ContinuousBeamDecoder, e.g. to submit examples and receive beams through futures.
+
+        See `edit_stream` for arguments.
+
+        Returns:
+            ContinuousBeamDecoder
+        """
+        encode = lambda examples: self._encode_examples(examples, vocab_shortlist)
+        return ContinuousBeamDecoder(self.test_decoder_beam, encode, batch_size / beam_size,
+                                     beam_size, max_seq_length=max_seq_length, sibling_penalty=0,
+                                     length_penalty=length_penalty)
+
+    def _encode_examples(self, examples, vocab_shortlist=0):
         source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, _, edit_embed = self._batch_editor_examples(
             examples)
         encoder_input = self.encoder.preprocess(source_words, insert_words, insert_exact_words, delete_words,
                                                 delete_exact_words, edit_embed)
         encoder_output = self.encoder(encoder_input)
+        if vocab_shortlist > 0:
+            encoder_output = encoder_output._replace(vocab_shortlist=self._vocab_shortlist(examples, vocab_shortlist))
+        return encoder_output
+
+    def _vocab_shortlist(self, examples, num_frequent):
+        """Build the shortlist of words which the decoder may generate for each example.
+
+        The shortlist contains the special tokens, the source and insert words of the example, and the
+        num_frequent most frequent words (the vocab is assumed to be sorted by frequency).
+
+        Args:
+            examples (list[EditExample])
+            num_frequent (int)
+
+        Returns:
+            Variable: ByteTensor of shape (batch_size, vocab_size)
+        """
+        vocab = self.test_decoder_beam.word_vocab
+        shortlist = np.zeros((len(examples), len(vocab)), dtype=np.uint8)
+        shortlist[:, :num_frequent] = 1
+        shortlist[:, [vocab.word2index(w) for w in WordVocab.SPECIAL_TOKENS]] = 1
+        for i, ex in enumerate(examples):
+            words = list(ex.source_words) + list(ex.insert_words) + list(ex.insert_exact_words)
+            shortlist[i, [vocab.word2index(w) for w in words]] = 1
+        return GPUVariable(torch.from_numpy(shortlist))
+
+    def _edit_batch(self, examples, max_seq_length, beam_size, length_penalty=0., vocab_shortlist=0,
+                    traces='final'):
+        encoder_output = self._encode_examples(examples, vocab_shortlist)
 
         beams, decoder_traces = self.test_decoder_beam.decode(examples, encoder_output, weighted_value_estimators=[]
                                                                      , beam_size=beam_size, prefix_hints = [[]]
-                                                                     , sibling_penalty=0, max_seq_length=max_seq_length)
+                                                                     , sibling_penalty=0, max_seq_length=max_seq_length
+                                                                     , length_penalty=length_penalty, traces=traces)
 
-        return beams, [EditTrace(ex, d_trace.beam_traces[-1]) for ex, d_trace in izip(examples, decoder_traces)]
+        return beams, self._edit_traces(examples, decoder_traces, traces)
+
+    @classmethod
+    def _edit_traces(cls, examples, decoder_traces, traces):
+        """Wrap decoder traces into EditTraces (see `edit`)."""
+        if traces == 'none':
+            return None
+        if traces == 'full':
+            return [EditTrace(ex, d_trace) for ex, d_trace in izip(examples, decoder_traces)]
+        return [EditTrace(ex, d_trace.beam_traces[-1]) for ex, d_trace in izip(examples, decoder_traces)]
 
     def interact(self, beam_size=8, verbose=True):
         ex = EditExample.from_prompt()
@@ -306,3 +519,20 @@ Attributes:
     encoder_input (EncoderInput)
     train_decoder_input (TrainDecoderInput)
 """
+
+
+IndexedEditorInput = namedtuple('IndexedEditorInput', ['source_words', 'insert_words', 'insert_exact_words',
+                                                       'delete_words', 'delete_exact_words', 'edit_embed',
+                                                       'decoder_input_words', 'decoder_target_words'])
+"""A batch of EditExamples converted into CPU tensors (see Editor.index_batch).
+
+Attributes:
+    source_words ((LongTensor, FloatTensor)): values and mask of each SequenceBatch of EncoderInput
+    insert_words ((LongTensor, FloatTensor))
+    insert_exact_words ((LongTensor, FloatTensor))
+    delete_words ((LongTensor, FloatTensor))
+    delete_exact_words ((LongTensor, FloatTensor))
+    edit_embed (np.ndarray | None): of shape (batch_size, edit_dim), or None.
+    decoder_input_words ((LongTensor, FloatTensor)): values and mask of TrainDecoderInput.input_words
+    decoder_target_words ((LongTensor, FloatTensor)): values and mask of TrainDecoderInput.target_words
+"""
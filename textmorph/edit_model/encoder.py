@@ -26,14 +26,23 @@ Note:
     by the EditEncoder.
 """
 
-class EncoderOutput(namedtuple('EncoderOutput', ['source_embeds', 'insert_embeds', 'delete_embeds', 'agenda']), NamedTupleLike):
-    pass
+class EncoderOutput(namedtuple('EncoderOutput', ['source_embeds', 'insert_embeds', 'delete_embeds', 'agenda', 'vocab_shortlist',
+                                               'attention_memories']), NamedTupleLike):
+    def __new__(cls, source_embeds, insert_embeds, delete_embeds, agenda, vocab_shortlist=None,
+                attention_memories=None):
+        return super(EncoderOutput, cls).__new__(cls, source_embeds, insert_embeds, delete_embeds, agenda,
+                                                 vocab_shortlist, attention_memories)
 """
 Args:
     source_embeds (SequenceBatch): of shape (batch_size, seq_length, hidden_size)
     insert_embeds (SequenceBatch): of shape (batch_size, max_edits, word_dim) ONLY contains inserts for the exact part for attention.
     delete_embeds (SequenceBatch): of shape (batch_size, max_edits, word_dim)
     agenda (Variable): of shape (batch_size, agenda_dim)
+    vocab_shortlist (Variable): ByteTensor of shape (batch_size, vocab_size), marking the words which the decoder
+        may generate for each example. If None (default), the decoder uses the full vocab.
+        AttentionDecoderCell.prepare replaces it with a VocabShortlist.
+    attention_memories (AttentionMemories): the decoder's precomputed attention over source_embeds, insert_embeds and
+        delete_embeds (see AttentionDecoderCell.prepare), or None.
 """
 
 
@@ -43,7 +52,8 @@ Args:
 # also see TODOs in decoder.py
 
 class Encoder(Module):
-    def __init__(self, token_embedder, agenda_dim, edit_dim, hidden_dim, lamb_reg, norm_eps, norm_max, kill_edit, num_layers, rnn_cell_factory):
+    def __init__(self, token_embedder, agenda_dim, edit_dim, hidden_dim, lamb_reg, norm_eps, norm_max, kill_edit, num_layers, rnn_cell_factory,
+                 fused=False, vmf_table_size=0):
         """Construct Encoder.
 
         Args:
@@ -53,6 +63,8 @@ class Encoder(Module):
             hidden_dim (int)
             num_layers (int)
             rnn_cell_factory (Callable[[int, int], RNNCell): takes input_dim and output_dim as arguments.
+            fused (bool): use the fused LSTM backend of MultiLayerSourceEncoder
+            vmf_table_size (int): size of the precomputed table of vMF weights (see EditEncoder), 0 to disable
         """
         super(Encoder, self).__init__()
 
@@ -64,8 +76,8 @@ class Encoder(Module):
         self.lamb_reg = lamb_reg
         self.kill_edit = kill_edit
 
-        self.source_encoder = MultiLayerSourceEncoder(word_dim, hidden_dim, num_layers, rnn_cell_factory)
-        self.edit_encoder = EditEncoder(word_dim, edit_dim, lamb_reg, norm_eps, norm_max)
+        self.source_encoder = MultiLayerSourceEncoder(word_dim, hidden_dim, num_layers, rnn_cell_factory, fused=fused)
+        self.edit_encoder = EditEncoder(word_dim, edit_dim, lamb_reg, norm_eps, norm_max, w_table_size=vmf_table_size)
         self.agenda_maker = AgendaMaker(self.source_encoder.hidden_dim, self.edit_dim, self.agenda_dim)
 
     def preprocess(self, source_words, insert_words, insert_exact_words, delete_words, delete_exact_words, edit_embed):
@@ -0,0 +1,34 @@
+import codecs
+import os
+from os.path import join
+
+from textmorph.edit_model import compiled_data
+
+
+def write_split(data_dir, split, lines):
+    with codecs.open(join(data_dir, '{}.tsv'.format(split)), 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + u'\n')
+
+
+def test_is_stale(tmpdir):
+    data_dir = str(tmpdir)
+    for split in compiled_data.SPLITS:
+        write_split(data_dir, split, [u'a b c\ta b d'])
+
+    assert not compiled_data.is_compiled(data_dir, True)
+    compiled_data.compile_data(data_dir, True, vocab_size=10)
+    assert compiled_data.is_compiled(data_dir, True)
+    assert not compiled_data.is_stale(data_dir, True, vocab_size=10)
+    assert compiled_data.is_stale(data_dir, True, vocab_size=20)
+
+    write_split(data_dir, 'valid', [u'a b c\ta b d', u'c d\td'])
+    assert compiled_data.is_stale(data_dir, True, vocab_size=10)
+
+    compiled_data.compile_data(data_dir, True, vocab_size=10)
+    assert not compiled_data.is_stale(data_dir, True, vocab_size=10)
+    assert len(compiled_data.CompiledEditSplit(compiled_data.compiled_dir(data_dir, True), 'valid',
+                                               compiled_data.load_tokens(data_dir, True))) == 2
+
+    os.remove(join(compiled_data.compiled_dir(data_dir, True), 'metadata.json'))
+    assert compiled_data.is_stale(data_dir, True, vocab_size=10)
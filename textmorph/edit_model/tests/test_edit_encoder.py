@@ -0,0 +1,22 @@
+import numpy as np
+import torch
+from torch.nn import Parameter
+
+from textmorph.edit_model.edit_encoder import EditEncoder
+
+
+def test_sample_vMF_zero_row_grads():
+    encoder = EditEncoder(word_dim=4, edit_dim=6, kappa_init=100., norm_eps=0.1, norm_max=10.)
+    mu = Parameter(torch.FloatTensor([
+        [1, 2, 0, 0, 1, 1],
+        [0, 0, 0, 0, 0, 0],  # e.g. an identity edit
+    ]))
+
+    samples = encoder.sample_vMF(mu, encoder.noise_scaler)
+    samples.sum().backward()
+
+    assert np.all(np.isfinite(samples.data.numpy()))
+    assert np.all(np.isfinite(mu.grad.data.numpy()))
+    # the zero row is replaced by a small vector, which does not depend on mu
+    assert np.linalg.norm(samples.data.numpy()[1]) <= encoder.norm_eps
+    assert np.all(mu.grad.data.numpy()[1] == 0)
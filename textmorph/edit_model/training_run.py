@@ -1,8 +1,8 @@
 import cPickle as pickle
 import codecs
 import random
+from collections import OrderedDict
 from contextlib import contextmanager
-from itertools import izip
 from os import listdir
 import os
 from os.path import dirname, realpath, join
@@ -12,22 +12,27 @@ import torch
 import torch.optim as optim
 from tensorboard_logger import tensorboard_logger
 from torch.autograd import Variable
-from torch.nn.utils import clip_grad_norm
-from fabric.api import local
 
 import gtd.io
 from gtd.chrono import verboserate
 from gtd.log import Metadata
-from gtd.utils import random_seed, sample_if_large, bleu, Failure, Config, chunks
+from gtd.utils import random_seed, sample_if_large, batch_bleu, index_tokens, Failure, Config, chunks
 from gtd.ml.training_run import TrainingRunWorkspace, TrainingRuns
 from gtd.ml.torch.training_run import TorchTrainingRun
 from textmorph import data
+from textmorph.edit_model import compiled_data
 from textmorph.edit_model.attention_decoder import AttentionDecoderCell
+from textmorph.edit_model.compiled_data import CompiledEditSplit, CompiledEditBatch
+from textmorph.edit_model.data_pipeline import EditBatchPipeline
 from gtd.ml.torch.simple_decoder_cell import SimpleDecoderCell
 from textmorph.edit_model.edit_noiser import EditNoiser
 from textmorph.edit_model.editor import Editor, EditExample
+from gtd.ml.torch.background_eval import BackgroundEvaluator
+from gtd.ml.torch.checkpoint_writer import CheckpointWriter, checkpoint_numbers, load_tensors
+from gtd.ml.torch.seq_batch import seq_batch_validation
 from gtd.ml.torch.token_embedder import TokenEmbedder
-from gtd.ml.torch.utils import similar_size_batches, try_gpu
+from gtd.ml.torch.utils import similar_size_batches, token_budget_batches, BatchSchedule, try_gpu, \
+    finite_grads, clip_grad_norm_finite
 from gtd.ml.vocab import SimpleEmbeddings, WordVocab
 
 class EditTrainingRuns(TrainingRuns):
@@ -79,20 +84,26 @@ class EditTrainingRuns(TrainingRuns):
 class EditDataSplits(object):
     """
     Attributes:
-        train (list[EditExample])
-        valid (list[EditExample])
-        test (list[EditExample])
+        train (list[EditExample]|CompiledEditSplit)
+        valid (list[EditExample]|CompiledEditSplit)
+        test (list[EditExample]|CompiledEditSplit)
         free (list[unicode]): a list of "free words" which are excluded from insertions and deletions
     """
 
-    def __init__(self, data_dir, use_diff):
+    def __init__(self, data_dir, use_diff, vocab_size=None):
         """Load examples for training, validation and testing.
 
         See README.md for how to format data so it can be loaded here.
         NOTE: this converts everything to lower case.
 
+        If the dataset has been compiled (see compiled_data.compile_data), the splits are memory-mapped
+        CompiledEditSplits instead, which load in seconds. A compiled dataset which no longer matches its TSV files
+        or the vocab size is recompiled first.
+
         Args:
             data_dir (str): absolute path to dataset
+            use_diff (bool)
+            vocab_size (int): vocab size of the model (config.editor.vocab_size)
 
         Returns:
             EditDataSplits
@@ -103,31 +114,21 @@ class EditDataSplits(object):
         #    free_set = set(free)
         free_set = set()
 
-        def examples_from_file(path):
-            """Return list[EditExample] from file path."""
-            examples = []
-
-            # count total lines before loading
-            total_lines = int(local('wc -l {}'.format(path), capture=True).split()[0])
-
-            with codecs.open(path, 'r', encoding='utf-8') as f:
-                for line in verboserate(f, desc='Reading data file.', total=total_lines):
-                    src, trg = line.strip().lower().split("\t")
-                    src_words = src.split(' ')
-                    trg_words = trg.split(' ')
-                    assert len(src_words) > 0
-                    assert len(trg_words) > 0
-
-                    if use_diff:
-                        ex = EditExample.salient_diff(src_words, trg_words, free_set)
-                    else:
-                        ex = EditExample.whitelist_blacklist(src_words, trg_words)
-                    examples.append(ex)
-            return examples
-
-        self.train = examples_from_file(join(data_dir, 'train.tsv'))
-        self.valid = examples_from_file(join(data_dir, 'valid.tsv'))
-        self.test = examples_from_file(join(data_dir, 'test.tsv'))
+        if compiled_data.is_compiled(data_dir, use_diff) and compiled_data.is_stale(data_dir, use_diff, vocab_size):
+            print 'Compiled dataset does not match its data files or vocab size. Recompiling.'
+            compiled_data.compile_data(data_dir, use_diff, vocab_size)
+
+        if compiled_data.is_compiled(data_dir, use_diff):
+            directory = compiled_data.compiled_dir(data_dir, use_diff)
+            tokens = compiled_data.load_tokens(data_dir, use_diff)
+            load_split = lambda split: compiled_data.CompiledEditSplit(directory, split, tokens)
+        else:
+            load_split = lambda split: list(compiled_data.read_examples(join(data_dir, '{}.tsv'.format(split)),
+                                                                        use_diff, free_set))
+
+        self.train = load_split('train')
+        self.valid = load_split('valid')
+        self.test = load_split('test')
         self.free = list()
 
 
@@ -135,17 +136,21 @@ class RandomState(object):
     def __init__(self):
         """Take a snapshot of random number generator state at this point in time.
 
-        Only covers random, numpy.random and torch (CPU).
+        Covers random, numpy.random, torch (CPU) and torch (current GPU, if available).
         """
         self.py = random.getstate()
         self.np = np.random.get_state()
         self.torch = torch.get_rng_state()
+        self.cuda = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
 
     def set_global(self):
         """Set all global random number generators to this state."""
         random.setstate(self.py)
         np.random.set_state(self.np)
         torch.set_rng_state(self.torch)
+        cuda = getattr(self, 'cuda', None)  # RandomStates pickled before the GPU state was covered lack it
+        if cuda is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state(cuda)
 
 
 # TODO(kelvin): make this a classmethod on RandomState?
@@ -161,8 +166,10 @@ def random_state(state):
     """
     old_state = RandomState()
     state.set_global()
-    yield
-    old_state.set_global()
+    try:
+        yield
+    finally:
+        old_state.set_global()
 
 
 # TODO(kelvin): reduce coupling with RandomState
@@ -174,7 +181,7 @@ def random_seed(seed):
 
     WARNING: torch GPU seeds are NOT set!
 
-    Does not affect the state of random number generators outside this block.
+    Does not affect the state of random number generators outside this block (see RandomState).
     Not thread-safe.
 
     Args:
@@ -184,12 +191,14 @@ def random_seed(seed):
     random.seed(seed)  # alter state
     np.random.seed(seed)
     torch.manual_seed(seed)
-    yield
-    state.set_global()
+    try:
+        yield
+    finally:
+        state.set_global()
 
 
 class TrainState(object):
-    def __init__(self, editor, optimizer, train_steps, random_state, max_grad_norm):
+    def __init__(self, editor, optimizer, train_steps, random_state, max_grad_norm, batch_schedule=None):
         """Construct a snapshot of training state.
 
         Args:
@@ -198,12 +207,15 @@ class TrainState(object):
             train_steps (int)
             random_state (RandomState)
             max_grad_norm (float): used for gradient clipping
+            batch_schedule (BatchSchedule): position in the training data (epoch, and batches consumed in that epoch).
+                None if training has not started (or for checkpoints saved before it was tracked).
         """
         self.editor = editor
         self.optimizer = optimizer
         self.train_steps = train_steps
         self.random_state = random_state
         self.max_grad_norm = max_grad_norm
+        self.batch_schedule = batch_schedule
 
     def update_random_state(self):
         """Store the latest random state."""
@@ -217,17 +229,19 @@ class TrainState(object):
         self.max_grad_norm = max(self.max_grad_norm, 2 * grad_norm)
 
     def save(self, checkpoints_dir):
-        path = join(checkpoints_dir, '{}.checkpoint'.format(self.train_steps))
-        gtd.io.makedirs(path)
+        """Write a checkpoint to checkpoints_dir, synchronously."""
+        self.save_with(CheckpointWriter(checkpoints_dir, background=False))
 
-        # save model
-        torch.save(self.editor.state_dict(), join(path, 'editor'))
-        torch.save(self.optimizer.state_dict(), join(path, 'optimizer'))
+    def save_with(self, writer):
+        """Write a checkpoint with a CheckpointWriter (possibly in the background, see CheckpointWriter.save).
 
+        Args:
+            writer (CheckpointWriter)
+        """
         # pickle remaining attributes
-        d = {attr: getattr(self, attr) for attr in ['train_steps', 'random_state', 'max_grad_norm']}
-        with open(join(path, 'metadata.p'), 'w') as f:
-            pickle.dump(d, f)
+        d = {attr: getattr(self, attr) for attr in ['train_steps', 'random_state', 'max_grad_norm', 'batch_schedule']}
+        writer.save(self.train_steps, {'editor': self.editor.state_dict(), 'optimizer': self.optimizer.state_dict()},
+                    {'metadata.p': d})
 
     @classmethod
     def load(cls, path, editor, optimizer):
@@ -235,8 +249,9 @@ class TrainState(object):
             d = pickle.load(f)
 
         # load model
-        optimizer.load_state_dict(torch.load(join(path, 'optimizer')))
-        editor.load_state_dict(torch.load(join(path, 'editor')))
+        editor_state = load_tensors(join(path, 'editor'))
+        optimizer.load_state_dict(editor.fuse_optimizer_state_dict(load_tensors(join(path, 'optimizer')), editor_state))
+        editor.load_state_dict(editor_state)
         train_state = TrainState(editor=editor, optimizer=optimizer, **d)
         return train_state
 
@@ -248,6 +263,12 @@ class EditTrainingRun(TorchTrainingRun):
         # extra dir for storing TrainStates where NaN was encountered
         self.workspace.add_dir('nan_checkpoints', 'nan_checkpoints')
 
+        # the evaluation process is forked before the model initializes CUDA (see BackgroundEvaluator)
+        if config.eval.get('eval_process', False):
+            self._evaluator = BackgroundEvaluator(lambda: self._eval_setup(config), self._eval_in_background)
+        else:
+            self._evaluator = None
+
         # reload train state (includes model)
         checkpoints_dir = self.workspace.checkpoints
         ckpt_num = self._get_latest_checkpoint_number(checkpoints_dir)
@@ -260,10 +281,11 @@ class EditTrainingRun(TorchTrainingRun):
 
         # load data
         data_dir = join(data.workspace.root, config.dataset.path)
-        self._examples = EditDataSplits(data_dir, config.dataset.use_diff)
+        self._examples = EditDataSplits(data_dir, config.dataset.use_diff, config.editor.vocab_size)
 
     def train(self):
-        self._train(self.config, self._train_state, self._examples, self.workspace, self.metadata, self.tb_logger)
+        self._train(self.config, self._train_state, self._examples, self.workspace, self.metadata, self.tb_logger,
+                    self._evaluator)
 
     def reload(self, train_steps):
         """Reload the checkpoint that was saved after taking `train_steps` steps."""
@@ -271,7 +293,8 @@ class EditTrainingRun(TorchTrainingRun):
 
     def evaluate(self, big_eval=True):
         """Run an evaluation without logging it."""
-        self._evaluate(self.config, self.editor, self._examples, None, None, 0, big_eval, log=False)
+        noiser = EditNoiser(self.config.editor.ident_pr, self.config.editor.attend_pr)
+        self._evaluate(self.config, self.editor, self._examples, None, None, 0, noiser, big_eval, log=False)
 
     @property
     def editor(self):
@@ -311,7 +334,9 @@ class EditTrainingRun(TorchTrainingRun):
         else:
             raise ValueError('{} not implemented'.format(config.decoder_cell))
 
-        editor = Editor(source_token_embedder, config.hidden_dim, config.agenda_dim, config.edit_dim, config.lamb_reg, config.norm_eps, config.norm_max, config.kill_edit, decoder_cell, config.encoder_layers)
+        editor = Editor(source_token_embedder, config.hidden_dim, config.agenda_dim, config.edit_dim, config.lamb_reg, config.norm_eps, config.norm_max, config.kill_edit, decoder_cell, config.encoder_layers,
+                        fused_encoder=config.get('fused_encoder', False), num_sampled=config.get('num_sampled', 0),
+                        vmf_table_size=config.get('vmf_table_size', 0))
 
         editor = try_gpu(editor)
         return editor
@@ -336,11 +361,33 @@ class EditTrainingRun(TorchTrainingRun):
         editor, optimizer = init_state.editor, init_state.optimizer
         return TrainState.load(ckpt_path, editor, optimizer)
 
+    @classmethod
+    def _batch_schedule(cls, saved_schedule, num_batches, seed):
+        """Resume the BatchSchedule of a TrainState, or start a new one.
+
+        Args:
+            saved_schedule (BatchSchedule): TrainState.batch_schedule (None if there is none)
+            num_batches (int)
+            seed (int)
+
+        Returns:
+            BatchSchedule
+        """
+        if saved_schedule is None:
+            return BatchSchedule(num_batches, seed)
+        if (saved_schedule.num_batches, saved_schedule.seed) != (num_batches, seed):
+            # the batches changed (e.g. a different batch size), so the position within the epoch is meaningless
+            print 'Training batches changed since the checkpoint. Starting epoch {} from its first batch.'.format(
+                saved_schedule.epoch)
+            return BatchSchedule(num_batches, seed, epoch=saved_schedule.epoch)
+        print 'Resuming epoch {} after {} of {} batches.'.format(saved_schedule.epoch, saved_schedule.cursor,
+                                                                 num_batches)
+        return BatchSchedule(num_batches, seed, epoch=saved_schedule.epoch, cursor=saved_schedule.cursor)
+
     @classmethod
     def _checkpoint_numbers(cls, checkpoints_dir):
         """Return the train steps at which checkpoints were saved (sorted ascending)."""
-        dirs = [d for d in listdir(checkpoints_dir) if d.endswith('.checkpoint')]
-        return sorted([int(d[:-11]) for d in dirs])
+        return checkpoint_numbers(checkpoints_dir)
 
     @classmethod
     def _get_latest_checkpoint_number(cls, checkpoints_dir):
@@ -364,24 +411,22 @@ class EditTrainingRun(TorchTrainingRun):
         Return:
             bool
         """
-        for param in parameters:
-            try:
-                if not np.isfinite(param.grad.data.sum()):
-                    return False
-            except AttributeError:
-                # allow some parameters not to have gradients and floating in the compute graph.
-                pass
-        return True
+        # allow some parameters not to have gradients and floating in the compute graph.
+        return finite_grads(parameters)
 
     @classmethod
-    def _train(cls, config, train_state, examples, workspace, metadata, tb_logger):
+    def _train(cls, config, train_state, examples, workspace, metadata, tb_logger, evaluator=None):
         """Train a model.
 
         NOTE: modifies TrainState in place.
         - parameters of the Editor and Optimizer are updated
-        - train_steps is updated
+        - train_steps and batch_schedule are updated
         - random number generator states are updated at every checkpoint
 
+        Training resumes exactly where the TrainState left off: at the same position in the same epoch, with the same
+        random number generator states. (The noise applied to each batch only depends on its position, see
+        EditBatchPipeline.)
+
         Args:
             config (Config)
             train_state (TrainState): initial TrainState. Includes the Editor and Optimizer.
@@ -389,93 +434,203 @@ class EditTrainingRun(TorchTrainingRun):
             workspace (Workspace)
             metadata (Metadata)
             tb_logger (tensorboard_logger.Logger)
+            evaluator (BackgroundEvaluator): if not None, periodic evaluations run in its process (see _eval_setup),
+                on snapshots of the Editor, and their results are logged when they finish.
         """
-        with random_state(train_state.random_state):
+        validate = config.optim.get('validate_seq_batches', True)
+        with random_state(train_state.random_state), seq_batch_validation(validate):
             editor = train_state.editor
-            optimizer = train_state.optimizer
             noiser = EditNoiser(config.editor.ident_pr, config.editor.attend_pr)
-            train_batches = similar_size_batches(examples.train, config.optim.batch_size)
-
-            # test batching!
-            editor.test_batch(noiser(train_batches[0]))
-
-            while True:
-                # TODO(kelvin): this shuffle and the position within the shuffle is not properly restored upon reload
-                random.shuffle(train_batches)
-
-                for batch in verboserate(train_batches, desc='Streaming training examples'):
-                    # compute gradients
-                    optimizer.zero_grad()
-                    if config.editor.edit_dropout:
-                        noised_batch = noiser(batch)
-                    else:
-                        noised_batch = batch
-                    loss = editor.loss(noised_batch, draw_samples=config.editor.enable_vae)
-                    loss.backward()
-
-                    # clip gradients
-                    if train_state.train_steps < 50:
-                        # don't clip, just observe the gradient norm
-                        grad_norm = clip_grad_norm(editor.parameters(), float('inf'), norm_type=2)
-                        train_state.track_grad_norms(grad_norm)
-                        metadata['max_grad_norm'] = train_state.max_grad_norm
-                    else:
-                        # clip according to the max allowed grad norm
-                        grad_norm = clip_grad_norm(editor.parameters(), train_state.max_grad_norm)
-                        # this returns the gradient norm BEFORE clipping
-
-                    finite_grads = cls._finite_grads(editor.parameters())
-
-                    # take a step if the grads are finite
-                    if finite_grads:
-                        optimizer.step()
-
-                    # increment step count
-                    train_state.increment_train_steps()
-
-                    # somehow we encountered NaN
-                    if not finite_grads:
-                        # dump parameters
-                        train_state.save(workspace.nan_checkpoints)
-
-                        # dump offending example batch
-                        examples_path = join(workspace.nan_checkpoints, '{}.examples'.format(train_state.train_steps))
-                        with open(examples_path, 'w') as f:
-                            pickle.dump(noised_batch, f)
-
-                        print 'Gradient was NaN/inf on step {}.'.format(train_state.train_steps)
-
-                        # if there were more than 5 NaNs in the last 10 steps, drop into the debugger
-                        nan_steps = cls._checkpoint_numbers(workspace.nan_checkpoints)
-                        recent_nans = [s for s in nan_steps if s > train_state.train_steps - 10]
-                        if len(recent_nans) > 5:
-                            print 'Too many NaNs encountered recently: {}. Entering debugger.'.format(recent_nans)
-                            import pdb
-                            pdb.set_trace()
-
-                    # run periodic evaluation and saving
-                    if train_state.train_steps % config.eval.eval_steps == 0:
-                        cls._evaluate(config, editor, examples, metadata, tb_logger, train_state.train_steps, noiser, big_eval=False)
-                        tb_logger.log_value('grad_norm', grad_norm, train_state.train_steps)
-
-                    if train_state.train_steps % config.eval.big_eval_steps == 0:
-                        cls._evaluate(config, editor, examples, metadata, tb_logger, train_state.train_steps, noiser, big_eval=True)
-
-                    if train_state.train_steps % config.eval.save_steps == 0:
-                        train_state.update_random_state()
-                        train_state.save(workspace.checkpoints)
-
-                    if train_state.train_steps >= config.optim.max_iters:
-                        return
+            # the schedule refers to batches by index, so they must be the same whenever training (re)starts
+            with random_seed(config.optim.seed):
+                train_batches = cls._train_batches(config.optim, examples.train)
+            schedule = cls._batch_schedule(train_state.batch_schedule, len(train_batches), config.optim.seed)
+            train_state.batch_schedule = schedule
+
+            # test batching! (without consuming the training random state)
+            with random_seed(config.optim.seed):
+                editor.test_batch(noiser(list(train_batches[0])))
+
+            # noising and indexing of upcoming batches runs ahead of training, in worker processes if data_workers > 0
+            pipeline = EditBatchPipeline(train_batches, schedule, noiser if config.editor.edit_dropout else None,
+                                         editor.train_decoder.word_vocab, config.optim.seed,
+                                         num_workers=config.optim.get('data_workers', 0),
+                                         prefetch=config.optim.get('prefetch_batches', 8))
+            # checkpoints are written on a background thread if eval.async_checkpoints
+            checkpoint_writer = CheckpointWriter(workspace.checkpoints,
+                                                 keep_last=config.eval.get('keep_checkpoints', 0),
+                                                 keep_every=config.eval.get('keep_checkpoint_every', 0),
+                                                 background=config.eval.get('async_checkpoints', False))
+            try:
+                cls._train_loop(config, train_state, examples, workspace, metadata, tb_logger, noiser, pipeline,
+                                checkpoint_writer, evaluator)
+            finally:
+                pipeline.close()
+                checkpoint_writer.close()  # finish writing pending checkpoints
+
+    @classmethod
+    def _train_loop(cls, config, train_state, examples, workspace, metadata, tb_logger, noiser, pipeline,
+                    checkpoint_writer, evaluator=None):
+        """Take training steps on the batches of pipeline (EditBatchPipeline), until optim.max_iters is reached.
+
+        Checkpoints are saved with checkpoint_writer (CheckpointWriter). See _train for the other arguments.
+        """
+        editor = train_state.editor
+        optimizer = train_state.optimizer
+        schedule = pipeline.schedule
+        while True:
+            for noised_batch, indexed_batch in verboserate(pipeline.epoch_batches(),
+                                                           desc='Streaming training examples',
+                                                           total=schedule.num_batches - schedule.cursor):
+                # compute gradients
+                optimizer.zero_grad()
+                loss = editor.indexed_loss(indexed_batch, draw_samples=config.editor.enable_vae)
+                loss.backward()
+
+                # clip gradients, and check that they are finite (with a single host sync)
+                if train_state.train_steps < 50:
+                    # don't clip, just observe the gradient norm
+                    grad_norm, finite_grads = clip_grad_norm_finite(editor.parameters(), float('inf'))
+                    train_state.track_grad_norms(grad_norm)
+                    metadata['max_grad_norm'] = train_state.max_grad_norm
+                else:
+                    # clip according to the max allowed grad norm
+                    grad_norm, finite_grads = clip_grad_norm_finite(editor.parameters(), train_state.max_grad_norm)
+                    # this returns the gradient norm BEFORE clipping
+
+                # take a step if the grads are finite
+                if finite_grads:
+                    optimizer.step()
+
+                # increment step count
+                train_state.increment_train_steps()
+
+                # somehow we encountered NaN
+                if not finite_grads:
+                    # dump parameters
+                    train_state.save(workspace.nan_checkpoints)
+
+                    # dump offending example batch
+                    examples_path = join(workspace.nan_checkpoints, '{}.examples'.format(train_state.train_steps))
+                    with open(examples_path, 'w') as f:
+                        pickle.dump(noised_batch, f)
+
+                    print 'Gradient was NaN/inf on step {}.'.format(train_state.train_steps)
+
+                    # if there were more than 5 NaNs in the last 10 steps, drop into the debugger
+                    nan_steps = cls._checkpoint_numbers(workspace.nan_checkpoints)
+                    recent_nans = [s for s in nan_steps if s > train_state.train_steps - 10]
+                    if len(recent_nans) > 5:
+                        print 'Too many NaNs encountered recently: {}. Entering debugger.'.format(recent_nans)
+                        import pdb
+                        pdb.set_trace()
+
+                # run periodic evaluation and saving
+                train_steps = train_state.train_steps
+                for big_eval, eval_steps in [(False, config.eval.eval_steps), (True, config.eval.big_eval_steps)]:
+                    if train_steps % eval_steps != 0:
+                        continue
+                    if evaluator is None:
+                        cls._evaluate(config, editor, examples, metadata, tb_logger, train_steps, noiser, big_eval)
+                    elif not evaluator.submit(editor.state_dict(), (train_steps, big_eval)):
+                        print 'Skipped evaluation on step {}: the evaluation process is busy.'.format(train_steps)
+                    if not big_eval:
+                        tb_logger.log_value('grad_norm', grad_norm, train_steps)
+
+                if evaluator is not None:
+                    for (eval_train_steps, _), metrics in evaluator.results():
+                        cls._log_metrics(metrics, metadata, tb_logger, eval_train_steps)
+
+                if train_state.train_steps % config.eval.save_steps == 0:
+                    train_state.update_random_state()
+                    train_state.save_with(checkpoint_writer)
+
+                if train_state.train_steps >= config.optim.max_iters:
+                    return
+
+    @classmethod
+    def _train_batches(cls, config, train):
+        """Group training examples into batches.
+
+        If config.max_tokens > 0, each batch holds up to that many padded tokens (see token_budget_batches),
+        counting source, target and edit set lengths, and config.batch_size only caps its number of examples.
+        Otherwise, each batch holds config.batch_size examples of similar target length.
+
+        Args:
+            config (Config): optim config
+            train (list[EditExample]|CompiledEditSplit)
+
+        Returns:
+            list[Sequence[EditExample]]
+        """
+        max_tokens = config.get('max_tokens', 0)
+        compiled = isinstance(train, CompiledEditSplit)
+        if max_tokens <= 0:
+            if compiled:
+                return train.similar_size_batches(config.batch_size)
+            return similar_size_batches(train, config.batch_size)
+
+        if compiled:
+            sizes = np.stack([train.lengths(field) for field in compiled_data.FIELDS], axis=1)
+        else:
+            sizes = np.array([[len(ex.source_words), len(ex.insert_exact_words), len(ex.delete_exact_words),
+                               len(ex.target_words)] for ex in train])
+        index_batches = token_budget_batches(sizes, max_tokens, max_batch_size=config.batch_size)
+
+        if compiled:
+            return [CompiledEditBatch(train, indices) for indices in index_batches]
+        return [[train[i] for i in indices] for indices in index_batches]
 
     @classmethod
     def _evaluate(cls, config, editor, examples, metadata, tb_logger, train_steps, noiser, big_eval, log=True):
+        metrics = cls._eval_metrics(config, editor, examples, train_steps, noiser, big_eval)
+        if log:
+            cls._log_metrics(metrics, metadata, tb_logger, train_steps)
+
+    @classmethod
+    def _log_metrics(cls, metrics, metadata, tb_logger, train_steps):
+        for name, value in metrics.items():
+            # log to both TensorBoard and metadata file
+            tb_logger.log_value(name, value, train_steps)
+            metadata[name] = value
+
+    @classmethod
+    def _eval_setup(cls, config):
+        """Build the Editor, data and noiser used by an evaluation process (see BackgroundEvaluator).
+
+        Returns:
+            (Editor, (Config, EditDataSplits, EditNoiser))
+        """
+        editor = cls._build_editor(config.editor)
+        examples = EditDataSplits(join(data.workspace.root, config.dataset.path), config.dataset.use_diff,
+                                  config.editor.vocab_size)
+        noiser = EditNoiser(config.editor.ident_pr, config.editor.attend_pr)
+        return editor, (config, examples, noiser)
+
+    @classmethod
+    def _eval_in_background(cls, editor, context, request):
+        """Evaluate a snapshot in the evaluation process (see BackgroundEvaluator).
+
+        Args:
+            editor (Editor)
+            context ((Config, EditDataSplits, EditNoiser)): see _eval_setup
+            request ((int, bool)): train steps of the snapshot, and whether this is a big evaluation
+
+        Returns:
+            OrderedDict[str, float]: see _eval_metrics
+        """
+        config, examples, noiser = context
+        train_steps, big_eval = request
+        return cls._eval_metrics(config, editor, examples, train_steps, noiser, big_eval)
 
-        def log_value(name, value, step):
-            if log:
-                # log to both TensorBoard and metadata file
-                tb_logger.log_value(name, value, step)
-                metadata[name] = value
+    @classmethod
+    def _eval_metrics(cls, config, editor, examples, train_steps, noiser, big_eval):
+        """Evaluate on samples of the train and valid sets, and print the results.
+
+        Returns:
+            OrderedDict[str, float]: metric name -> value
+        """
+        metrics = OrderedDict()
 
         def evaluate_on_examples(name, examples):
             # use more samples for big evaluation
@@ -487,9 +642,8 @@ class EditTrainingRun(TorchTrainingRun):
                                                                edit_dropout=config.editor.edit_dropout,
                                                                draw_samples=config.editor.enable_vae)
 
-            # log
-            log_value('loss_{}{}'.format(big_str, name), loss, train_steps)
-            log_value('bleu_{}{}'.format(big_str, name), avg_bleu, train_steps)
+            metrics['loss_{}{}'.format(big_str, name)] = loss
+            metrics['bleu_{}{}'.format(big_str, name)] = avg_bleu
 
             print '=== {}{} ==='.format(big_str, name)
             print 'loss: {}, bleu: {}'.format(loss, avg_bleu)
@@ -502,32 +656,45 @@ class EditTrainingRun(TorchTrainingRun):
         print '===== STEP {} ====='.format(train_steps)
         evaluate_on_examples('train', examples.train)
         evaluate_on_examples('valid', examples.valid)
+        return metrics
 
     @classmethod
     def _compute_metrics(cls, editor, examples, num_evaluate_examples, noiser,
-                         batch_size=256, edit_dropout=False, draw_samples=False):
+                         batch_size=256, edit_dropout=False, draw_samples=False, beam_size=5):
+        # the sample, its noise and the variational noise are the same for every evaluation,
+        # and the training random state is left untouched (so that evaluating does not change training)
         with random_seed(0):
             sample = sample_if_large(examples, num_evaluate_examples, replace=False)
-        if edit_dropout:
-            noised_sample = noiser(sample)
-        else:
-            noised_sample = sample
-
-        # compute loss and log to TensorBoard
-        # need to break the sample into batches, in case the sample is too large to fit in GPU memory
-        losses, weights = [], []
-        for batch in chunks(noised_sample, batch_size):
-            weights.append(len(batch))
-            loss_var = editor.loss(batch, draw_samples)
-            losses.append(loss_var.data[0])
+            if edit_dropout:
+                noised_sample = noiser(sample)
+            else:
+                noised_sample = sample
+
+            # compute the loss and beam decode in one pass per chunk, sharing the preprocessing
+            # (see Editor.loss_and_edit)
+            # need to break the sample into chunks, in case the sample is too large to fit in GPU memory
+            # (the decoder processes batch_size / beam_size examples at a time, like Editor.edit)
+            # this runs in eval mode, so that the loss is exact even when training with a sampled softmax
+            losses, weights, outputs, edit_traces = [], [], [], []
+            was_training = editor.training
+            editor.eval()
+            try:
+                for batch in chunks(noised_sample, batch_size / beam_size):
+                    loss_var, beams, batch_traces = editor.loss_and_edit(batch, draw_samples, beam_size=beam_size)
+                    weights.append(len(batch))
+                    losses.append(loss_var.data[0])
+                    outputs.extend(beams)
+                    edit_traces.extend(batch_traces)
+            finally:
+                if was_training:
+                    editor.train()
+
         losses, weights = np.array(losses), np.array(weights)
         loss = np.sum(losses * weights) / np.sum(weights)  # weighted average
 
-        # compute BLEU score and log to TensorBoard
-        outputs, edit_traces = editor.edit(noised_sample)
-        bleus = []
-        for ex, output in izip(noised_sample, outputs):
-            # outputs is a list(over batches)[ list(over beams) [ list(over tokens) [ unicode ] ] ] object.
-            bleus.append(bleu(ex.target_words, output[0]))
-        avg_bleu = np.mean(bleus)
+        # compute BLEU of the top beam of each example, on integer ids
+        # the ids are local to this sample, so that words outside the vocab do not match each other as UNK
+        references, predictions = index_tokens([ex.target_words for ex in noised_sample],
+                                               [output[0] for output in outputs])
+        avg_bleu = np.mean(batch_bleu(references, predictions).sentence)
         return loss, avg_bleu, edit_traces
@@ -67,13 +67,27 @@ class LanguageModel(Module):
         encoder_output = self._encoder_output(batch_size)
         return self.train_decoder.loss(encoder_output, decoder_input)
 
-    def generate(self, num_samples, decode_method='argmax'):
+    def generate(self, num_samples, decode_method='argmax', temperature=1., sample_top_k=0, top_p=1., seed=None):
+        """Generate sentences.
+
+        Args:
+            num_samples (int)
+            decode_method (str): 'sample' or 'argmax'
+            temperature (float), sample_top_k (int), top_p (float), seed (int): only used for 'sample'.
+                See SampleDecoder.decode.
+
+        Returns:
+            list[list[unicode]]
+        """
         examples = range(num_samples)
         prefix_hints = [[]] * num_samples  # none
         encoder_output = self._encoder_output(num_samples)
         if decode_method == 'sample':
             output_beams, decoder_traces = self.sample_decoder.decode(examples, encoder_output,
-                                                                      beam_size=1, prefix_hints=prefix_hints)
+                                                                      beam_size=1, prefix_hints=prefix_hints,
+                                                                      temperature=temperature,
+                                                                      sample_top_k=sample_top_k, top_p=top_p,
+                                                                      seed=seed)
         elif decode_method == 'argmax':
             value_estimators = []
             beam_size = 1
@@ -11,7 +11,7 @@ from gtd.chrono import verboserate
 from gtd.io import num_lines
 from gtd.ml.torch.token_embedder import TokenEmbedder
 from gtd.ml.torch.training_run import TorchTrainingRun
-from gtd.ml.torch.utils import similar_size_batches
+from gtd.ml.torch.utils import similar_size_batches, token_budget_batches, BatchSchedule
 from gtd.ml.torch.utils import try_gpu
 from gtd.ml.training_run import TrainingRuns
 from gtd.ml.vocab import SimpleEmbeddings
@@ -72,13 +72,21 @@ class LMTrainingRun(TorchTrainingRun):
     def _train(cls, config, train_state, examples):
         model = train_state.model
         optimizer = train_state.optimizer
-        train_batches = similar_size_batches(
-            examples.train, config.optim.batch_size, size=lambda ex: len(ex))
+        max_tokens = config.optim.get('max_tokens', 0)
+        if max_tokens > 0:
+            sizes = np.array([len(ex) for ex in examples.train])
+            index_batches = token_budget_batches(sizes, max_tokens, max_batch_size=config.optim.batch_size)
+            train_batches = [[examples.train[j] for j in indices] for indices in index_batches]
+        else:
+            train_batches = similar_size_batches(
+                examples.train, config.optim.batch_size, size=lambda ex: len(ex))
+        schedule = BatchSchedule(len(train_batches), config.optim.seed)
 
         while True:
-            random.shuffle(train_batches)
+            epoch_batches = (train_batches[j] for j in schedule.epoch_batches())
             i = 0  # cannot enumerate(verboserate(...))
-            for batch in verboserate(train_batches, desc='Streaming training examples'):
+            for batch in verboserate(epoch_batches, desc='Streaming training examples',
+                                     total=schedule.num_batches - schedule.cursor):
                 loss = model.loss(batch, cls._train_state.train_steps)
                 cls._take_grad_step(train_state, loss)
                 if (i % 100) == 0:
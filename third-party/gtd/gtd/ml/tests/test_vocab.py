@@ -15,6 +15,22 @@ def embeds(vocab):
     return SimpleEmbeddings(array, vocab)
 
 
+class TestSimpleEmbeddings(object):
+    def test_from_file_cache(self, tmpdir):
+        path = str(tmpdir.join('vectors.txt'))
+        with open(path, 'w') as f:
+            f.write('a 1.0 2.0\nb 3.0 4.0\nc 5.0 6.0\n')
+
+        parsed = SimpleEmbeddings.from_file(path, 2, vocab_size=2)
+        cached = SimpleEmbeddings.from_file(path, 2, vocab_size=2)
+        assert isinstance(cached.array, np.memmap)
+        assert np.array_equal(cached.array, parsed.array)
+        assert cached.vocab == parsed.vocab
+
+        # the cache is keyed by vocab_size
+        assert len(SimpleEmbeddings.from_file(path, 2, vocab_size=3)) == 3
+
+
 class TestSimpleVocab(object):
     def test_save_load(self, vocab, tmpdir):
         path = str(tmpdir.join('vocab.txt'))
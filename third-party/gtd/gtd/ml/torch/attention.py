@@ -1,12 +1,14 @@
 from collections import namedtuple
+from itertools import izip
 
 import math
 import torch
+from torch.autograd import Variable
 from gtd.ml.torch.utils import GPUVariable
 from torch.nn import Parameter
 from torch.nn import Softmax, Tanh, Module
 
-from gtd.ml.torch.utils import conditional, NamedTupleLike
+from gtd.ml.torch.utils import NamedTupleLike
 
 
 class AttentionOutput(namedtuple('AttentionOutput', ['weights', 'context']), NamedTupleLike):
@@ -92,26 +94,179 @@ class Attention(Module):
         logits = torch.transpose(attn_embeds.squeeze(2), 0, 1)
 
         mask = memory_cells.mask
+        suppress, has_cells = self.mask_bias(mask)
+
+        logits = logits + suppress
+        # -inf + anything = -inf
+
+        # compute normalized weights
+        weights = self.softmax(logits)  # (batch_size, num_cells)
+
+        # if a given row has no memory cells, weights should be all zeros
+        weights = weights * has_cells.unsqueeze(1).expand_as(weights)
+
+        context = torch.bmm(weights.unsqueeze(1), memory_cells.values)  # (batch_size, 1, memory_dim)
+        context = context.squeeze(1)  # (batch_size, memory_dim)
+        return AttentionOutput(weights=weights, context=context)
+
+    @classmethod
+    def mask_bias(cls, mask):
+        """Compute the additive mask applied to attention logits.
+
+        Args:
+            mask (Variable): of shape (batch_size, num_cells)
+
+        Returns:
+            suppress (Variable): of shape (batch_size, num_cells). 0 for memory cells and -inf for non-cells, except
+                for rows with no memory cells at all, which are left alone (all 0).
+            has_cells (Variable): of shape (batch_size,). 1 if the row has any memory cells, 0 otherwise.
+        """
+        batch_size, num_cells = mask.size()
 
         # no_cells is a FloatTensor with shape (batch_size, num_cells)
         # no_cells[i, j] = 1 if example i has NO memory cells, 0 otherwise
-        no_cells = (1 - mask).prod(1).expand_as(mask)
+        no_cells = (1 - mask).prod(1).view(batch_size, 1).expand_as(mask)
         # TODO(kelvin): check for numerical stability. Product of 1's does not necessarily equal 1 exactly, which we need
 
         suppress = GPUVariable(torch.zeros(*mask.size()))
         suppress[mask == 0] = float('-inf')  # send the logit of non-cells to -infinity
         suppress[no_cells == 1] = 0.0  # but if an entire row has no cells, just leave the cells alone
 
-        logits = logits + suppress
-        # -inf + anything = -inf
+        has_cells = 1 - no_cells.select(1, 0)
+        return suppress, has_cells
 
-        # compute normalized weights
-        weights = self.softmax(logits)  # (batch_size, num_cells)
+
+class AttentionMemories(namedtuple('AttentionMemories', ['transformed', 'mask_bias', 'has_cells']), NamedTupleLike):
+    @classmethod
+    def concatenate_batches(cls, batches):
+        """Concatenate AttentionMemories along the batch dimension (see BatchConcatenator).
+
+        Padding cells get zero projections and a mask bias of -inf, like the padding added by `precompute`.
+
+        Args:
+            batches (list[AttentionMemories])
+
+        Returns:
+            AttentionMemories
+        """
+        max_cells = max(int(memories.mask_bias.size()[1]) for memories in batches)
+        transformed = torch.cat([cls._pad_cells(memories.transformed, max_cells, 0.) for memories in batches], 0)
+        mask_bias = torch.cat([cls._pad_cells(memories.mask_bias, max_cells, float('-inf')) for memories in batches],
+                              0)
+        has_cells = torch.cat([memories.has_cells for memories in batches], 0)
+        return AttentionMemories(transformed, mask_bias, has_cells)
+
+    @classmethod
+    def _pad_cells(cls, v, max_cells, value):
+        size = list(v.size())
+        if size[1] == max_cells:
+            return v
+        size[1] = max_cells - size[1]
+        padding = Variable(v.data.new(*size).fill_(value), volatile=v.volatile)
+        return torch.cat([v, padding], 1)
+"""
+The memories of a MultiAttention, with everything that does not depend on the query precomputed.
+
+Cells are along dimension 1, so that batches can be concatenated along dimension 0 after padding dimension 1.
+
+Attributes:
+    transformed (Variable): of shape (batch_size, max_cells, num_memories, attn_dim). Hi * Wh for each memory,
+        padded with zeros to max_cells.
+    mask_bias (Variable): of shape (batch_size, max_cells, num_memories). See `Attention.mask_bias`.
+        Padding cells are -inf.
+    has_cells (Variable): of shape (batch_size, num_memories)
+"""
+
+
+class MultiAttention(object):
+    """Computes several Attention modules with one batched computation.
+
+    Each Attention has its own parameters and memory (memories may differ in memory_dim and num_cells), but they
+    share the same query and attn_dim. Since the memories do not change while decoding, the memory projections
+    Hi * Wh and the additive masks are precomputed once with `precompute`.
+    """
+    def __init__(self, attentions):
+        """Construct MultiAttention.
+
+        Args:
+            attentions (list[Attention])
+        """
+        attn_dims = set(attention.attn_dim for attention in attentions)
+        query_dims = set(attention.query_dim for attention in attentions)
+        if len(attn_dims) != 1 or len(query_dims) != 1:
+            raise ValueError('All attentions must have the same attn_dim and query_dim.')
+        self.attentions = attentions
+        self.attn_dim = attn_dims.pop()
+
+    def precompute(self, memories):
+        """Precompute the memory projections and masks.
+
+        Args:
+            memories (list[SequenceBatch]): one for each attention, of shape (batch_size, num_cells, memory_dim)
+
+        Returns:
+            AttentionMemories
+        """
+        max_cells = max(int(memory.mask.size()[1]) for memory in memories)
+
+        transformed_list, mask_bias_list, has_cells_list = [], [], []
+        for attention, memory in izip(self.attentions, memories):
+            batch_size, num_cells = memory.mask.size()
+            values = memory.values.contiguous().view(batch_size * num_cells, attention.memory_dim)
+            transformed = torch.mm(values, attention.memory_transform).view(batch_size, num_cells, self.attn_dim)
+            mask_bias, has_cells = attention.mask_bias(memory.mask)
+
+            if num_cells < max_cells:
+                pad = max_cells - num_cells
+                transformed = torch.cat([transformed, GPUVariable(torch.zeros(batch_size, pad, self.attn_dim))], 1)
+                mask_bias = torch.cat([mask_bias, GPUVariable(torch.zeros(batch_size, pad).fill_(float('-inf')))], 1)
+
+            transformed_list.append(transformed)
+            mask_bias_list.append(mask_bias)
+            has_cells_list.append(has_cells)
+
+        return AttentionMemories(torch.stack(transformed_list, 2), torch.stack(mask_bias_list, 2),
+                                 torch.stack(has_cells_list, 1))
+
+    def __call__(self, attention_memories, memories, query):
+        """Attend to each memory.
+
+        Computes the same outputs as calling each Attention on its memory.
+
+        Args:
+            attention_memories (AttentionMemories): precomputed from memories
+            memories (list[SequenceBatch]): the memory of each attention
+            query (Variable): of shape (batch_size, query_dim)
+
+        Returns:
+            list[AttentionOutput]: one for each attention
+        """
+        transformed = attention_memories.transformed
+        batch_size, max_cells, num_memories, attn_dim = transformed.size()
+
+        # transform the query for all attentions at once
+        query_transform = torch.cat([attention.query_transform for attention in self.attentions], 1)
+        transformed_query = torch.mm(query, query_transform).view(batch_size, 1, num_memories, attn_dim)
+        attn_embeds = torch.tanh(transformed + transformed_query.expand_as(transformed))
+
+        v_transform = torch.cat([attention.v_transform for attention in self.attentions], 1)  # (attn_dim, num_memories)
+        v_transform = v_transform.t().contiguous().view(1, 1, num_memories, attn_dim).expand_as(attn_embeds)
+        logits = (attn_embeds * v_transform).sum(3).view(batch_size, max_cells, num_memories)
+        logits = logits + attention_memories.mask_bias
+
+        # softmax over the cells of each memory
+        logits = logits.transpose(1, 2).contiguous().view(batch_size * num_memories, max_cells)
+        weights = torch.exp(logits - logits.max(1)[0].view(-1, 1).expand_as(logits))
+        weights = weights / weights.sum(1).view(-1, 1).expand_as(weights)
+        weights = weights.view(batch_size, num_memories, max_cells)
 
         # if a given row has no memory cells, weights should be all zeros
-        all_zeros = GPUVariable(torch.zeros(*mask.size()))
-        weights = conditional(no_cells, all_zeros, weights)
+        weights = weights * attention_memories.has_cells.unsqueeze(2).expand_as(weights)
 
-        context = torch.bmm(weights.unsqueeze(1), memory_cells.values)  # (batch_size, 1, memory_dim)
-        context = context.squeeze(1)  # (batch_size, memory_dim)
-        return AttentionOutput(weights=weights, context=context)
+        outputs = []
+        for i, memory in enumerate(memories):
+            num_cells = int(memory.mask.size()[1])
+            memory_weights = weights.select(1, i).narrow(1, 0, num_cells)  # (batch_size, num_cells)
+            context = torch.bmm(memory_weights.unsqueeze(1), memory.values).squeeze(1)  # (batch_size, memory_dim)
+            outputs.append(AttentionOutput(weights=memory_weights, context=context))
+        return outputs
@@ -0,0 +1,94 @@
+"""Evaluate snapshots of a model's weights in a separate process, while training continues.
+
+The evaluation process is forked when the BackgroundEvaluator is created. A CUDA context does not survive a fork,
+so the BackgroundEvaluator must be created before the training process initializes CUDA (i.e. before any model is
+moved to the GPU). The evaluation process then initializes its own.
+
+Snapshots are copied to CPU, and travel through a torch.multiprocessing queue, which moves them into shared memory.
+"""
+import traceback
+from Queue import Empty, Full
+
+import torch.multiprocessing as multiprocessing
+
+from gtd.ml.torch.checkpoint_writer import cpu_snapshot
+
+
+def _evaluation_loop(setup, evaluate, requests, results):
+    model, context = setup()
+    while True:
+        item = requests.get()
+        if item is None:
+            return
+
+        state_dict, request = item
+        try:
+            model.load_state_dict(state_dict)
+            results.put((request, evaluate(model, context, request), None))
+        except Exception:
+            results.put((request, None, traceback.format_exc()))
+
+
+class BackgroundEvaluator(object):
+    """Runs evaluations on snapshots of a model's weights, in a separate process.
+
+    At most one snapshot waits for evaluation at a time. Snapshots submitted while one is waiting are dropped,
+    so training never waits for evaluation.
+    """
+
+    def __init__(self, setup, evaluate):
+        """Start the evaluation process.
+
+        Args:
+            setup (Callable[[], (Module, object)]): called once, in the evaluation process. Returns the model that
+                snapshots are loaded into, and a context passed to evaluate (e.g. the evaluation data).
+            evaluate (Callable[[Module, object, object], object]): evaluate(model, context, request) is called in the
+                evaluation process, once a snapshot is loaded into model. Returns the result of the request.
+        """
+        self._requests = multiprocessing.Queue(maxsize=1)
+        self._results = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_evaluation_loop,
+                                                args=(setup, evaluate, self._requests, self._results))
+        self._process.daemon = True
+        self._process.start()
+
+    def submit(self, state_dict, request):
+        """Snapshot a state dict, and queue it for evaluation.
+
+        Args:
+            state_dict (dict): e.g. Module.state_dict()
+            request (object): picklable description of the evaluation (passed to evaluate, and returned by results)
+
+        Returns:
+            bool: False if the snapshot was dropped, because an earlier one is still waiting.
+        """
+        if self._requests.full():
+            return False
+        try:
+            self._requests.put_nowait((cpu_snapshot(state_dict), request))
+        except Full:
+            return False
+        return True
+
+    def results(self):
+        """Return the results of the evaluations that finished since the last call, without blocking.
+
+        Returns:
+            list[(object, object)]: (request, result) pairs, in the order they were submitted
+        """
+        finished = []
+        while True:
+            try:
+                request, result, error = self._results.get_nowait()
+            except Empty:
+                return finished
+            if error is not None:
+                raise RuntimeError('Evaluation process failed:\n{}'.format(error))
+            finished.append((request, result))
+
+    def close(self):
+        """Stop the evaluation process, abandoning pending evaluations."""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
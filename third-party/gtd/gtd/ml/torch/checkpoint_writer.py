@@ -0,0 +1,158 @@
+import cPickle as pickle
+import os
+import shutil
+import sys
+from Queue import Queue
+from os import listdir
+from os.path import join, exists
+from threading import Thread
+
+import torch
+
+from gtd.ml.torch.utils import try_gpu
+
+
+def cpu_snapshot(obj):
+    """Copy all tensors in a (nested) state dict to CPU.
+
+    The copies do not share memory with the originals, so training can keep updating the originals.
+
+    Args:
+        obj: a tensor, or a dict / list / tuple containing tensors (e.g. Module.state_dict(), Optimizer.state_dict())
+
+    Returns:
+        a copy of obj, where every tensor is a new CPU tensor
+    """
+    if torch.is_tensor(obj):
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())  # preserves OrderedDicts
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def load_tensors(path):
+    """Load a file written by CheckpointWriter with torch.save, putting its tensors on GPU if available."""
+    return torch.load(path, map_location=lambda storage, location: try_gpu(storage))
+
+
+def checkpoint_numbers(checkpoints_dir):
+    """Return the train steps at which checkpoints were saved (sorted ascending)."""
+    dirs = [d for d in listdir(checkpoints_dir) if d.endswith('.checkpoint')]
+    return sorted([int(d[:-11]) for d in dirs])  # '.checkpoint' is 11 characters
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints to `<checkpoints_dir>/<train_steps>.checkpoint`, optionally on a background thread.
+
+    Each checkpoint is written to a temporary directory, which is renamed into place once complete. So a
+    checkpoint directory is never seen half-written, even if training dies during a write.
+
+    Retention policy: if keep_last > 0, after each write only the latest keep_last checkpoints are kept, plus those
+    whose train steps are a multiple of keep_every (if keep_every > 0).
+    """
+
+    def __init__(self, checkpoints_dir, keep_last=0, keep_every=0, background=True, max_pending=1):
+        """
+
+        Args:
+            checkpoints_dir (str)
+            keep_last (int): see retention policy above. 0 keeps all checkpoints.
+            keep_every (int): see retention policy above.
+            background (bool): write checkpoints on a background thread
+            max_pending (int): max snapshots waiting to be written. Once reached, save blocks until one is written.
+        """
+        self.directory = checkpoints_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self._error = None
+
+        if background:
+            self._queue = Queue(maxsize=max_pending)
+            self._thread = Thread(target=self._write_loop)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def save(self, train_steps, tensors, pickles):
+        """Snapshot a checkpoint, and write it (now, or on the background thread).
+
+        The snapshot is taken before this returns, so the caller can keep modifying the saved objects.
+
+        Args:
+            train_steps (int)
+            tensors (dict[str, object]): file name -> object saved with torch.save (e.g. a state dict)
+            pickles (dict[str, object]): file name -> object saved with pickle
+        """
+        self._raise_error()
+        snapshot = (train_steps,
+                    {name: cpu_snapshot(obj) for name, obj in tensors.items()},
+                    {name: pickle.dumps(obj) for name, obj in pickles.items()})
+        if self._thread is None:
+            self._write(*snapshot)
+        else:
+            self._queue.put(snapshot)
+
+    def wait(self):
+        """Block until all pending checkpoints are written."""
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write all pending checkpoints, and stop the background thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def _write_loop(self):
+        while True:
+            snapshot = self._queue.get()
+            try:
+                if snapshot is None:
+                    return
+                if self._error is None:
+                    self._write(*snapshot)
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def _write(self, train_steps, tensors, pickled):
+        path = join(self.directory, '{}.checkpoint'.format(train_steps))
+        tmp_path = path + '.tmp'
+        if exists(tmp_path):
+            shutil.rmtree(tmp_path)  # left over from an interrupted write
+        os.makedirs(tmp_path)
+
+        for name, obj in tensors.items():
+            torch.save(obj, join(tmp_path, name))
+        for name, data in pickled.items():
+            with open(join(tmp_path, name), 'wb') as f:
+                f.write(data)
+
+        if exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        """Delete the checkpoints that the retention policy does not keep."""
+        if self.keep_last <= 0:
+            return
+        nums = checkpoint_numbers(self.directory)
+        keep = set(nums[-self.keep_last:])
+        if self.keep_every > 0:
+            keep.update(n for n in nums if n % self.keep_every == 0)
+        for n in nums:
+            if n not in keep:
+                shutil.rmtree(join(self.directory, '{}.checkpoint'.format(n)))
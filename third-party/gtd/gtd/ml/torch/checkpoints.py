@@ -1,11 +1,8 @@
 import cPickle as pickle
-from os import listdir
 import os
-from os.path import join
+from os.path import join, dirname
 
-import torch
-
-import gtd
+from gtd.ml.torch.checkpoint_writer import CheckpointWriter, checkpoint_numbers, load_tensors
 from gtd.ml.torch.utils import RandomState
 
 
@@ -34,19 +31,23 @@ class TrainState(object):
         self.max_grad_norm = max(self.max_grad_norm, 2 * grad_norm)
 
     def save(self, path):
-        gtd.io.makedirs(path)
+        """Write a checkpoint to path, which must be named `<train_steps>.checkpoint`."""
+        assert os.path.basename(path) == '{}.checkpoint'.format(self.train_steps)
+        self.save_with(CheckpointWriter(dirname(path), background=False))
+
+    def save_with(self, writer):
+        """Write a checkpoint with a CheckpointWriter.
 
+        Args:
+            writer (CheckpointWriter)
+        """
         # Store the latest random state
         self.random_state = RandomState()
 
-        # save model
-        torch.save(self.model.state_dict(), join(path, 'model'))
-        torch.save(self.optimizer.state_dict(), join(path, 'optimizer'))
-
         # pickle remaining attributes
         d = {attr: getattr(self, attr) for attr in ['train_steps', 'random_state', 'max_grad_norm']}
-        with open(join(path, 'metadata.p'), 'w') as f:
-            pickle.dump(d, f)
+        writer.save(self.train_steps, {'model': self.model.state_dict(), 'optimizer': self.optimizer.state_dict()},
+                    {'metadata.p': d})
 
     @classmethod
     def load(cls, path, model, optimizer):
@@ -54,8 +55,8 @@ class TrainState(object):
             d = pickle.load(f)
 
         # load model
-        optimizer.load_state_dict(torch.load(join(path, 'optimizer')))
-        model.load_state_dict(torch.load(join(path, 'model')))
+        optimizer.load_state_dict(load_tensors(join(path, 'optimizer')))
+        model.load_state_dict(load_tensors(join(path, 'model')))
         train_state = TrainState(model=model, optimizer=optimizer, **d)
         return train_state
 
@@ -69,14 +70,23 @@ class TrainState(object):
 
 
 class Checkpoints(object):
-    def __init__(self, checkpoints_dir):
+    def __init__(self, checkpoints_dir, keep_last=0, keep_every=0, background=False):
+        """
+
+        Args:
+            checkpoints_dir (str)
+            keep_last (int): see CheckpointWriter
+            keep_every (int): see CheckpointWriter
+            background (bool): write checkpoints on a background thread (see CheckpointWriter)
+        """
         self._path = checkpoints_dir
+        self._writer = CheckpointWriter(checkpoints_dir, keep_last=keep_last, keep_every=keep_every,
+                                        background=background)
 
     @property
     def checkpoint_numbers(self):
         """Return the train steps at which checkpoints were saved (sorted ascending)."""
-        dirs = [d for d in listdir(self._path) if d.endswith('.checkpoint')]
-        return sorted([int(d[:-11]) for d in dirs])  # '.checkpoint' is 11 characters
+        return checkpoint_numbers(self._path)
 
     @property
     def latest_checkpoint_number(self):
@@ -106,9 +116,15 @@ class Checkpoints(object):
         return TrainState.load(ckpt_path, model, optimizer)
 
     def save(self, train_state):
-        """Save TrainState."""
-        ckpt_path = join(self._path, '{}.checkpoint'.format(train_state.train_steps))
-        train_state.save(ckpt_path)
+        """Save TrainState.
+
+        If checkpoints are written in the background, this returns once the TrainState has been snapshotted.
+        """
+        train_state.save_with(self._writer)
+
+    def wait(self):
+        """Block until all saved checkpoints are written."""
+        self._writer.wait()
 
     def load_latest(self, model, optimizer):
         """Load the latest checkpoint.
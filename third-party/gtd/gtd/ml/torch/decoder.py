@@ -1,16 +1,18 @@
 from abc import ABCMeta, abstractmethod
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, deque
+from contextlib import contextmanager
 from itertools import izip
 
 import numpy as np
+from concurrent.futures import Future
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn import Module
 
 from gtd.chrono import verboserate
 from gtd.ml.torch.seq_batch import SequenceBatch, SequenceBatchElement
-from gtd.ml.torch.utils import GPUVariable, try_gpu, NamedTupleLike
-from gtd.ml.utils import temperature_smooth
+from gtd.ml.torch.utils import GPUVariable, try_gpu, NamedTupleLike, conditional, random_seed
 from gtd.ml.vocab import WordVocab
 from gtd.utils import UnicodeMixin, chunks
 
@@ -36,6 +38,33 @@ class TrainDecoderInput(object):
         self.input_words = SequenceBatch.from_sequences(input_words, word_vocab)
         self.target_words = SequenceBatch.from_sequences(target_words_shifted, word_vocab)
 
+    @classmethod
+    def index_tensors(cls, target_words, word_vocab, indexed=False):
+        """The input and target words of a TrainDecoderInput, as CPU tensors (see SequenceBatch.index_tensors).
+
+        Args:
+            target_words (list[list[unicode]])
+            word_vocab (WordVocab)
+            indexed (bool): if True, target_words already holds word indices of word_vocab, rather than words
+
+        Returns:
+            ((LongTensor, FloatTensor), (LongTensor, FloatTensor)): input words and target words
+        """
+        start, stop = word_vocab.word2index(word_vocab.START), word_vocab.word2index(word_vocab.STOP)
+        to_indices = list if indexed else word_vocab.words2indices
+        indices = [to_indices(tokens) for tokens in target_words]
+        input_words = SequenceBatch.index_tensors([[start] + seq for seq in indices])
+        target_words_shifted = SequenceBatch.index_tensors([seq + [stop] for seq in indices])
+        return input_words, target_words_shifted
+
+    @classmethod
+    def from_index_tensors(cls, input_words, target_words):
+        """Create a TrainDecoderInput from the output of index_tensors."""
+        self = cls.__new__(cls)
+        self.input_words = SequenceBatch.from_index_tensors(input_words)
+        self.target_words = SequenceBatch.from_index_tensors(target_words)
+        return self
+
 class DropoutTrainDecoderInput(object):
 
     __slots__ = ['input_words', 'target_words']
@@ -78,70 +107,130 @@ class RNNContextCombiner(object):
 
 
 class TrainDecoder(Module):
-    def __init__(self, decoder_cell, token_embedder, rnn_context_combiner):
+    def __init__(self, decoder_cell, token_embedder, rnn_context_combiner, num_sampled=0):
         """Construct TrainDecoder.
 
         Args:
             decoder_cell (DecoderCell)
             token_embedder (TokenEmbedder)
             rnn_context_combiner (RNNContextCombiner)
+            num_sampled (int): if > 0, the loss is approximated with a sampled softmax in training mode (see
+                `_sampled_losses`), which only projects onto the target words and num_sampled sampled words.
+                In eval mode (after calling `.eval()`), the loss is always computed exactly.
         """
         super(TrainDecoder, self).__init__()
         self.decoder_cell = decoder_cell
         self.token_embedder = token_embedder
         self.word_vocab = token_embedder.vocab
         self.rnn_context_combiner = rnn_context_combiner
+        self.num_sampled = num_sampled
 
-    def forward(self, encoder_output, train_decoder_input):
+    def forward(self, encoder_output, train_decoder_input, keep_states=True):
         """
 
+        The RNN is first run over the whole sequence, and then the vocab projection and the loss are computed for all
+        time steps at once.
+
         Args:
             encoder_output (EncoderOutput)
             train_decoder_input (TrainDecoderInput)
+            keep_states (bool): if False, rnn_states is None
 
         Returns:
             rnn_states (list[RNNState])
-            total_loss (Variable): a scalar loss
+            per_instance_losses (Variable): of shape (batch_size,)
         """
-        batch_size, _ = train_decoder_input.input_words.mask.size()
+        mask = train_decoder_input.input_words.mask
+        batch_size, seq_length = mask.size()
         rnn_state = self.decoder_cell.initialize(batch_size)
+        encoder_output = self.decoder_cell.prepare(encoder_output)
 
         input_word_embeds = self.token_embedder.embed_seq_batch(train_decoder_input.input_words)
 
-        input_embed_list = input_word_embeds.split()
-        target_word_list = train_decoder_input.target_words.split()
-
-        loss_list = []
-        rnn_states = []
-        for t, (x, target_word) in enumerate(izip(input_embed_list, target_word_list)):
-            # x is a (batch_size, word_dim) SequenceBatchElement, target_word is a (batch_size,) Variable
+        queries = []
+        rnn_states = [] if keep_states else None
+        for x in input_word_embeds.split():
+            # x is a (batch_size, word_dim) SequenceBatchElement
 
             # update rnn state
             rnn_input = self.rnn_context_combiner(encoder_output, x.values)
-            decoder_cell_output = self.decoder_cell(rnn_state, rnn_input, x.mask)
-            rnn_state = decoder_cell_output.rnn_state
-            rnn_states.append(rnn_state)
-
-            # compute loss
-            loss = decoder_cell_output.loss(target_word.values)  # (batch_size,)
-            loss_list.append(SequenceBatchElement(loss, x.mask))
-
-        losses = SequenceBatch.cat(loss_list)  # (batch_size, target_seq_length)
+            rnn_state, query = self.decoder_cell.step(rnn_state, rnn_input, x.mask)
+            queries.append(query)
+            if keep_states:
+                rnn_states.append(rnn_state)
+
+        # project all time steps onto the vocab at once
+        queries = torch.stack(queries, 1).view(batch_size * seq_length, -1)  # (batch_size * seq_length, query_dim)
+        target_words = train_decoder_input.target_words.values.view(batch_size * seq_length)
+        if self.training and self.num_sampled > 0:
+            losses = self._sampled_losses(queries, target_words)
+        else:
+            log_probs = F.log_softmax(self.decoder_cell.vocab_logits(queries))  # (batch_size * seq_length, vocab_size)
+            # negative log-likelihood of each target word
+            losses = -torch.gather(log_probs, 1, target_words.unsqueeze(1))
+        losses = losses.view(batch_size, seq_length)
 
         # sum losses across time, accounting for mask
-        per_instance_losses = SequenceBatch.reduce_sum(losses)  # (batch_size,)
+        per_instance_losses = SequenceBatch.reduce_sum(SequenceBatch(losses, mask))  # (batch_size,)
         return rnn_states, per_instance_losses
 
+    def _sampled_losses(self, queries, target_words):
+        """Approximate the negative log-likelihood of each target word with a sampled softmax (Jean et al. 2015).
+
+        The softmax is taken over the candidate set of all target words in the batch plus num_sampled words drawn
+        from a log-uniform (Zipfian) distribution over word indices, which assumes that the vocab is sorted from
+        most to least frequent. The logit of each candidate is corrected by the log probability that it is sampled.
+
+        Args:
+            queries (Variable): of shape (num_queries, query_dim)
+            target_words (Variable): LongTensor of shape (num_queries,)
+
+        Returns:
+            Variable: of shape (num_queries, 1)
+        """
+        targets = target_words.data.cpu().numpy()
+        candidates, log_q = self._sample_candidates(targets, len(self.word_vocab), self.num_sampled)
+        target_positions = np.searchsorted(candidates, targets)  # position of each target among the candidates
+
+        logits = self.decoder_cell.vocab_logits(queries, GPUVariable(torch.from_numpy(candidates)))
+        logits = logits - GPUVariable(torch.from_numpy(log_q)).unsqueeze(0).expand_as(logits)
+        log_probs = F.log_softmax(logits)  # (num_queries, num_candidates)
+        return -torch.gather(log_probs, 1, GPUVariable(torch.from_numpy(target_positions)).unsqueeze(1))
+
+    @classmethod
+    def _sample_candidates(cls, targets, vocab_size, num_sampled):
+        """Sample the candidate words of a sampled softmax.
+
+        Args:
+            targets (np.ndarray): int array of target word indices
+            vocab_size (int)
+            num_sampled (int): number of words to sample (with replacement) from a log-uniform distribution
+
+        Returns:
+            candidates (np.ndarray): sorted unique int64 array of word indices, containing all targets
+            log_q (np.ndarray): float32 array, same shape as candidates. The log probability that each candidate
+                is among the sampled words.
+        """
+        log_range = np.log(vocab_size + 1.)
+        sampled = np.floor(np.exp(np.random.uniform(size=num_sampled) * log_range)).astype(np.int64) - 1
+        sampled = np.clip(sampled, 0, vocab_size - 1)
+        candidates = np.union1d(targets.astype(np.int64), sampled)
+
+        # P(word k) = log((k + 2) / (k + 1)) / log(vocab_size + 1)
+        probs = np.log((candidates + 2.) / (candidates + 1.)) / log_range
+        log_q = np.log(-np.expm1(num_sampled * np.log1p(-probs)))  # log(1 - (1 - p) ** num_sampled)
+        return candidates, log_q.astype(np.float32)
+
     def rnn_states(self, encoder_output, train_decoder_input):
         rnn_states, _ = self(encoder_output, train_decoder_input)
         return rnn_states
 
     def per_instance_losses(self, encoder_output, train_decoder_input):
-        _, per_instance_losses = self(encoder_output, train_decoder_input)
+        _, per_instance_losses = self(encoder_output, train_decoder_input, keep_states=False)
         return per_instance_losses
 
     def loss(self, encoder_output, train_decoder_input):
-        _, per_instance_losses = self(encoder_output, train_decoder_input)
+        _, per_instance_losses = self(encoder_output, train_decoder_input, keep_states=False)
         total_loss = torch.mean(per_instance_losses)
         return total_loss
 
@@ -165,17 +254,19 @@ class DecoderState(UnicodeMixin):
         example (Example): the example that we are decoding for.
         prev (DecoderState): the previous DecoderState
         token (unicode): the token predicted at this time step.
-        sequence_prob (float): probability of the overall sequence
+        sequence_log_prob (float): log probability of the overall sequence
+        length (int): number of tokens predicted on the path to this DecoderState (<start> is not counted)
         trace (PredictionTrace): a trace of the prediction made for this time step.
     """
-    __slots__ = ['example', 'prev', 'token', 'sequence_prob', 'trace']
+    __slots__ = ['example', 'prev', 'token', 'sequence_log_prob', 'length', 'trace']
 
-    def __init__(self, example, prev, token, sequence_prob, trace):
+    def __init__(self, example, prev, token, sequence_log_prob, trace):
         self.example = example
         self.prev = prev
         self.token = token
         self.trace = trace
-        self.sequence_prob = sequence_prob
+        self.sequence_log_prob = sequence_log_prob
+        self.length = 0 if prev is None else prev.length + 1
 
     @classmethod
     def initial(cls, example):
@@ -187,21 +278,26 @@ class DecoderState(UnicodeMixin):
         Returns:
             DecoderState
         """
-        return DecoderState(example, None, START, 1.0, None)
+        return DecoderState(example, None, START, 0.0, None)
 
     @classmethod
     def initial_doomed(cls, example):
-        """Create an initial decoder state that is 'doomed', in that it has sequence_prob = 0."""
-        return DecoderState(example, None, START, 0.0, None)
+        """Create an initial decoder state that is 'doomed', in that it has sequence_log_prob = -inf."""
+        return DecoderState(example, None, START, float('-inf'), None)
+
+    @property
+    def sequence_prob(self):
+        """Probability of the overall sequence (may underflow to 0 for long sequences)."""
+        return np.exp(self.sequence_log_prob)
 
     @property
     def terminated(self):
         return self.token == STOP
 
-    def extend(self, token, sequence_prob, trace):
+    def extend(self, token, sequence_log_prob, trace):
         if self.terminated:
             raise RuntimeError('Cannot extend terminated node.')
-        return DecoderState(self.example, self, token, sequence_prob, trace)
+        return DecoderState(self.example, self, token, sequence_log_prob, trace)
 
     @property
     def sequence(self):
@@ -242,7 +338,7 @@ class DecoderState(UnicodeMixin):
         return not self.__eq__(other)
 
     def __unicode__(self):
-        return u'({:.2f}) {}'.format(self.sequence_prob, u' '.join(self.token_sequence))
+        return u'({:.2f}) {}'.format(self.sequence_log_prob, u' '.join(self.token_sequence))
 
 
 class Candidate(namedtuple('Candidate', ['token', 'prob'])):
@@ -278,9 +374,20 @@ class PredictionTrace(UnicodeMixin):
         return u'{}\n{}'.format(c_str, attn_str)
 
 
-class BeamCandidate(namedtuple('BeamCandidate', ['sequence', 'prob'])):
+class BeamCandidate(namedtuple('BeamCandidate', ['sequence', 'log_prob'])):
+    """
+    Attributes:
+        sequence (list[unicode])
+        log_prob (float): log probability of the sequence
+    """
+    __slots__ = ()
+
+    @property
+    def prob(self):
+        return np.exp(self.log_prob)
+
     def __unicode__(self):
-        return u'({:.2f}) {}'.format(self.prob, u' '.join(self.sequence))
+        return u'({:.2f}) {}'.format(self.log_prob, u' '.join(self.sequence))
 
     def __repr__(self):
         return unicode(self).encode('utf-8')
@@ -295,17 +402,43 @@ class BeamDecoderTrace(UnicodeMixin):
 
 
 class BeamTrace(UnicodeMixin):
-    def __init__(self, beam, top_k):
-        candidates = []
-        for state in beam[:top_k]:
-            candidates.append(BeamCandidate(state.token_sequence, state.sequence_prob))
+    def __init__(self, candidates):
+        """Construct BeamTrace.
+
+        Args:
+            candidates (list[BeamCandidate]): sorted highest to lowest score
+        """
         self.candidates = candidates
 
+    @classmethod
+    def from_beam(cls, beam, top_k):
+        """Construct BeamTrace from the top_k DecoderStates of a beam.
+
+        Args:
+            beam (list[DecoderState])
+            top_k (int)
+
+        Returns:
+            BeamTrace
+        """
+        return cls([BeamCandidate(state.token_sequence, state.sequence_log_prob) for state in beam[:top_k]])
+
     def __unicode__(self):
         return u'\n'.join(unicode(c) for c in self.candidates)
 
 
 class LeftRightDecoder(TestDecoder):
+    # how much of the search to record in the returned traces:
+    #   'none': no traces are returned
+    #   'final': only the trace of the final time step
+    #   'full': a trace for every time step (expensive, only useful for debugging)
+    TRACE_MODES = ('none', 'final', 'full')
+
+    @classmethod
+    def _check_trace_mode(cls, traces):
+        if traces not in cls.TRACE_MODES:
+            raise ValueError('traces must be one of {}, got {!r}.'.format(cls.TRACE_MODES, traces))
+
     @classmethod
     def _initialize(cls, decoder_cell, examples):
         """Initialize RNN and decoder states.
@@ -366,46 +499,91 @@ class LeftRightDecoder(TestDecoder):
 
         return rnn_state, predictions
 
-    @classmethod
-    def _prefix_hints_at_time_t(cls, prefix_hints, t, beam_size):
-        """Extract prefix hints at time t.
+    def _force_prefixes(self, encoder_output, rnn_state, prefix_hints):
+        """Teacher-force the decoder through a batch of prefixes.
+
+        All prefixes are read in a single batched pass, with the RNN state of each example frozen once its
+        prefix ends.
 
         Args:
+            encoder_output (EncoderOutput): NOT duplicated to beam_size
+            rnn_state (RNNState): the initial RNN state
             prefix_hints (list[list[unicode]]): a batch of prefixes, one per example.
-            t (int): the time index to pull out
-            beam_size (int)
 
         Returns:
-            list[unicode]: prefix hints at time t, of length len(prefix_hints) * beam_size.
+            rnn_state (RNNState): after reading <start> and all but the last token of each prefix
+            tokens (Variable): LongTensor of shape (batch_size,). The last token of each prefix (<start> if it is
+                empty), to be read at the next time step.
+            token_log_probs (Variable): of shape (batch_size, max_prefix_length). The log prob of each prefix token.
+                0 past the end of each prefix.
         """
-        hints_at_t = []
-        for prefix in prefix_hints:
-            if t >= len(prefix):
-                hint = None
-            else:
-                hint = prefix[t]
-            hints_at_t.extend([hint] * beam_size)
-        return hints_at_t
+        prefixes = SequenceBatch.from_sequences(prefix_hints, self.word_vocab)
+        batch_size = len(prefix_hints)
+        tokens = GPUVariable(torch.LongTensor(batch_size).fill_(self.word_vocab.word2index(START)))
 
-    @classmethod
-    def _recover_sequences(cls, states_over_time, beam_size, top_k):
-        # create decoder_traces
-        ex_idx_to_beam_traces = defaultdict(list)
-        for t, states in enumerate(states_over_time):
-            assert len(states) % beam_size == 0
-            beams = list(chunks(states, beam_size))
-            for ex_idx, beam in enumerate(beams):
-                trace = BeamTrace(beam, top_k)
-                ex_idx_to_beam_traces[ex_idx].append(trace)
+        token_log_probs = []
+        for target in prefixes.split():
+            # target.values is a (batch_size,) Variable, target.mask is (batch_size, 1)
+            x = self.token_embedder.embed_indices(tokens)
+            rnn_input = self.rnn_context_combiner(encoder_output, x)
+            dc_output = self.decoder_cell(rnn_state, rnn_input, target.mask)
+            rnn_state = dc_output.rnn_state
 
-        decoder_traces = []
-        for ex_idx in range(max(ex_idx_to_beam_traces.keys()) + 1):
-            beam_traces = ex_idx_to_beam_traces[ex_idx]
-            decoder_traces.append(BeamDecoderTrace(beam_traces))
+            mask = target.mask.squeeze(1)
+            token_log_probs.append(-dc_output.loss(target.values) * mask)
+            tokens = conditional(mask.long(), target.values, tokens)
+
+        return rnn_state, tokens, torch.stack(token_log_probs, 1)
 
+    def _force_prefix_states(self, encoder_output, rnn_state, states, prefix_hints):
+        """Like `_force_prefixes`, but extends a batch of DecoderStates with the prefixes.
+
+        Args:
+            encoder_output (EncoderOutput): NOT duplicated to beam_size
+            rnn_state (RNNState): the initial RNN state
+            states (list[DecoderState]): the initial states
+            prefix_hints (list[list[unicode]]): a batch of prefixes, one per example.
+
+        Returns:
+            rnn_state (RNNState)
+            states (list[DecoderState]): ending with the last token of each prefix
+        """
+        rnn_state, _, token_log_probs = self._force_prefixes(encoder_output, rnn_state, prefix_hints)
+        token_log_probs = token_log_probs.data.cpu().numpy()
+
+        new_states = []
+        for state, prefix, log_probs in izip(states, prefix_hints, token_log_probs):
+            for token, log_prob in izip(prefix, log_probs):
+                trace = PredictionTrace([Candidate(token, np.exp(log_prob))], [])
+                state = state.extend(token, state.sequence_log_prob + log_prob, trace)
+            new_states.append(state)
+
+        return rnn_state, new_states
+
+    @classmethod
+    def _recover_sequences(cls, states_over_time, beam_size, top_k, traces='full'):
         final_state_beams = list(chunks(states_over_time[-1], beam_size))
         output_beams = [[state.token_sequence for state in state_beam] for state_beam in final_state_beams]
 
+        # create decoder_traces
+        if traces == 'none':
+            decoder_traces = None
+        elif traces == 'final':
+            decoder_traces = [BeamDecoderTrace([BeamTrace.from_beam(beam, top_k)]) for beam in final_state_beams]
+        else:
+            ex_idx_to_beam_traces = defaultdict(list)
+            for t, states in enumerate(states_over_time):
+                assert len(states) % beam_size == 0
+                beams = list(chunks(states, beam_size))
+                for ex_idx, beam in enumerate(beams):
+                    trace = BeamTrace.from_beam(beam, top_k)
+                    ex_idx_to_beam_traces[ex_idx].append(trace)
+
+            decoder_traces = []
+            for ex_idx in range(max(ex_idx_to_beam_traces.keys()) + 1):
+                beam_traces = ex_idx_to_beam_traces[ex_idx]
+                decoder_traces.append(BeamDecoderTrace(beam_traces))
+
         return output_beams, decoder_traces
 
 
@@ -425,7 +603,8 @@ class SampleDecoder(LeftRightDecoder):
         self.word_dim = token_embedder.embed_dim
         self.rnn_context_combiner = rnn_context_combiner
 
-    def decode(self, examples, encoder_output, beam_size, prefix_hints, max_seq_length=50, top_k=5, temperature=1.):
+    def decode(self, examples, encoder_output, beam_size, prefix_hints, max_seq_length=50, top_k=5, temperature=1.,
+               sample_top_k=0, top_p=1., seed=None, traces='final'):
         """Sample an output. 
 
         Args:
@@ -437,84 +616,180 @@ class SampleDecoder(LeftRightDecoder):
             max_seq_length (int): maximum allowable length of outputted sequences
             top_k (int): number of beam candidates to show in trace
             temperature (float): sampling temperature
+            sample_top_k (int): if > 0, only sample from the sample_top_k most probable tokens at each step
+            top_p (float): if < 1, only sample from the smallest set of most probable tokens whose total probability
+                reaches top_p (nucleus sampling, Holtzman et al. 2019)
+            seed (int): if not None, seed the random number generators used for sampling, for reproducibility.
+                The state of the global generators is restored afterwards.
+            traces (str): one of 'none', 'final' (default) or 'full'. See BeamDecoder.decode.
 
         Returns:
             beams (list[list[list[unicode]]]): a batch of beams of decoded sequences
-            traces (list[PredictionTrace])
+            traces (list[BeamDecoderTrace]): None if traces == 'none'
         """
-        rnn_state_orig, states_orig = self._initialize(self.decoder_cell, examples)
+        self._check_trace_mode(traces)
+        encoder_output = self.decoder_cell.prepare(encoder_output)
+        with self._random_seed(seed):
+            rnn_state_orig, states_orig = self._initialize(self.decoder_cell, examples)
+            if any(prefix_hints):
+                # read the prefixes before duplicating to beam_size
+                rnn_state_orig, states_orig = self._force_prefix_states(encoder_output, rnn_state_orig, states_orig,
+                                                                        prefix_hints)
+
+            # duplicate everything to beam_size
+            duplicate = BeamDuplicator(beam_size)
+            rnn_state = duplicate(rnn_state_orig)
+            encoder_output = duplicate(encoder_output)
+            states = []
+            for state in states_orig:
+                states.extend([state] * beam_size)
+
+            states_over_time = []
+            for t in range(max_seq_length):
+                # stop if all sequences have terminated
+                if all(state.terminated for state in states): break
+                rnn_state, states = self._advance(encoder_output, rnn_state, states, temperature, sample_top_k, top_p,
+                                                  traces)
+                states_over_time.append(states)
+
+        return self._recover_sequences(states_over_time, beam_size, top_k=top_k, traces=traces)
 
-        # duplicate everything to beam_size
-        duplicate = BeamDuplicator(beam_size)
-        rnn_state = duplicate(rnn_state_orig)
-        encoder_output = duplicate(encoder_output)
-        states = []
-        for state in states_orig:
-            states.extend([state] * beam_size)
+    @classmethod
+    @contextmanager
+    def _random_seed(cls, seed):
+        """Like `random_seed`, but also seeds (and restores) the GPU generator. Does nothing if seed is None."""
+        if seed is None:
+            yield
+            return
+
+        use_cuda = torch.cuda.is_available()
+        if use_cuda:
+            cuda_state = torch.cuda.get_rng_state()
+            torch.cuda.manual_seed(seed)
+        try:
+            with random_seed(seed):
+                yield
+        finally:
+            if use_cuda:
+                torch.cuda.set_rng_state(cuda_state)
 
-        states_over_time = []
-        for t in range(max_seq_length):
-            # stop if all sequences have terminated
-            if all(state.terminated for state in states): break
-            hints_at_t = self._prefix_hints_at_time_t(prefix_hints, t, beam_size)
-            rnn_state, states = self._advance(encoder_output, rnn_state, states, hints_at_t, temperature)
-            states_over_time.append(states)
+    @classmethod
+    def sampling_weights(cls, token_probs, temperature=1., sample_top_k=0, top_p=1.):
+        """Smooth and truncate a batch of distributions for sampling.
 
-        return self._recover_sequences(states_over_time, beam_size, top_k=top_k)
+        Temperature smoothing is the same as `temperature_smooth`, computed for the whole batch at once.
 
-    def _advance(self, encoder_output, rnn_state, states, hints_at_t, temperature):
+        Args:
+            token_probs (FloatTensor): of shape (batch_size, vocab_size)
+            temperature (float)
+            sample_top_k (int): see `decode`
+            top_p (float): see `decode`
+
+        Returns:
+            FloatTensor: of shape (batch_size, vocab_size). Unnormalized sampling weights.
+        """
+        if temperature <= 0:
+            raise ValueError("Temperature must be positive.")
+
+        if not np.isfinite(temperature):
+            raise ValueError("Temperature must be finite.")
+
+        weights = token_probs
+        if temperature != 1.:
+            logits = torch.log(token_probs) / temperature  # in range [-inf, 0]
+            # shift the largest logit in each row to 0, so that the weights do not all underflow
+            weights = torch.exp(logits - torch.max(logits, 1)[0].expand_as(logits))
+
+        batch_size, vocab_size = weights.size()
+        if 0 < sample_top_k < vocab_size:
+            top_weights, top_indices = torch.topk(weights, sample_top_k, 1)
+            weights = weights.new(batch_size, vocab_size).zero_().scatter_(1, top_indices, top_weights)
+
+        if top_p < 1.:
+            sorted_weights, sorted_indices = torch.sort(weights, 1, descending=True)
+            sorted_probs = sorted_weights / torch.sum(sorted_weights, 1).expand_as(sorted_weights)
+            # drop a token if the more probable tokens already reach top_p. The most probable token is always kept.
+            drop = (torch.cumsum(sorted_probs, 1) - sorted_probs) >= top_p
+            sorted_weights = sorted_weights.masked_fill_(drop, 0.)
+            weights = weights.new(batch_size, vocab_size).zero_().scatter_(1, sorted_indices, sorted_weights)
+
+        return weights
+
+    def _advance(self, encoder_output, rnn_state, states, temperature, sample_top_k, top_p, traces='full'):
         """
 
         Args:
             encoder_output (EncoderOutput)
             rnn_state (RNNState)
             states (list[DecoderState]) 
-            hints_at_t (list[unicode]): of length = len(states)
             temperature (float)
+            sample_top_k (int)
+            top_p (float)
+            traces (str): a PredictionTrace is only attached to the new states if traces == 'full'
 
         Returns:
             rnn_state (RNNState)
             states (list[DecoderState])
         """
         # update RNN state
-        rnn_state, predictions = self._advance_rnn(self.token_embedder, self.decoder_cell, self.rnn_context_combiner,
-                                                   encoder_output, rnn_state, states)
-        token_probs, vocab = predictions
-        vocab_size = len(vocab)
+        previous_words = [state.token for state in states]  # get latest words
+        advance = GPUVariable(torch.ones(len(states), 1))
+        x = self.token_embedder.embed_tokens(previous_words)
+        rnn_input = self.rnn_context_combiner(encoder_output, x)
+        dc_output = self.decoder_cell(rnn_state, rnn_input, advance)
+        vocab = dc_output.vocab
+        token_probs = dc_output.vocab_probs.data  # (batch_size, vocab_size)
+
+        # sample a token for every sequence at once
+        # terminated sequences are sampled too, but their samples are ignored
+        weights = self.sampling_weights(token_probs, temperature, sample_top_k, top_p)
+        token_indices = torch.multinomial(weights, 1).view(-1)  # (batch_size,)
+
+        selected_probs = torch.gather(token_probs, 1, token_indices.unsqueeze(1)).view(-1)  # (batch_size,)
+        token_indices, selected_probs = token_indices.cpu().numpy(), selected_probs.cpu().numpy()
 
         # update states
         new_states = []
-        for batch_idx, (state, hint) in enumerate(izip(states, hints_at_t)):
+        for state, token_idx, token_prob in izip(states, token_indices, selected_probs):
             if state.terminated:
                 new_state = state
             else:
-                if hint is None:
-                    sampling_probs = token_probs[batch_idx]  # np.array (vocab_size,)
-                    sampling_probs = temperature_smooth(sampling_probs, temperature)
-                    token_idx = np.random.choice(vocab_size, p=sampling_probs)  # select token according to prob
-                else:
-                    token_idx = vocab.word2index(hint)  # follow the hint
                 token = vocab.index2word(token_idx)
-                token_prob = token_probs[batch_idx, token_idx]
-                extension_prob = state.sequence_prob * token_prob  # compute prob of entire new sequence
+                extension_log_prob = state.sequence_log_prob + np.log(token_prob)  # log prob of entire new sequence
 
-                candidates = [Candidate(token, token_prob)]
-                trace = PredictionTrace(candidates, [])
-                new_state = state.extend(token, extension_prob, trace)
+                trace = PredictionTrace([Candidate(token, token_prob)], []) if traces == 'full' else None
+                new_state = state.extend(token, extension_log_prob, trace)
 
             new_states.append(new_state)
 
-        return rnn_state, new_states
+        return dc_output.rnn_state, new_states
+
+
+class BeamSearchState(namedtuple('BeamSearchState', ['rnn_state', 'tokens', 'terminated', 'sequence_log_probs',
+                                                     'lengths']), NamedTupleLike):
+    """Search state of tensorized beam search, for a batch of hypotheses.
+
+    Attributes:
+        rnn_state (RNNState)
+        tokens (Variable[LongTensor]): of shape (batch_size,). The last token of each hypothesis.
+        terminated (Variable[FloatTensor]): of shape (batch_size,). 1 if the hypothesis has emitted <stop>.
+        sequence_log_probs (Variable[FloatTensor]): of shape (batch_size,)
+        lengths (Variable[FloatTensor]): of shape (batch_size,). Number of tokens in each hypothesis.
+    """
+    __slots__ = ()
 
 
 class BeamDecoder(LeftRightDecoder):
-    def __init__(self, decoder_cell, token_embedder, rnn_context_combiner):
+    def __init__(self, decoder_cell, token_embedder, rnn_context_combiner, tensorized=False):
         """Construct BeamDecoder.
 
         Args:
             decoder_cell (DecoderCell)
             token_embedder (TokenEmbedder)
             rnn_context_combiner (RNNContextCombiner)
+            tensorized (bool): if True, beam search keeps sequence probabilities, backpointers and tokens as
+                tensors on device, rather than building a DecoderState per hypothesis. Token sequences are only
+                recovered once decoding has finished. Does not support value estimators.
 
         """
         self.decoder_cell = decoder_cell
@@ -522,11 +797,15 @@ class BeamDecoder(LeftRightDecoder):
         self.token_embedder = token_embedder
         self.word_dim = token_embedder.embed_dim
         self.rnn_context_combiner = rnn_context_combiner
+        self.tensorized = tensorized
 
     def decode(self, examples, encoder_output, weighted_value_estimators,
-               beam_size, prefix_hints, sibling_penalty, max_seq_length=50, top_k=5, verbose=False):
+               beam_size, prefix_hints, sibling_penalty, max_seq_length=50, top_k=5, verbose=False,
+               length_penalty=0., traces='final'):
         """Beam decode.
 
+        Hypotheses are scored in log space, so sequence probabilities do not underflow on long sequences.
+
         Args:
             examples (list[Example])
             encoder_output (EncoderOutput)
@@ -538,12 +817,31 @@ class BeamDecoder(LeftRightDecoder):
             max_seq_length (int): maximum allowable length of outputted sequences
             top_k (int): number of beam candidates to show in trace
             verbose (bool): default is False
+            length_penalty (float): if non-zero, hypotheses are ranked by their log probability divided by
+                ((5 + length) / 6) ** length_penalty, as in Wu et al. 2016. If 0 (default), hypotheses are
+                ranked by their log probability.
+            traces (str): how much of the search to record in the returned traces. 'none' returns no traces,
+                'final' (default) returns only the top_k candidates of the final beams, and 'full' returns the
+                top_k candidates at every time step. 'full' is expensive and only meant for debugging.
 
         Returns:
             beams (list[list[list[unicode]]]): a batch of beams of decoded sequences
-            traces (list[BeamDecoderTrace])
+            traces (list[BeamDecoderTrace]): None if traces == 'none'. If traces == 'final', each
+                BeamDecoderTrace holds a single BeamTrace.
         """
+        self._check_trace_mode(traces)
+        encoder_output = self.decoder_cell.prepare(encoder_output)
+        if self.tensorized:
+            if weighted_value_estimators:
+                raise ValueError('Value estimators are not supported by tensorized beam search.')
+            return self._decode_tensorized(examples, encoder_output, beam_size, prefix_hints, sibling_penalty,
+                                           max_seq_length, top_k, verbose, length_penalty, traces)
+
         rnn_state_orig, states_orig = self._initialize(self.decoder_cell, examples)
+        if any(prefix_hints):
+            # read the prefixes before duplicating to beam_size
+            rnn_state_orig, states_orig = self._force_prefix_states(encoder_output, rnn_state_orig, states_orig,
+                                                                    prefix_hints)
 
         # duplicate everything to beam_size
         duplicate = BeamDuplicator(beam_size)
@@ -553,7 +851,7 @@ class BeamDecoder(LeftRightDecoder):
         states = []
         for state in states_orig:
             states.append(state)
-            # these states are guaranteed to die on the first round, because their sequence_prob = 0
+            # these states are guaranteed to die on the first round, because their sequence_log_prob = -inf
             # they are just here as padding
             # TODO(kelvin): WARNING! In the future, the ValueEstimators in BeamDecoder._advance might break
             # my assumption that any extension of a sequence with 0 prob will also have 0 prob.
@@ -571,39 +869,41 @@ class BeamDecoder(LeftRightDecoder):
             # stop if all sequences have terminated
             if all(state.terminated for state in states): break
             rnn_state, states = self._advance(encoder_output, weighted_value_estimators, beam_size, rnn_state, states,
-                                              sibling_penalty)
+                                              sibling_penalty, length_penalty, traces)
             states_over_time.append(states)
 
-        return self._recover_sequences(states_over_time, beam_size, top_k)
+        return self._recover_sequences(states_over_time, beam_size, top_k, traces)
 
     @classmethod
-    def _select_extensions_fast(cls, extension_probs, beam_size):
-        extension_probs_sorted, original_indices = cls._truncate_extension_probs(extension_probs,
-                                                                                 beam_size)  # (batch_size, beam_size)
-        batch_indices, sorted_token_indices = cls._select_extensions(extension_probs_sorted,
+    def _select_extensions_fast(cls, extension_scores, beam_size, sibling_penalty=0.):
+        extension_scores_sorted, original_indices = cls._truncate_extension_scores(extension_scores,
+                                                                                   beam_size)  # (batch_size, beam_size)
+        # apply diversity-inducing sibling penalization trick
+        extension_scores_sorted = cls.penalize_extensions_by_rank(extension_scores_sorted, sibling_penalty)
+        batch_indices, sorted_token_indices = cls._select_extensions(extension_scores_sorted,
                                                                      beam_size)  # 1D array of batch_size * beam_size
         token_indices = original_indices[batch_indices, sorted_token_indices]  # 1D array of batch_size * beam_size
         return batch_indices, token_indices
 
     @classmethod
-    def _select_extensions(cls, extension_probs, beam_size):
-        """For each beam in extension_probs, select <beam_size> elements to continue.
+    def _select_extensions(cls, extension_scores, beam_size):
+        """For each beam in extension_scores, select <beam_size> elements to continue.
 
         Args:
-            extension_probs (np.ndarray): of shape (batch_size, vocab_size). Containing the probability of
-                every extension of every element in the batch.
+            extension_scores (np.ndarray): of shape (batch_size, vocab_size). Containing the score (e.g. log
+                probability) of every extension of every element in the batch.
             beam_size (int): must satisfy batch_size % beam_size == 0
 
         Returns:
             batch_indices (np.ndarray): 1D array, batch indices of the top extensions
             token_indices (np.ndarray): 1D array, token indices of the top extensions
         """
-        batch_size, vocab_size = extension_probs.shape
+        batch_size, vocab_size = extension_scores.shape
         num_beams = batch_size / beam_size
         assert batch_size % beam_size == 0
 
-        beam_probs = np.reshape(extension_probs, (num_beams, vocab_size * beam_size))
-        top_indices = np.argsort(-beam_probs, axis=1)  # TODO: do this in PyTorch
+        beam_scores = np.reshape(extension_scores, (num_beams, vocab_size * beam_size))
+        top_indices = np.argsort(-beam_scores, axis=1)  # TODO: do this in PyTorch
         top_indices = top_indices[:, :beam_size]  # (num_beams, beam_size)
 
         assert top_indices.dtype == np.int64  # going to do int arithmetic with this
@@ -616,62 +916,78 @@ class BeamDecoder(LeftRightDecoder):
         return batch_indices.flatten(), token_indices.flatten()
 
     @classmethod
-    def _truncate_extension_probs(cls, extension_probs, beam_size):
-        """For each example, keep only the k highest scoring extension probs.
+    def _truncate_extension_scores(cls, extension_scores, beam_size):
+        """For each example, keep only the k highest extension scores.
 
         Where k = beam_size.
 
         Args:
-            extension_probs (np.ndarray): of shape (batch_size, vocab_size)
+            extension_scores (np.ndarray): of shape (batch_size, vocab_size)
             beam_size (int)
 
         Returns:
-            extension_probs_sorted (np.ndarray): of shape (batch_size, beam_size). Like extension_probs, but each
-                row is sorted in descending probability, and truncated to a length of beam_size.
+            extension_scores_sorted (np.ndarray): of shape (batch_size, beam_size). Like extension_scores, but each
+                row is sorted in descending order, and truncated to a length of beam_size.
             original_indices (np.ndarray): of shape (batch_size, beam_size).
-                original_indices[i, j] = the original column index of the probability value at extension_probs_sorted[i, j]
+                original_indices[i, j] = the original column index of the score at extension_scores_sorted[i, j]
         """
-        extension_probs_var = try_gpu(Variable((torch.from_numpy(extension_probs)), volatile=True))
-        extension_probs_sorted_var, original_indices_var = torch.sort(extension_probs_var, 1, descending=True)
-        extension_probs_sorted_var = extension_probs_sorted_var[:, :beam_size]
-        original_indices_var = original_indices_var[:, :beam_size]
+        extension_scores_var = try_gpu(Variable((torch.from_numpy(extension_scores)), volatile=True))
+        extension_scores_sorted_var, original_indices_var = torch.topk(extension_scores_var, beam_size, 1)
 
         from_var = lambda v: v.data.cpu().numpy()
-        extension_probs_sorted = from_var(extension_probs_sorted_var)
+        extension_scores_sorted = from_var(extension_scores_sorted_var)
         original_indices = from_var(original_indices_var)
 
-        # batch_size, vocab_size = extension_probs.shape
-        # original_indices = np.argsort(-extension_probs, axis=1)  # (batch_size, vocab_size)
-        # original_indices = original_indices[:, :beam_size]  # (batch_size, beam_size)
-        #
-        # j_indices, i_indices = np.meshgrid(np.arange(beam_size), np.arange(batch_size))  # (batch_size, beam_size)
-        #
-        # extension_probs_sorted = extension_probs[i_indices, original_indices]  # (batch_size, beam_size)
-
-        return extension_probs_sorted, original_indices
+        return extension_scores_sorted, original_indices
 
     @classmethod
-    def penalize_extensions_by_rank(cls, extension_probs, penalty):
+    def penalize_extensions_by_rank(cls, extension_scores_sorted, penalty):
         """Penalize extensions by their rank, as done in Li et al. 2016.
 
         "A Simple, Fast Diverse Decoding Algorithm for Neural Generation."
 
+        Only the top beam_size extensions of a hypothesis can make it onto the beam (any other extension is beaten
+        by all of them, even after penalization). So the penalty is only applied to those: each row of
+        extension_scores_sorted must already be truncated to the top extensions, sorted in descending order.
+
         Args:
-            extension_probs (np.ndarray): of shape (batch_size, vocab_size)
+            extension_scores_sorted (np.ndarray | Variable): of shape (batch_size, k), in log space
             penalty (float)
-        """
-        batch_size, vocab_size = extension_probs.shape
-        penalized_extension_probs = np.copy(extension_probs)
 
+        Returns:
+            np.ndarray | Variable: of shape (batch_size, k)
+        """
         if penalty == 0.0:
-            return penalized_extension_probs  # shortcut for when there is no penalty
+            return extension_scores_sorted  # shortcut for when there is no penalty
 
-        top_indices = np.argsort(-extension_probs, axis=1)
-        j_indices, i_indices = np.meshgrid(np.arange(vocab_size), np.arange(batch_size))
-        penalized_extension_probs[i_indices, top_indices] /= np.exp(penalty * j_indices)
-        return penalized_extension_probs
+        if isinstance(extension_scores_sorted, Variable):
+            batch_size, k = extension_scores_sorted.size()
+            ranks = GPUVariable(torch.arange(0, k)).unsqueeze(0).expand(batch_size, k)
+        else:
+            batch_size, k = extension_scores_sorted.shape
+            ranks = np.arange(k, dtype=np.float32)
+        return extension_scores_sorted - penalty * ranks
 
-    def _advance(self, encoder_output, weighted_value_estimators, beam_size, rnn_state, states, sibling_penalty):
+    @classmethod
+    def _length_normalize(cls, log_probs, lengths, length_penalty):
+        """Normalize log probabilities by sequence length, as done in Wu et al. 2016.
+
+        "Google's Neural Machine Translation System: Bridging the Gap between Human and Machine Translation."
+
+        Args:
+            log_probs (np.ndarray | Variable)
+            lengths (np.ndarray | Variable): same shape as log_probs
+            length_penalty (float)
+
+        Returns:
+            np.ndarray | Variable: same shape as log_probs
+        """
+        if length_penalty == 0.0:
+            return log_probs  # shortcut for when there is no penalty
+        return log_probs / (((5. + lengths) / 6.) ** length_penalty)
+
+    def _advance(self, encoder_output, weighted_value_estimators, beam_size, rnn_state, states, sibling_penalty,
+                 length_penalty, traces='full'):
         """Take one step of beam search.
 
         Args:
@@ -681,6 +997,8 @@ class BeamDecoder(LeftRightDecoder):
             rnn_state (RNNState)
             states (list[DecoderState])
             sibling_penalty (float)
+            length_penalty (float)
+            traces (str): a PredictionTrace is only attached to the new states if traces == 'full'
 
         Returns:
             h (Variable): (batch_size, hidden_dim)
@@ -691,19 +1009,22 @@ class BeamDecoder(LeftRightDecoder):
                                                    encoder_output, rnn_state, states)
         token_probs, vocab = predictions
 
-        sequence_probs = np.expand_dims(np.array([s.sequence_prob for s in states]), 1)  # (batch_size, 1)
-        extension_probs = sequence_probs * token_probs  # (batch_size, vocab_size)
+        with np.errstate(divide='ignore'):
+            token_log_probs = np.log(token_probs)  # (batch_size, vocab_size)
+        sequence_log_probs = np.array([[s.sequence_log_prob] for s in states], dtype=np.float32)  # (batch_size, 1)
+        extension_log_probs = sequence_log_probs + token_log_probs  # (batch_size, vocab_size)
 
-        # modify extension probs using value estimators
-        modified_extension_probs = np.copy(extension_probs)
+        # modify extension scores using value estimators
+        extension_scores = extension_log_probs
         for val_estimator, weight in weighted_value_estimators:
-            modified_extension_probs *= np.exp(weight * val_estimator.value(states, rnn_state))
+            extension_scores = extension_scores + weight * val_estimator.value(states, rnn_state)
 
-        # apply diversity-inducing sibling penalization trick
-        modified_extension_probs = self.penalize_extensions_by_rank(modified_extension_probs, sibling_penalty)
+        # terminated sequences do not grow any longer
+        lengths = np.array([[s.length if s.terminated else s.length + 1] for s in states], dtype=np.float32)
+        extension_scores = self._length_normalize(extension_scores, lengths, length_penalty)
 
-        # select the best extensions of each beam, using MODIFIED extension_probs
-        batch_indices, token_indices = self._select_extensions_fast(modified_extension_probs, beam_size)
+        # select the best extensions of each beam, using MODIFIED extension_scores
+        batch_indices, token_indices = self._select_extensions_fast(extension_scores, beam_size, sibling_penalty)
         # both batch_indices and token_indices are (batch_size,)
 
         # select surviving RNN states
@@ -711,8 +1032,8 @@ class BeamDecoder(LeftRightDecoder):
         rnn_state = batch_selector(rnn_state)
 
         # update states
-        # note that here we store the original, UN-MODIFIED extension_probs
-        # these are actual generation probabilities
+        # note that here we store the original, UN-MODIFIED extension_log_probs
+        # these are actual generation log probabilities
         new_states = []
         for batch_idx, token_idx in izip(batch_indices, token_indices):
             state = states[batch_idx]
@@ -720,20 +1041,327 @@ class BeamDecoder(LeftRightDecoder):
                 new_state = state
             else:
                 token = vocab.index2word(token_idx)
-                extension_prob = extension_probs[batch_idx, token_idx]
+                extension_log_prob = extension_log_probs[batch_idx, token_idx]
 
                 # construct trace
-                token_prob = token_probs[batch_idx, token_idx]
-                candidates = [Candidate(token, token_prob)]
-                trace = PredictionTrace(candidates, [])
-                # TODO(kelvin): add more info to trace
+                trace = None
+                if traces == 'full':
+                    token_prob = token_probs[batch_idx, token_idx]
+                    candidates = [Candidate(token, token_prob)]
+                    trace = PredictionTrace(candidates, [])
+                    # TODO(kelvin): add more info to trace
 
-                new_state = state.extend(token, extension_prob, trace)
+                new_state = state.extend(token, extension_log_prob, trace)
 
             new_states.append(new_state)
 
         return rnn_state, new_states
 
+    def _decode_tensorized(self, examples, encoder_output, beam_size, prefix_hints, sibling_penalty, max_seq_length,
+                           top_k, verbose, length_penalty, traces='final'):
+        """Beam decode, keeping all search state on device.
+
+        Same arguments and return values as `decode`.
+        """
+        num_examples = len(examples)
+        if not any(prefix_hints):
+            prefix_hints = [[]] * num_examples
+        search_state = self._initial_search_state(num_examples, beam_size, encoder_output, prefix_hints)
+        encoder_output = BeamDuplicator(beam_size)(encoder_output)
+
+        # examples whose beams have fully terminated are dropped from the batch, so that we do not spend
+        # computation on them. active[i] is the index (into examples) of the i-th example still being decoded.
+        active = np.arange(num_examples)
+        parent_rows = None  # if the batch was compacted, maps each row to its row before compaction
+
+        # perform iterations of beam search
+        time_steps = range(max_seq_length)
+        if verbose:
+            time_steps = verboserate(time_steps, desc='Beam decoding sequences')
+
+        tokens_over_time, backpointers_over_time, log_probs_over_time, active_over_time = [], [], [], []
+        for _ in time_steps:
+            search_state, batch_indices = self._advance_tensorized(encoder_output, search_state, beam_size,
+                                                                   sibling_penalty, length_penalty)
+
+            tokens_over_time.append(search_state.tokens)
+            backpointers_over_time.append(batch_indices if parent_rows is None
+                                          else parent_rows.index_select(0, batch_indices))
+            log_probs_over_time.append(search_state.sequence_log_probs)
+            active_over_time.append(active)
+
+            done = self._finished_beams(search_state, beam_size)  # (num_active,)
+            if done.all(): break
+
+            parent_rows = None
+            if done.any():
+                # drop finished examples from the batch
+                keep = np.flatnonzero(~done)
+                select = BatchSelector(self._beam_rows(keep, beam_size, beam_size))
+                search_state, encoder_output = select(search_state), select(encoder_output)
+                active = active[keep]
+                parent_rows = select.batch_indices
+
+        return self._recover_sequences_tensorized(self.word_vocab, prefix_hints, tokens_over_time,
+                                                  backpointers_over_time, log_probs_over_time, active_over_time,
+                                                  beam_size, top_k, traces)
+
+    def _initial_search_state(self, num_examples, beam_size, encoder_output=None, prefix_hints=None):
+        """Create the initial BeamSearchState for a batch of examples.
+
+        Args:
+            num_examples (int)
+            beam_size (int)
+            encoder_output (EncoderOutput): NOT duplicated to beam_size. Only needed if there are prefix_hints.
+            prefix_hints (list[list[unicode]]): a batch of prefixes, one per example. If any are non-empty, they
+                are read by the decoder, and search starts from the end of each prefix.
+
+        Returns:
+            BeamSearchState: with num_examples * beam_size rows
+        """
+        rnn_state = self.decoder_cell.initialize(num_examples)
+        tokens = GPUVariable(torch.LongTensor(num_examples).fill_(self.word_vocab.word2index(START)))
+        sequence_log_probs = GPUVariable(torch.zeros(num_examples))
+        lengths = GPUVariable(torch.zeros(num_examples))
+
+        if prefix_hints is not None and any(prefix_hints):
+            rnn_state, tokens, token_log_probs = self._force_prefixes(encoder_output, rnn_state, prefix_hints)
+            sequence_log_probs = token_log_probs.sum(1).view(num_examples)
+            lengths = GPUVariable(torch.FloatTensor([len(prefix) for prefix in prefix_hints]))
+
+        # only the first element of each beam is alive. The rest are padding with sequence_log_prob = -inf,
+        # guaranteed to die on the first round (see `decode`).
+        doomed = np.full(num_examples * beam_size, -np.inf, dtype=np.float32)
+        doomed[::beam_size] = 0.0
+
+        duplicate = BeamDuplicator(beam_size)
+        return BeamSearchState(
+            rnn_state=duplicate(rnn_state),
+            tokens=duplicate(tokens),
+            terminated=GPUVariable(torch.zeros(num_examples * beam_size)),
+            sequence_log_probs=duplicate(sequence_log_probs) + GPUVariable(torch.from_numpy(doomed)),
+            lengths=duplicate(lengths),
+        )
+
+    def _advance_tensorized(self, encoder_output, search_state, beam_size, sibling_penalty, length_penalty):
+        """Take one step of beam search, on device.
+
+        Args:
+            encoder_output (EncoderOutput): already duplicated to beam_size
+            search_state (BeamSearchState)
+            beam_size (int)
+            sibling_penalty (float)
+            length_penalty (float)
+
+        Returns:
+            search_state (BeamSearchState)
+            batch_indices (Variable): of shape (batch_size,). The row (of the old search_state) that each
+                row of the new search_state extends.
+        """
+        vocab = self.word_vocab
+        vocab_size = len(vocab)
+        stop_idx = vocab.word2index(STOP)
+        tokens, terminated, sequence_log_probs, lengths = \
+            search_state.tokens, search_state.terminated, search_state.sequence_log_probs, search_state.lengths
+        batch_size = int(tokens.size()[0])
+        num_beams = batch_size / beam_size
+
+        # terminated sequences can only be extended with <stop>
+        stop_probs = torch.zeros(1, vocab_size)
+        stop_probs[0, stop_idx] = 1.0
+        stop_probs = GPUVariable(stop_probs)
+
+        beam_offsets = GPUVariable(torch.from_numpy(np.arange(num_beams) * beam_size)).unsqueeze(1)  # (num_beams, 1)
+        advance = GPUVariable(torch.ones(batch_size, 1))
+
+        # advance the RNN
+        x = self.token_embedder.embed_indices(tokens)
+        rnn_input = self.rnn_context_combiner(encoder_output, x)
+        dc_output = self.decoder_cell(search_state.rnn_state, rnn_input, advance)
+
+        token_probs = dc_output.vocab_probs  # (batch_size, vocab_size)
+        token_probs = conditional(terminated.unsqueeze(1).expand_as(token_probs),
+                                  stop_probs.expand_as(token_probs), token_probs)
+        token_log_probs = torch.log(token_probs)
+        extension_log_probs = sequence_log_probs.unsqueeze(1).expand_as(token_log_probs) + token_log_probs
+        extension_lengths = lengths + (1 - terminated)  # terminated sequences do not grow any longer
+
+        # select the best extensions of each beam, using MODIFIED extension scores
+        extension_scores = self._length_normalize(extension_log_probs,
+                                                  extension_lengths.unsqueeze(1).expand_as(extension_log_probs),
+                                                  length_penalty)
+        if sibling_penalty == 0.0:
+            extension_scores = extension_scores.view(num_beams, beam_size * vocab_size)
+            _, top_indices = torch.topk(extension_scores, beam_size, 1)  # (num_beams, beam_size)
+        else:
+            # apply diversity-inducing sibling penalization trick, to the top extensions of each hypothesis
+            row_scores, row_tokens = torch.topk(extension_scores, beam_size, 1)  # (batch_size, beam_size)
+            row_scores = self.penalize_extensions_by_rank(row_scores, sibling_penalty)
+            _, top = torch.topk(row_scores.view(num_beams, beam_size * beam_size), beam_size, 1)
+            top_tokens = torch.gather(row_tokens.view(num_beams, beam_size * beam_size), 1, top)
+            top_indices = (top / beam_size) * vocab_size + top_tokens  # (num_beams, beam_size)
+
+        batch_indices = (beam_offsets.expand_as(top_indices) + top_indices / vocab_size).view(batch_size)
+        token_indices = torch.fmod(top_indices, vocab_size).view(batch_size)
+
+        # note that here we store the original, UN-MODIFIED extension_log_probs
+        # terminated sequences are extended with <stop>, which leaves their log prob unchanged
+        sequence_log_probs = torch.gather(extension_log_probs.view(num_beams, beam_size * vocab_size), 1,
+                                          top_indices).view(batch_size)
+        lengths = extension_lengths.index_select(0, batch_indices)
+        was_terminated = terminated.index_select(0, batch_indices)
+        tokens = conditional(was_terminated.long(), stop_idx, token_indices)
+        terminated = (tokens == stop_idx).float()
+
+        # select surviving RNN states
+        rnn_state = BatchSelector(batch_indices)(dc_output.rnn_state)
+
+        return BeamSearchState(rnn_state, tokens, terminated, sequence_log_probs, lengths), batch_indices
+
+    @classmethod
+    def _finished_beams(cls, search_state, beam_size):
+        """Check which beams have fully terminated.
+
+        Once every hypothesis in a beam has terminated, the beam can no longer change.
+
+        Args:
+            search_state (BeamSearchState)
+            beam_size (int)
+
+        Returns:
+            np.ndarray: boolean array of shape (num_beams,)
+        """
+        return search_state.terminated.data.cpu().numpy().reshape(-1, beam_size).all(axis=1)
+
+    @classmethod
+    def _beam_rows(cls, positions, beam_size, k):
+        """Return the row indices of the first k hypotheses of the beams at the given positions in the batch.
+
+        Args:
+            positions (np.ndarray): 1D array of beam positions
+            beam_size (int)
+            k (int)
+
+        Returns:
+            np.ndarray: 1D array of shape (len(positions) * k,)
+        """
+        return (np.expand_dims(positions * beam_size, 1) + np.arange(k)).flatten()
+
+    @classmethod
+    def _recover_sequences_tensorized(cls, vocab, prefix_hints, tokens_over_time, backpointers_over_time,
+                                      log_probs_over_time, active_over_time, beam_size, top_k, traces='full'):
+        """Follow backpointers to recover token sequences and traces.
+
+        Args:
+            vocab (Vocab)
+            prefix_hints (list[list[unicode]]): the prefix of each example, which is prepended to its sequences
+            tokens_over_time (list[Variable]): each of shape (num_active * beam_size,). The token selected for each
+                hypothesis.
+            backpointers_over_time (list[Variable]): each of shape (num_active * beam_size,). The index of the
+                hypothesis (at the previous time step) that each hypothesis extends.
+            log_probs_over_time (list[Variable]): each of shape (num_active * beam_size,). The sequence log prob of
+                each hypothesis.
+            active_over_time (list[np.ndarray]): each of shape (num_active,). The indices of the examples that were
+                still being decoded at each time step.
+            beam_size (int)
+            top_k (int): number of beam candidates to show in trace
+            traces (str): one of 'none', 'final' or 'full'. See `decode`.
+
+        Returns:
+            beams (list[list[list[unicode]]])
+            traces (list[BeamDecoderTrace]): None if traces == 'none'
+        """
+        # transfer everything to the CPU at once
+        split_points = np.cumsum([len(active) * beam_size for active in active_over_time])[:-1]
+        to_numpy = lambda variables: np.split(torch.cat(variables).data.cpu().numpy(), split_points)
+        tokens, backpointers, log_probs = [to_numpy(v) for v in
+                                           (tokens_over_time, backpointers_over_time, log_probs_over_time)]
+        num_examples = len(prefix_hints)
+        num_steps = len(active_over_time)
+        stop_idx = vocab.word2index(STOP)
+
+        def token_sequences(t, indices):
+            """Return the token sequences of the hypotheses at the given indices of time step t."""
+            paths = np.zeros((t + 1, len(indices)), dtype=np.int64)
+            for s in reversed(range(t + 1)):
+                paths[s] = tokens[s][indices]
+                indices = backpointers[s][indices]
+
+            sequences = []
+            for path in paths.T:
+                sequence = []
+                for token_idx in path:
+                    if token_idx == stop_idx: break
+                    sequence.append(vocab.index2word(token_idx))
+                sequences.append(sequence)
+            return sequences
+
+        # the hypotheses in each beam are sorted from highest to lowest score
+        k = min(top_k, beam_size)
+
+        ex_idx_to_beam_traces = defaultdict(list)
+        output_beams = [None] * num_examples
+        for t, active in enumerate(active_over_time):
+            if traces == 'full':
+                trace_indices = cls._beam_rows(np.arange(len(active)), beam_size, k)
+                sequences = token_sequences(t, trace_indices)
+                for ex_idx, beam_sequences, beam_indices in izip(active, chunks(sequences, k),
+                                                                 chunks(trace_indices, k)):
+                    prefix = prefix_hints[ex_idx]
+                    candidates = [BeamCandidate(prefix + seq, float(log_probs[t][idx]))
+                                  for seq, idx in izip(beam_sequences, beam_indices)]
+                    ex_idx_to_beam_traces[ex_idx].append(BeamTrace(candidates))
+
+            # examples which leave the batch after this time step
+            is_final = np.ones(len(active), dtype=bool) if t == num_steps - 1 \
+                else ~np.in1d(active, active_over_time[t + 1])
+            final_positions = np.flatnonzero(is_final)
+            final_indices = cls._beam_rows(final_positions, beam_size, beam_size)
+            final_sequences = token_sequences(t, final_indices)
+            for ex_idx, beam, beam_indices in izip(active[final_positions], chunks(final_sequences, beam_size),
+                                                   chunks(final_indices, beam_size)):
+                prefix = prefix_hints[ex_idx]
+                output_beams[ex_idx] = [prefix + seq for seq in beam]
+                if traces == 'final':
+                    candidates = [BeamCandidate(prefix + seq, float(log_probs[t][idx]))
+                                  for seq, idx in izip(beam[:k], beam_indices[:k])]
+                    ex_idx_to_beam_traces[ex_idx].append(BeamTrace(candidates))
+
+        if traces == 'none':
+            return output_beams, None
+
+        # finished beams do not change, so repeat their final trace for the remaining time steps
+        num_traces = num_steps if traces == 'full' else 1
+        decoder_traces = []
+        for ex_idx in range(num_examples):
+            beam_traces = ex_idx_to_beam_traces[ex_idx]
+            beam_traces.extend([beam_traces[-1]] * (num_traces - len(beam_traces)))
+            decoder_traces.append(BeamDecoderTrace(beam_traces))
+
+        return output_beams, decoder_traces
+
+
+class BatchShared(object):
+    """Wraps a value which belongs to a whole batch rather than to its rows (e.g. inside an encoder output).
+
+    BeamDuplicator and BatchSelector leave it unchanged, instead of indexing it by row.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    @classmethod
+    def concatenate_batches(cls, objs):
+        """Concatenating batches keeps their shared value, which must be the same object for all of them.
+
+        Types holding BatchShared values which may differ between batches should define concatenate_batches
+        themselves (see BatchConcatenator).
+        """
+        if any(obj is not objs[0] for obj in objs):
+            raise ValueError('Cannot concatenate batches with different BatchShared values.')
+        return objs[0]
+
 
 class BeamDuplicator(object):
     def __init__(self, beam_size):
@@ -747,6 +1375,8 @@ class BeamDuplicator(object):
             return self._list(obj)
         if t == Variable:
             return self._variable(obj)
+        if t == BatchShared:
+            return obj
         if isinstance(obj, NamedTupleLike):
             return self._namedtuple(obj)
         raise TypeError('Cannot duplicate {}'.format(t))
@@ -770,7 +1400,15 @@ class BeamDuplicator(object):
 # TODO(kelvin): test
 class BatchSelector(object):
     def __init__(self, batch_indices):
-        self.batch_indices = GPUVariable(torch.from_numpy(batch_indices))
+        """Construct BatchSelector.
+
+        Args:
+            batch_indices (np.ndarray | Variable): 1D array of batch indices to select (LongTensor if a Variable)
+        """
+        if isinstance(batch_indices, Variable):
+            self.batch_indices = batch_indices
+        else:
+            self.batch_indices = GPUVariable(torch.from_numpy(batch_indices))
 
     def __call__(self, obj):
         t = type(obj)
@@ -780,6 +1418,8 @@ class BatchSelector(object):
             return self._list(obj)
         if t == Variable:
             return self._variable(obj)
+        if t == BatchShared:
+            return obj
         if isinstance(obj, NamedTupleLike):
             return self._namedtuple(obj)
         raise TypeError('Cannot batch-select {}'.format(t))
@@ -792,4 +1432,255 @@ class BatchSelector(object):
         return type(obj)(*[self(item) for item in obj])
 
     def _list(self, l):
-        return [self(item) for item in l]
\ No newline at end of file
+        return [self(item) for item in l]
+
+class BatchConcatenator(object):
+    """Concatenate batches along the batch dimension.
+
+    Variables which differ in size along dimension 1 (e.g. the values and mask of a SequenceBatch) are
+    right-padded with zeros. Types which need something else (e.g. a different padding value) can define a
+    classmethod `concatenate_batches(objs)`, which is used instead.
+    """
+
+    def __call__(self, objs):
+        """Concatenate batches.
+
+        Args:
+            objs (list): a list of batches of the same type (Variable, NamedTupleLike or list)
+        """
+        obj = objs[0]
+        t = type(obj)
+        if obj is None:
+            return None
+        if t == list:
+            return self._list(objs)
+        if t == Variable:
+            return self._variable(objs)
+        if hasattr(t, 'concatenate_batches'):
+            return t.concatenate_batches(objs)
+        if isinstance(obj, NamedTupleLike):
+            return self._namedtuple(objs)
+        raise TypeError('Cannot concatenate {}'.format(t))
+
+    def _variable(self, vs):
+        if vs[0].dim() > 1:
+            max_len = max(int(v.size()[1]) for v in vs)
+            vs = [self._pad(v, max_len) for v in vs]
+        return torch.cat(vs, 0)
+
+    def _pad(self, v, length):
+        size = list(v.size())
+        if size[1] == length:
+            return v
+        size[1] = length - size[1]
+        padding = Variable(v.data.new(*size).zero_(), volatile=v.volatile)
+        return torch.cat([v, padding], 1)
+
+    def _namedtuple(self, objs):
+        assert isinstance(objs[0], tuple)
+        return type(objs[0])(*[self(list(items)) for items in izip(*objs)])
+
+    def _list(self, objs):
+        return [self(list(items)) for items in izip(*objs)]
+
+
+class ContinuousBeamDecoder(object):
+    """Beam decode a stream of examples, with continuous batching.
+
+    Rather than decoding a fixed batch of examples to completion, finished examples leave the batch after every
+    step and pending examples take their place. This keeps the batch full when sequence lengths are uneven.
+
+    Examples can either be submitted one at a time (each returning a Future, resolved by calls to `step`), or
+    decoded with the `decode` generator.
+
+    Only the final beam of each example is traced.
+    """
+
+    def __init__(self, beam_decoder, encode, max_examples, beam_size, max_seq_length=50, top_k=5,
+                 sibling_penalty=0., length_penalty=0.):
+        """Construct ContinuousBeamDecoder.
+
+        Args:
+            beam_decoder (BeamDecoder): must be tensorized
+            encode (Callable[[list[Example]], EncoderOutput]): encodes a batch of examples
+            max_examples (int): max number of examples decoded in parallel. The batch holds at most
+                max_examples * beam_size hypotheses.
+            beam_size (int)
+            max_seq_length (int): maximum allowable length of outputted sequences
+            top_k (int): number of beam candidates to show in trace
+            sibling_penalty (float)
+            length_penalty (float)
+        """
+        if not beam_decoder.tensorized:
+            raise ValueError('ContinuousBeamDecoder requires a tensorized BeamDecoder.')
+
+        self.beam_decoder = beam_decoder
+        self.encode = encode
+        self.max_examples = max_examples
+        self.beam_size = beam_size
+        self.max_seq_length = max_seq_length
+        self.top_k = top_k
+        self.sibling_penalty = sibling_penalty
+        self.length_penalty = length_penalty
+
+        self._pending = deque()  # (example, Future) pairs waiting to join the batch
+        self._slots = []  # (example, Future) for each example in the batch
+        self._start_steps = np.zeros(0, dtype=np.int64)  # the time step at which each example joined the batch
+        self._search_state = None
+        self._encoder_output = None  # prepared by the decoder cell, see DecoderCell.prepare
+        self._history = None  # (batch_size, num_steps) tokens of each hypothesis, starting with <start>
+        self._history_start = 0  # the time step of the first column of _history
+        self._t = 0
+
+    def submit(self, example):
+        """Queue an example for decoding.
+
+        Args:
+            example (Example)
+
+        Returns:
+            Future: resolves to a (beam, trace) pair, where beam is a list[list[unicode]] and trace is a
+                BeamDecoderTrace.
+        """
+        future = Future()
+        self._pending.append((example, future))
+        return future
+
+    @property
+    def idle(self):
+        """True if there are no pending examples and the batch is empty."""
+        return not self._pending and not self._slots
+
+    def step(self):
+        """Fill the batch with pending examples and take one step of beam search.
+
+        Resolves the futures of examples which finish on this step.
+        """
+        self._join()
+        if not self._slots:
+            return
+
+        search_state, batch_indices = self.beam_decoder._advance_tensorized(
+            self._encoder_output, self._search_state, self.beam_size, self.sibling_penalty, self.length_penalty)
+        self._history = torch.cat([self._history.index_select(0, batch_indices), search_state.tokens.unsqueeze(1)], 1)
+        self._search_state = search_state
+        self._t += 1
+
+        done = self.beam_decoder._finished_beams(search_state, self.beam_size)
+        done |= (self._t - self._start_steps) >= self.max_seq_length
+        if done.any():
+            self._finish(done)
+
+    def run(self):
+        """Step until all submitted examples have been decoded."""
+        while not self.idle:
+            self.step()
+
+    def decode(self, examples):
+        """Decode examples, yielding results in the order that they finish.
+
+        Args:
+            examples (Iterable[Example])
+
+        Returns:
+            Iterable[(Example, list[list[unicode]], BeamDecoderTrace)]
+        """
+        examples = iter(examples)
+        exhausted = False
+        submitted = []
+        while True:
+            # only read as many examples as can join the batch
+            while not exhausted and len(self._pending) + len(self._slots) < self.max_examples:
+                try:
+                    ex = next(examples)
+                except StopIteration:
+                    exhausted = True
+                    break
+                submitted.append((ex, self.submit(ex)))
+
+            if self.idle:
+                break
+            self.step()
+
+            for ex, future in submitted:
+                if future.done():
+                    beam, trace = future.result()
+                    yield ex, beam, trace
+            submitted = [(ex, future) for ex, future in submitted if not future.done()]
+
+    def _join(self):
+        """Move pending examples into the batch."""
+        num_new = min(self.max_examples - len(self._slots), len(self._pending))
+        if num_new <= 0:
+            return
+
+        new_slots = [self._pending.popleft() for _ in range(num_new)]
+        # only the new examples are prepared. Examples already in the batch keep their prepared encoder output.
+        duplicate = BeamDuplicator(self.beam_size)
+        encoder_output = self.beam_decoder.decoder_cell.prepare(duplicate(self.encode([ex for ex, _ in new_slots])))
+        search_state = self.beam_decoder._initial_search_state(num_new, self.beam_size)
+
+        if not self._slots:
+            self._history_start = self._t
+        start_idx = self.beam_decoder.word_vocab.word2index(START)
+        history = GPUVariable(torch.LongTensor(num_new * self.beam_size,
+                                               self._t - self._history_start + 1).fill_(start_idx))
+
+        if self._slots:
+            concat = BatchConcatenator()
+            search_state = concat([self._search_state, search_state])
+            encoder_output = concat([self._encoder_output, encoder_output])
+            history = torch.cat([self._history, history], 0)
+
+        self._search_state, self._encoder_output, self._history = search_state, encoder_output, history
+        self._slots.extend(new_slots)
+        self._start_steps = np.concatenate([self._start_steps, np.full(num_new, self._t, dtype=np.int64)])
+
+    def _finish(self, done):
+        """Resolve the futures of finished examples, and drop them from the batch.
+
+        Args:
+            done (np.ndarray): boolean array of shape (num_examples,)
+        """
+        beam_size = self.beam_size
+        vocab = self.beam_decoder.word_vocab
+        stop_idx = vocab.word2index(STOP)
+        k = min(self.top_k, beam_size)
+
+        finished = np.flatnonzero(done)
+        rows = BatchSelector(BeamDecoder._beam_rows(finished, beam_size, beam_size))
+        tokens = rows(self._history).data.cpu().numpy()
+        log_probs = rows(self._search_state.sequence_log_probs).data.cpu().numpy()
+
+        for i, ex_idx in enumerate(finished):
+            _, future = self._slots[ex_idx]
+            first_col = self._start_steps[ex_idx] - self._history_start + 1  # skip <start>
+
+            beam = []
+            for path in tokens[i * beam_size:(i + 1) * beam_size, first_col:]:
+                sequence = []
+                for token_idx in path:
+                    if token_idx == stop_idx: break
+                    sequence.append(vocab.index2word(token_idx))
+                beam.append(sequence)
+
+            beam_log_probs = log_probs[i * beam_size:(i + 1) * beam_size]
+            candidates = [BeamCandidate(seq, float(lp)) for seq, lp in izip(beam[:k], beam_log_probs[:k])]
+            future.set_result((beam, BeamDecoderTrace([BeamTrace(candidates)])))
+
+        keep = np.flatnonzero(~done)
+        self._slots = [self._slots[i] for i in keep]
+        self._start_steps = self._start_steps[keep]
+        if not self._slots:
+            self._search_state = self._encoder_output = self._history = None
+            return
+
+        select = BatchSelector(BeamDecoder._beam_rows(keep, beam_size, beam_size))
+        self._search_state, self._encoder_output, self._history = \
+            select([self._search_state, self._encoder_output, self._history])
+
+        # drop history which precedes every example still in the batch
+        offset = int(self._start_steps.min()) - self._history_start
+        if offset > 0:
+            self._history = self._history[:, offset:]
+            self._history_start += offset
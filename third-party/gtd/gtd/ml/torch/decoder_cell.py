@@ -93,4 +93,48 @@ class DecoderCell(Module):
         Returns:
             DecoderCellOutput
         """
+        raise NotImplementedError
+
+    def prepare(self, encoder_output):
+        """Precompute anything that only depends on the encoder output, once before decoding a batch.
+
+        Decoders call this before their first time step, and pass the result to their RNNContextCombiner at every
+        time step. By default, the encoder output is returned unchanged.
+
+        Args:
+            encoder_output (object)
+
+        Returns:
+            object: an encoder output of the same type
+        """
+        return encoder_output
+
+    def step(self, rnn_state, rnn_input, advance):
+        """Advance the RNN by one step, without predicting a distribution over words.
+
+        Together with `vocab_logits`, this lets the vocab projection of many time steps be batched together.
+
+        Args:
+            rnn_state (RNNState): the previous RNN state.
+            rnn_input (RNNInput): any inputs at this time step.
+            advance (Variable): of shape (batch_size, 1). The RNN should advance on example i iff mask[i] == 1.
+
+        Returns:
+            rnn_state (RNNState)
+            query (Variable): of shape (batch_size, query_dim), from which `vocab_logits` predicts the next word
+        """
+        raise NotImplementedError
+
+    def vocab_logits(self, query, candidates=None):
+        """Compute unnormalized log probabilities over the vocab.
+
+        Args:
+            query (Variable): of shape (num_queries, query_dim), as returned by `step`. The queries of several
+                time steps may be stacked together.
+            candidates (Variable): LongTensor of shape (num_candidates,). If not None, only compute the logits of
+                these words.
+
+        Returns:
+            Variable: of shape (num_queries, vocab_size), or (num_queries, num_candidates) if candidates is given
+        """
         raise NotImplementedError
\ No newline at end of file
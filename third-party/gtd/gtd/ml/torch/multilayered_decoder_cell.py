@@ -48,6 +48,11 @@ class MultilayeredDecoderCell(DecoderCell):
         return MultilayeredRNNState([h] * self.num_layers, [c] * self.num_layers)
 
     def forward(self, rnn_state, rnn_input, advance):
+        rnn_state, query = self.step(rnn_state, rnn_input, advance)
+        vocab_probs = self.softmax(self.vocab_logits(query))
+        return DecoderCellOutput(rnn_state, vocab=self.token_embedder.vocab, vocab_probs=vocab_probs)
+
+    def step(self, rnn_state, rnn_input, advance):
         x = torch.cat([rnn_input.x, rnn_input.agenda], 1)
         hs, cs = [], []
         for layer in range(self.num_layers):
@@ -68,12 +73,10 @@ class MultilayeredDecoderCell(DecoderCell):
             else:
                 x = x + h
 
-        query = self.linear(x)
-        word_vocab = self.token_embedder.vocab
-        word_embeds = self.token_embedder.embeds
-        vocab_logits = torch.mm(query, word_embeds.t())  # (batch_size, vocab_size)
-        vocab_probs = self.softmax(vocab_logits)
-
-        rnn_state = MultilayeredRNNState(hs, cs)
+        return MultilayeredRNNState(hs, cs), x
 
-        return DecoderCellOutput(rnn_state, vocab=word_vocab, vocab_probs=vocab_probs)
\ No newline at end of file
+    def vocab_logits(self, query, candidates=None):
+        word_embeds = self.token_embedder.embeds
+        if candidates is not None:
+            word_embeds = word_embeds.index_select(0, candidates)
+        return torch.mm(self.linear(query), word_embeds.t())  # (num_queries, vocab_size)
\ No newline at end of file
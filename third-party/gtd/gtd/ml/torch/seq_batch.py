@@ -1,4 +1,5 @@
 from collections import namedtuple
+from contextlib import contextmanager
 from itertools import izip
 
 import numpy as np
@@ -14,12 +15,25 @@ class SequenceBatch(namedtuple('SequenceBatch', ['values', 'mask']), NamedTupleL
     Attributes:
         values (Variable): of shape (batch_size, max_seq_length, X1, X2, ...)
         mask (Variable[FloatTensor]): of shape (batch_size, max_seq_length)
+
+    The mask is checked to be binary and left-justified on construction, unless validate is False
+    (see seq_batch_validation).
     """
     __slots__ = ()
+    validate = True  # global switch for the mask checks
+
     def __new__(cls, values, mask):
         if not isinstance(values, Variable) or not isinstance(mask, Variable):
             raise ValueError('values and mask must both be of type Variable.')
 
+        if cls.validate:
+            cls._validate_mask(mask)
+
+        self = super(SequenceBatch, cls).__new__(cls, values, mask)
+        return self
+
+    @classmethod
+    def _validate_mask(cls, mask):
         m = mask.data
 
         if len(m.size()) == 0:
@@ -39,9 +53,6 @@ class SequenceBatch(namedtuple('SequenceBatch', ['values', 'mask']), NamedTupleL
             if not all_non_increasing:
                 raise ValueError('Mask must be left-justified:\n{}'.format(mask))
 
-        self = super(SequenceBatch, cls).__new__(cls, values, mask)
-        return self
-
     @classmethod
     def from_sequences(cls, sequences, vocab, min_seq_length=0):
         """Convert a batch of sequences into a SequenceBatch.
@@ -55,22 +66,57 @@ class SequenceBatch(namedtuple('SequenceBatch', ['values', 'mask']), NamedTupleL
         Returns:
             SequenceBatch
         """
-        batch_size = len(sequences)
-        if batch_size == 0:
-            seq_length = 0
-        else:
-            seq_length = max(len(seq) for seq in sequences)  # max seq length in batch
-        seq_length = max(seq_length, min_seq_length)  # make sure it is at least min_seq_length
+        return cls.from_indices([vocab.words2indices(seq) for seq in sequences], min_seq_length)
 
-        shape = (batch_size, seq_length)
-        values = np.zeros(shape, dtype=np.int64)  # pad with zeros
-        mask = np.zeros(shape, dtype=np.float32)
-        for i, seq in enumerate(sequences):
-            for j, word in enumerate(seq):
-                values[i, j] = vocab.word2index(word)
-                mask[i, j] = 1.0
+    @classmethod
+    def from_indices(cls, indices, min_seq_length=0):
+        """Convert a batch of already indexed sequences into a SequenceBatch.
+
+        The mask is correct by construction, so it is not validated.
+
+        Args:
+            indices (list[list[int]|np.ndarray]): one sequence of word indices per example
+            min_seq_length (int): enforce that the Tensor representing the SequenceBatch have at least
+                this many columns.
 
-        return SequenceBatch(GPUVariable(torch.from_numpy(values)), GPUVariable(torch.from_numpy(mask)))
+        Returns:
+            SequenceBatch
+        """
+        return cls.from_index_tensors(cls.index_tensors(indices, min_seq_length))
+
+    @classmethod
+    def from_index_tensors(cls, tensors):
+        """Wrap the output of index_tensors in a SequenceBatch (on GPU, if available), without validating it.
+
+        Args:
+            tensors ((LongTensor, FloatTensor)): values and mask
+
+        Returns:
+            SequenceBatch
+        """
+        values, mask = tensors
+        return cls._make((GPUVariable(values), GPUVariable(mask)))  # _make skips __new__, and with it the mask checks
+
+    @classmethod
+    def index_tensors(cls, indices, min_seq_length=0):
+        """The values and mask of from_indices, as CPU tensors.
+
+        This does not touch the GPU, so it can run in a data loading process.
+
+        Returns:
+            (LongTensor, FloatTensor): values and mask, both of shape (batch_size, seq_length)
+        """
+        lengths = np.array([len(seq) for seq in indices], dtype=np.int64)
+        batch_size = len(lengths)
+        seq_length = max(lengths.max() if batch_size > 0 else 0, min_seq_length)
+
+        mask = np.arange(seq_length)[np.newaxis, :] < lengths[:, np.newaxis]  # (batch_size, seq_length)
+        values = np.zeros((batch_size, seq_length), dtype=np.int64)  # pad with zeros
+        if lengths.sum() > 0:
+            # boolean indexing is row-major, so the flattened sequences fill the mask in order
+            values[mask] = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in indices])
+
+        return torch.from_numpy(values), torch.from_numpy(mask.astype(np.float32))
 
     def split(self):
         """Convert SequenceBatch into a list of Variables, where each element represents one time step.
@@ -219,3 +265,21 @@ class SequenceBatch(namedtuple('SequenceBatch', ['values', 'mask']), NamedTupleL
 
 
 SequenceBatchElement = namedtuple('SequenceBatchElement', ['values', 'mask'])
+
+
+@contextmanager
+def seq_batch_validation(enabled):
+    """Enable or disable the mask checks of SequenceBatch inside this with-block.
+
+    Disabling them saves a few reductions on every construction, on code paths that are trusted to produce
+    valid masks. Not thread-safe.
+
+    Args:
+        enabled (bool)
+    """
+    old_enabled = SequenceBatch.validate
+    SequenceBatch.validate = enabled
+    try:
+        yield
+    finally:
+        SequenceBatch.validate = old_enabled
@@ -39,6 +39,11 @@ class SimpleDecoderCell(DecoderCell):
         return SimpleRNNState(h, c)
 
     def forward(self, rnn_state, rnn_input, advance):
+        rnn_state, query = self.step(rnn_state, rnn_input, advance)
+        vocab_probs = self.softmax(self.vocab_logits(query))
+        return DecoderCellOutput(rnn_state, vocab=self.token_embedder.vocab, vocab_probs=vocab_probs)
+
+    def step(self, rnn_state, rnn_input, advance):
         rnn_input_embed = torch.cat([rnn_input.x, rnn_input.agenda], 1)
         h, c = self.rnn_cell(rnn_input_embed, (rnn_state.h, rnn_state.c))
 
@@ -46,13 +51,11 @@ class SimpleDecoderCell(DecoderCell):
         h = gated_update(rnn_state.h, h, advance)
         c = gated_update(rnn_state.c, c, advance)
 
-        query = self.linear(h)
-        word_vocab = self.token_embedder.vocab
-        word_embeds = self.token_embedder.embeds
-        vocab_logits = torch.mm(query, word_embeds.t())  # (batch_size, vocab_size)
-        vocab_probs = self.softmax(vocab_logits)
-
         # no attention over source, insert and delete embeds
-        rnn_state = SimpleRNNState(h, c)
+        return SimpleRNNState(h, c), h
 
-        return DecoderCellOutput(rnn_state, vocab=word_vocab, vocab_probs=vocab_probs)
\ No newline at end of file
+    def vocab_logits(self, query, candidates=None):
+        word_embeds = self.token_embedder.embeds
+        if candidates is not None:
+            word_embeds = word_embeds.index_select(0, candidates)
+        return torch.mm(self.linear(query), word_embeds.t())  # (num_queries, vocab_size)
\ No newline at end of file
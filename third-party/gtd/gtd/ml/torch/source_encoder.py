@@ -1,13 +1,17 @@
+import re
 from abc import ABCMeta, abstractmethod, abstractproperty
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from itertools import izip
 
+import numpy as np
 import torch
 from gtd.ml.torch.recurrent import tile_state, gated_update
-from torch.nn import Module
+from torch.nn import Module, LSTM, LSTMCell
 from torch.nn import Parameter
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
-from gtd.ml.torch.seq_batch import SequenceBatchElement
+from gtd.ml.torch.seq_batch import SequenceBatch, SequenceBatchElement
+from gtd.ml.torch.utils import GPUVariable, conditional
 
 
 class SourceEncoder(Module):
@@ -107,6 +111,89 @@ class BidirectionalSourceEncoder(SourceEncoder):
         return BidirectionalEncoderOutput(forward_states, backward_states)
 
 
+class FusedBidirectionalSourceEncoder(SourceEncoder):
+    """A BidirectionalSourceEncoder with LSTM cells, which runs both directions over all time steps with a single
+    call to a (cuDNN) torch.nn.LSTM on packed sequences.
+
+    Computes the same states as BidirectionalSourceEncoder(input_dim, hidden_dim, LSTMCell), including at masked
+    time steps: forward states carry the last unmasked state, and backward states hold the initial state.
+    See MultiLayerSourceEncoder.fuse_state_dict to convert the weights of a BidirectionalSourceEncoder.
+    """
+    def __init__(self, input_dim, hidden_dim):
+        super(FusedBidirectionalSourceEncoder, self).__init__()
+
+        if hidden_dim % 2 != 0:
+            raise ValueError('hidden_dim must be even for FusedBidirectionalSourceEncoder.')
+        self._hidden_dim = hidden_dim
+
+        self.lstm = LSTM(input_dim, hidden_dim / 2, num_layers=1, bidirectional=True)
+        # initial states of the forward (index 0) and backward (index 1) directions
+        self.h0 = Parameter(torch.zeros(2, hidden_dim / 2))
+        self.c0 = Parameter(torch.zeros(2, hidden_dim / 2))
+
+    @property
+    def hidden_dim(self):
+        return self._hidden_dim
+
+    def forward(self, input_embeds_list):
+        """Compute bidirectional RNN embeddings.
+
+        Args:
+            input_embeds_list (list[SequenceBatchElement])
+
+        Returns:
+            BidirectionalEncoderOutput
+        """
+        inputs = SequenceBatch.cat(input_embeds_list)
+        forward_states, backward_states = self.encode(inputs)
+        return BidirectionalEncoderOutput(SequenceBatch(forward_states, inputs.mask).split(),
+                                          SequenceBatch(backward_states, inputs.mask).split())
+
+    def encode(self, inputs):
+        """Compute bidirectional RNN embeddings, without splitting into time steps.
+
+        Args:
+            inputs (SequenceBatch): of shape (batch_size, seq_length, input_dim)
+
+        Returns:
+            forward_states (Variable): of shape (batch_size, seq_length, hidden_dim / 2)
+            backward_states (Variable): of shape (batch_size, seq_length, hidden_dim / 2)
+        """
+        batch_size, seq_length = inputs.mask.size()
+        half_dim = self.hidden_dim / 2
+
+        # pack_padded_sequence requires non-empty sequences, sorted from longest to shortest
+        lengths = inputs.mask.data.sum(1).view(-1).long().cpu().numpy()
+        order = np.argsort(-lengths, kind='mergesort')
+        sorted_lengths = [max(int(length), 1) for length in lengths[order]]
+        unorder = GPUVariable(torch.from_numpy(np.argsort(order)))
+        order = GPUVariable(torch.from_numpy(order))
+
+        sorted_values = inputs.values.index_select(0, order).transpose(0, 1)  # (seq_length, batch_size, input_dim)
+        h0 = self.h0.unsqueeze(1).expand(2, batch_size, half_dim).contiguous()
+        c0 = self.c0.unsqueeze(1).expand(2, batch_size, half_dim).contiguous()
+        packed_states, (h_n, _) = self.lstm(pack_padded_sequence(sorted_values, sorted_lengths), (h0, c0))
+        states, _ = pad_packed_sequence(packed_states)  # (max_length, batch_size, hidden_dim)
+
+        states = states.index_select(1, unorder).transpose(0, 1)  # (batch_size, max_length, hidden_dim)
+        if states.size()[1] < seq_length:
+            padding = GPUVariable(torch.zeros(batch_size, seq_length - states.size()[1], self.hidden_dim))
+            states = torch.cat([states, padding], 1)
+        forward_states, backward_states = states[:, :, :half_dim], states[:, :, half_dim:]
+
+        # masked time steps hold the last forward state and the initial backward state, like gated_update
+        non_empty = GPUVariable(torch.from_numpy((lengths > 0).astype(np.float32))).unsqueeze(1)
+        non_empty = non_empty.expand(batch_size, half_dim)
+        last_forward = conditional(non_empty, h_n[0].index_select(0, unorder), tile_state(self.h0[0], batch_size))
+        first_backward = tile_state(self.h0[1], batch_size)
+
+        mask = inputs.mask.unsqueeze(2).expand(batch_size, seq_length, half_dim)
+        fill = lambda state: state.unsqueeze(1).expand(batch_size, seq_length, half_dim)
+        forward_states = conditional(mask, forward_states, fill(last_forward))
+        backward_states = conditional(mask, backward_states, fill(first_backward))
+        return forward_states, backward_states
+
+
 class BidirectionalEncoderOutput(namedtuple('BidirectionalEncoderOutput', ['forward_states', 'backward_states'])):
     """
     Attributes:
@@ -137,7 +224,7 @@ class BidirectionalEncoderOutput(namedtuple('BidirectionalEncoderOutput', ['forw
 
 # TODO(kelvin): test this
 class MultiLayerSourceEncoder(SourceEncoder):
-    def __init__(self, input_dim, hidden_dim, num_layers, rnn_cell_factory):
+    def __init__(self, input_dim, hidden_dim, num_layers, rnn_cell_factory, fused=False):
         """
 
         Args:
@@ -145,16 +232,130 @@ class MultiLayerSourceEncoder(SourceEncoder):
             hidden_dim (int)
             num_layers (int)
             rnn_cell_factory (Callable[[int, int], RNNCell): takes input_dim and output_dim as arguments.
+            fused (bool): if True, each layer is a FusedBidirectionalSourceEncoder, which computes the same states
+                much faster. Requires rnn_cell_factory to be LSTMCell. Weights saved with fused=False can be loaded
+                after converting them with `fuse_state_dict`.
         """
         super(MultiLayerSourceEncoder, self).__init__()
+        if fused and rnn_cell_factory is not LSTMCell:
+            raise ValueError('A fused MultiLayerSourceEncoder only supports LSTMCell.')
+        self.fused = fused
+
         self.layers = []
         for layer in range(num_layers):
             in_dim = input_dim if layer == 0 else hidden_dim
             out_dim = hidden_dim
-            encoder = BidirectionalSourceEncoder(in_dim, out_dim, rnn_cell_factory)
+            if fused:
+                encoder = FusedBidirectionalSourceEncoder(in_dim, out_dim)
+            else:
+                encoder = BidirectionalSourceEncoder(in_dim, out_dim, rnn_cell_factory)
             self.add_module('encoder_layer_{}'.format(layer), encoder)
             self.layers.append(encoder)
 
+    # matches the parameters of a (non-fused) BidirectionalSourceEncoder layer in a state dict
+    _UNFUSED_KEY = re.compile(r'^(.*encoder_layer_\d+\.)(forward|backward)_encoder\.(h0|c0|rnn_cell\.(\w+))$')
+
+    @classmethod
+    def is_unfused_state_dict(cls, state_dict):
+        """Return True if state_dict contains the parameters of a non-fused MultiLayerSourceEncoder."""
+        return any(cls._UNFUSED_KEY.match(key) for key in state_dict)
+
+    @classmethod
+    def _fuse_items(cls, items, stack):
+        """Map values keyed by non-fused parameter names to the fused parameter names.
+
+        Args:
+            items (Iterable[(str, object)]): (parameter name, value) pairs
+            stack (Callable[[object, object], object]): combines the values of the forward and backward initial
+                states into the value of the fused initial states
+
+        Returns:
+            OrderedDict[str, object]
+        """
+        fused = OrderedDict()
+        initial_states = OrderedDict()
+        for key, value in items:
+            match = cls._UNFUSED_KEY.match(key)
+            if match is None:
+                fused[key] = value
+                continue
+
+            prefix, direction, name, cell_param = match.groups()
+            if cell_param is not None:
+                suffix = '_l0' if direction == 'forward' else '_l0_reverse'
+                fused[prefix + 'lstm.' + cell_param + suffix] = value
+            else:
+                initial_states.setdefault(prefix + name, {})[direction] = value
+
+        for key, states in initial_states.iteritems():
+            fused[key] = stack(states['forward'], states['backward'])
+        return fused
+
+    @classmethod
+    def fuse_state_dict(cls, state_dict):
+        """Convert a state dict containing non-fused MultiLayerSourceEncoders to the fused parameter layout.
+
+        Each LSTMCell weight becomes the corresponding weight of the fused layer's LSTM (the gate layout is the same),
+        and the forward and backward initial states are stacked. Keys of other modules, and keys which are already
+        in the fused layout, are left unchanged.
+
+        Args:
+            state_dict (dict[str, Tensor]): e.g. the state dict of a model containing a MultiLayerSourceEncoder
+
+        Returns:
+            OrderedDict[str, Tensor]
+        """
+        return cls._fuse_items(state_dict.iteritems(), lambda forward, backward: torch.stack([forward, backward]))
+
+    @classmethod
+    def fuse_optimizer_state_dict(cls, state_dict, param_names, fused_param_names):
+        """Convert the state dict of an optimizer over non-fused parameters to the fused parameter layout.
+
+        Per-parameter state (e.g. Adam's moving averages) is mapped like the parameters in `fuse_state_dict`.
+
+        Args:
+            state_dict (dict): Optimizer.state_dict() of an optimizer with a single parameter group
+            param_names (list[str]): names of the non-fused parameters, in the order they were passed to the optimizer
+            fused_param_names (list[str]): names of the fused parameters, in the order they are passed to the
+                optimizer that loads the converted state
+
+        Returns:
+            dict
+        """
+        if len(state_dict['param_groups']) != 1:
+            raise ValueError('Can only convert the state of an optimizer with a single parameter group.')
+        group = state_dict['param_groups'][0]
+        if len(group['params']) != len(param_names):
+            raise ValueError('Optimizer has {} parameters, but {} names were given.'.format(
+                len(group['params']), len(param_names)))
+
+        def stack(forward, backward):
+            if forward is None or backward is None:
+                return None
+            return {key: torch.stack([value, backward[key]]) if torch.is_tensor(value) else value
+                    for key, value in forward.iteritems()}
+
+        param_states = [(name, state_dict['state'].get(param_id)) for name, param_id in izip(param_names, group['params'])]
+        fused = cls._fuse_items(param_states, stack)
+        if sorted(fused.keys()) != sorted(fused_param_names):
+            raise ValueError('Optimizer parameters do not match the fused parameters.')
+
+        # parameters are identified by their position in the parameter group
+        fused_group = dict(group, params=range(len(fused_param_names)))
+        fused_state = {i: fused[name] for i, name in enumerate(fused_param_names) if fused[name] is not None}
+        return {'state': fused_state, 'param_groups': [fused_group]}
+
+    def unfused_parameter_names(self):
+        """Return the parameter names of the equivalent non-fused encoder, in the order of its parameters()."""
+        if not self.fused:
+            return [name for name, _ in self.named_parameters()]
+        # SimpleSourceEncoder registers its initial states before the parameters of its LSTMCell
+        encoder_params = ['h0', 'c0'] + ['rnn_cell.' + name for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']]
+        return ['encoder_layer_{}.{}_encoder.{}'.format(layer, direction, name)
+                for layer in range(len(self.layers))
+                for direction in ['forward', 'backward']
+                for name in encoder_params]
+
     @property
     def hidden_dim(self):
         return self.layers[-1].hidden_dim
@@ -168,6 +369,9 @@ class MultiLayerSourceEncoder(SourceEncoder):
         Returns:
             hidden_states_list (list[SequenceBatchElement]) where each element is (batch_size, hidden_dim)
         """
+        if self.fused:
+            return self._forward_fused(input_embeds_list)
+
         for i, layer in enumerate(self.layers):
             if i == 0:
                 prev_hidden_states = input_embeds_list
@@ -188,4 +392,26 @@ class MultiLayerSourceEncoder(SourceEncoder):
                 forward_states = add_residuals(forward_states, new_forward_states)
                 backward_states = add_residuals(backward_states, new_backward_states)
 
-        return BidirectionalEncoderOutput(forward_states, backward_states)
\ No newline at end of file
+        return BidirectionalEncoderOutput(forward_states, backward_states)
+
+    def _forward_fused(self, input_embeds_list):
+        """Same as forward, but keeps the states of all time steps in one tensor between layers."""
+        inputs = SequenceBatch.cat(input_embeds_list)
+        for i, layer in enumerate(self.layers):
+            if i == 0:
+                prev_hidden_states = inputs
+            else:
+                prev_hidden_states = SequenceBatch(torch.cat([forward_states, backward_states], 2), inputs.mask)
+
+            new_forward_states, new_backward_states = layer.encode(prev_hidden_states)
+
+            if i == 0:
+                # no skip connections here, because dimensions don't match
+                forward_states, backward_states = new_forward_states, new_backward_states
+            else:
+                # add residuals to previous hidden states
+                forward_states = forward_states + new_forward_states
+                backward_states = backward_states + new_backward_states
+
+        return BidirectionalEncoderOutput(SequenceBatch(forward_states, inputs.mask).split(),
+                                          SequenceBatch(backward_states, inputs.mask).split())
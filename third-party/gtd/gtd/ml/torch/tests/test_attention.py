@@ -1,9 +1,10 @@
 import numpy as np
 import torch
 
-from gtd.ml.torch.attention import Attention
+from gtd.ml.torch.attention import Attention, MultiAttention
+from gtd.ml.torch.decoder import BatchConcatenator
 from gtd.ml.torch.seq_batch import SequenceBatch
-from gtd.ml.torch.utils import GPUVariable
+from gtd.ml.torch.utils import GPUVariable, random_seed
 from gtd.ml.torch.utils import assert_tensor_equal
 
 
@@ -98,4 +99,47 @@ class TestAttention(object):
 
         attn_out = attn(memory_cells, query)
         assert_tensor_equal(attn_out.weights, manual_weights, decimal=4)
-        assert_tensor_equal(attn_out.context, manual_context, decimal=4)
\ No newline at end of file
+        assert_tensor_equal(attn_out.context, manual_context, decimal=4)
+
+
+class TestMultiAttention(object):
+    def test_matches_attention(self):
+        batch_size, query_dim, attn_dim = 3, 4, 2
+        masks = [
+            [[1, 1, 1], [1, 0, 0], [0, 0, 0]],
+            [[1], [0], [1]],
+        ]
+        with random_seed(0):
+            attentions = [Attention(5, query_dim, attn_dim), Attention(3, query_dim, attn_dim)]
+            memories = [SequenceBatch(GPUVariable(torch.randn(batch_size, len(mask[0]), attn.memory_dim)),
+                                      GPUVariable(torch.FloatTensor(mask)))
+                        for attn, mask in zip(attentions, masks)]
+            query = GPUVariable(torch.randn(batch_size, query_dim))
+
+        multi_attention = MultiAttention(attentions)
+        outputs = multi_attention(multi_attention.precompute(memories), memories, query)
+
+        assert len(outputs) == 2
+        for attn, memory, output in zip(attentions, memories, outputs):
+            expected = attn(memory, query)
+            assert_tensor_equal(output.weights, expected.weights)
+            assert_tensor_equal(output.context, expected.context)
+
+    def test_concatenate_precomputed(self):
+        query_dim, attn_dim = 4, 2
+        with random_seed(0):
+            attention = Attention(5, query_dim, attn_dim)
+            memory_batches = [SequenceBatch(GPUVariable(torch.randn(2, num_cells, 5)),
+                                            GPUVariable(torch.ones(2, num_cells)))
+                              for num_cells in [3, 1]]
+            query = GPUVariable(torch.randn(4, query_dim))
+
+        multi_attention = MultiAttention([attention])
+        concat = BatchConcatenator()
+        memories = concat([[memory] for memory in memory_batches])  # padding cells are masked out
+        precomputed = concat([multi_attention.precompute([memory]) for memory in memory_batches])
+
+        output, = multi_attention(precomputed, memories, query)
+        expected, = multi_attention(multi_attention.precompute(memories), memories, query)
+        assert_tensor_equal(output.weights, expected.weights)
+        assert_tensor_equal(output.context, expected.context)
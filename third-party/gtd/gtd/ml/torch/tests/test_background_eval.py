@@ -0,0 +1,27 @@
+import time
+
+import torch
+from torch.nn import Linear
+
+from gtd.ml.torch.background_eval import BackgroundEvaluator
+
+
+def weight_sum(model, context, request):
+    return context + request + model.weight.data.sum()
+
+
+def test_background_evaluator():
+    evaluator = BackgroundEvaluator(lambda: (Linear(2, 3), 10.), weight_sum)
+    model = Linear(2, 3)
+    model.weight.data.fill_(1.)
+    assert evaluator.submit(model.state_dict(), 100.)
+    model.weight.data.zero_()  # modifying the model after submit does not affect the snapshot
+
+    results = []
+    for _ in range(100):
+        results.extend(evaluator.results())
+        if results:
+            break
+        time.sleep(0.1)
+    evaluator.close()
+    assert results == [(100., 116.)]
@@ -0,0 +1,29 @@
+import cPickle as pickle
+from os.path import join
+
+import torch
+
+from gtd.ml.torch.checkpoint_writer import CheckpointWriter, checkpoint_numbers, load_tensors
+from gtd.ml.torch.utils import assert_tensor_equal
+
+
+class TestCheckpointWriter(object):
+    def test_save(self, tmpdir):
+        checkpoints_dir = str(tmpdir)
+        writer = CheckpointWriter(checkpoints_dir)
+        state = {'weight': torch.ones(2, 3)}
+        writer.save(7, {'model': state}, {'metadata.p': {'train_steps': 7}})
+        state['weight'].zero_()  # modifying the state after save does not affect the checkpoint
+        writer.close()
+
+        path = join(checkpoints_dir, '7.checkpoint')
+        assert_tensor_equal(load_tensors(join(path, 'model'))['weight'].cpu(), torch.ones(2, 3))
+        with open(join(path, 'metadata.p'), 'r') as f:
+            assert pickle.load(f) == {'train_steps': 7}
+
+    def test_retention(self, tmpdir):
+        checkpoints_dir = str(tmpdir)
+        writer = CheckpointWriter(checkpoints_dir, keep_last=2, keep_every=20, background=False)
+        for train_steps in range(10, 70, 10):
+            writer.save(train_steps, {}, {'metadata.p': train_steps})
+        assert checkpoint_numbers(checkpoints_dir) == [20, 40, 50, 60]
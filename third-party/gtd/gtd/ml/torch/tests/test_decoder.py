@@ -0,0 +1,229 @@
+import numpy as np
+import pytest
+import torch
+
+from gtd.ml.torch.decoder import BeamDecoder, ContinuousBeamDecoder, BatchConcatenator, BatchSelector, \
+    BatchShared, BeamDuplicator, SampleDecoder, TrainDecoder, TrainDecoderInput
+from gtd.ml.torch.seq_batch import SequenceBatch
+from gtd.ml.torch.simple_decoder_cell import SimpleDecoderCell, SimpleRNNInput
+from gtd.ml.torch.token_embedder import TokenEmbedder
+from gtd.ml.torch.utils import GPUVariable, random_seed, assert_tensor_equal
+from gtd.ml.utils import temperature_smooth
+from gtd.ml.vocab import WordVocab
+from gtd.utils import Bunch
+
+
+@pytest.fixture
+def token_embedder():
+    vocab = WordVocab(list(WordVocab.SPECIAL_TOKENS) + ['a', 'b', 'c', 'd'])
+    with random_seed(0):
+        arr = np.random.normal(size=(len(vocab), 3)).astype(np.float32)
+    return TokenEmbedder(Bunch(vocab=vocab, array=arr))
+
+
+@pytest.fixture
+def decoder_args(token_embedder):
+    with random_seed(0):
+        decoder_cell = SimpleDecoderCell(token_embedder, hidden_dim=4, input_dim=3, agenda_dim=2)
+    context_combiner = lambda agenda, x: SimpleRNNInput(x=x, agenda=agenda)
+    return decoder_cell, token_embedder, context_combiner
+
+
+@pytest.fixture
+def agenda():
+    with random_seed(0):
+        return GPUVariable(torch.randn(3, 2))
+
+
+class TestBeamDecoder(object):
+    def decode(self, decoder, agenda, sibling_penalty=0., length_penalty=0., prefix_hints=None, traces='full'):
+        examples = range(3)
+        if prefix_hints is None:
+            prefix_hints = [[]] * 3
+        return decoder.decode(examples, agenda, weighted_value_estimators=[], beam_size=4,
+                              prefix_hints=prefix_hints, sibling_penalty=sibling_penalty, max_seq_length=6,
+                              length_penalty=length_penalty, traces=traces)
+
+    @pytest.mark.parametrize('sibling_penalty, length_penalty, prefix_hints', [
+        (0., 0., None),
+        (1., 0., None),
+        (0., 1., None),
+        (0., 0., [['a', 'b'], [], ['c']]),
+    ])
+    def test_tensorized_matches_states(self, decoder_args, agenda, sibling_penalty, length_penalty, prefix_hints):
+        beams, traces = self.decode(BeamDecoder(*decoder_args), agenda, sibling_penalty, length_penalty,
+                                    prefix_hints)
+        tensorized_beams, tensorized_traces = self.decode(BeamDecoder(*decoder_args, tensorized=True), agenda,
+                                                          sibling_penalty, length_penalty, prefix_hints)
+
+        assert tensorized_beams == beams
+        for trace, tensorized_trace in zip(traces, tensorized_traces):
+            assert len(trace.beam_traces) == len(tensorized_trace.beam_traces)
+            for beam_trace, tensorized_beam_trace in zip(trace.beam_traces, tensorized_trace.beam_traces):
+                assert [c.sequence for c in beam_trace.candidates] == \
+                       [c.sequence for c in tensorized_beam_trace.candidates]
+                assert np.allclose([c.log_prob for c in beam_trace.candidates],
+                                   [c.log_prob for c in tensorized_beam_trace.candidates])
+
+    @pytest.mark.parametrize('tensorized', [False, True])
+    def test_trace_modes(self, decoder_args, agenda, tensorized):
+        decoder = BeamDecoder(*decoder_args, tensorized=tensorized)
+        beams, full_traces = self.decode(decoder, agenda, traces='full')
+        final_beams, final_traces = self.decode(decoder, agenda, traces='final')
+        no_trace_beams, no_traces = self.decode(decoder, agenda, traces='none')
+
+        assert final_beams == beams and no_trace_beams == beams
+        assert no_traces is None
+        for full_trace, final_trace in zip(full_traces, final_traces):
+            assert len(final_trace.beam_traces) == 1
+            assert [c.sequence for c in final_trace.beam_traces[0].candidates] == \
+                   [c.sequence for c in full_trace.beam_traces[-1].candidates]
+            assert np.allclose([c.log_prob for c in final_trace.beam_traces[0].candidates],
+                               [c.log_prob for c in full_trace.beam_traces[-1].candidates])
+
+        with pytest.raises(ValueError):
+            self.decode(decoder, agenda, traces='some')
+
+    def test_prefix_hints(self, decoder_args, agenda):
+        prefix_hints = [['a', 'b'], [], ['c']]
+        beams, _ = self.decode(BeamDecoder(*decoder_args, tensorized=True), agenda, prefix_hints=prefix_hints)
+        for beam, prefix in zip(beams, prefix_hints):
+            for sequence in beam:
+                assert sequence[:len(prefix)] == prefix
+
+    def test_continuous_matches_batch(self, decoder_args, agenda):
+        decoder = BeamDecoder(*decoder_args, tensorized=True)
+        beams, traces = self.decode(decoder, agenda)
+
+        encode = lambda examples: agenda.index_select(0, GPUVariable(torch.LongTensor(examples)))
+        continuous = ContinuousBeamDecoder(decoder, encode, max_examples=2, beam_size=4, max_seq_length=6)
+        results = {ex: (beam, trace) for ex, beam, trace in continuous.decode(range(3))}
+
+        assert sorted(results) == range(3)
+        for ex in range(3):
+            beam, trace = results[ex]
+            assert beam == beams[ex]
+            assert np.allclose([c.log_prob for c in trace.beam_traces[-1].candidates],
+                               [c.log_prob for c in traces[ex].beam_traces[-1].candidates])
+        assert continuous.idle
+
+    def test_value_estimators_unsupported(self, decoder_args, agenda):
+        decoder = BeamDecoder(*decoder_args, tensorized=True)
+        with pytest.raises(ValueError):
+            decoder.decode(range(3), agenda, weighted_value_estimators=[(None, 1.)], beam_size=2,
+                           prefix_hints=[[]] * 3, sibling_penalty=0.)
+
+    def test_penalize_extensions_by_rank(self):
+        scores = np.array([[-1., -2., -4.], [-3., -3.5, -5.]], dtype=np.float32)
+        penalized = BeamDecoder.penalize_extensions_by_rank(scores, 2.)
+        assert np.allclose(penalized, [[-1., -4., -8.], [-3., -5.5, -9.]])
+        assert BeamDecoder.penalize_extensions_by_rank(scores, 0.) is scores
+
+    def test_length_normalize(self):
+        log_probs = np.array([[-2., -4.]])
+        lengths = np.array([[1., 7.]])
+        assert BeamDecoder._length_normalize(log_probs, lengths, 0.) is log_probs
+        assert np.allclose(BeamDecoder._length_normalize(log_probs, lengths, 1.), [[-2., -2.]])
+
+
+class TestTrainDecoder(object):
+    def test_per_instance_losses(self, decoder_args, agenda):
+        decoder_cell, token_embedder, context_combiner = decoder_args
+        decoder = TrainDecoder(decoder_cell, token_embedder, context_combiner)
+        decoder_input = TrainDecoderInput([['a', 'b'], [], ['c', 'd', 'a']], token_embedder.vocab)
+        losses = decoder.per_instance_losses(agenda, decoder_input)
+
+        # compare to the loss of each time step
+        rnn_state = decoder_cell.initialize(3)
+        input_embeds = token_embedder.embed_seq_batch(decoder_input.input_words).split()
+        expected = 0.
+        for x, target in zip(input_embeds, decoder_input.target_words.split()):
+            output = decoder_cell(rnn_state, context_combiner(agenda, x.values), x.mask)
+            rnn_state = output.rnn_state
+            expected += output.loss(target.values) * x.mask.squeeze(1)
+
+        assert_tensor_equal(losses, expected, decimal=5)
+
+    def test_input_from_index_tensors(self, token_embedder):
+        vocab = token_embedder.vocab
+        target_words = [['a', 'B'], [], ['c', 'x']]
+        expected = TrainDecoderInput(target_words, vocab)
+        indices = [vocab.words2indices(words) for words in target_words]
+        for decoder_input in [
+            TrainDecoderInput.from_index_tensors(*TrainDecoderInput.index_tensors(target_words, vocab)),
+            TrainDecoderInput.from_index_tensors(*TrainDecoderInput.index_tensors(indices, vocab, indexed=True)),
+        ]:
+            for name in ['input_words', 'target_words']:
+                assert_tensor_equal(getattr(decoder_input, name).values, getattr(expected, name).values)
+                assert_tensor_equal(getattr(decoder_input, name).mask, getattr(expected, name).mask)
+
+    def test_sampled_softmax(self, decoder_args, agenda):
+        decoder_cell, token_embedder, context_combiner = decoder_args
+        exact_decoder = TrainDecoder(decoder_cell, token_embedder, context_combiner)
+        sampled_decoder = TrainDecoder(decoder_cell, token_embedder, context_combiner, num_sampled=2)
+        decoder_input = TrainDecoderInput([['a', 'b'], [], ['c', 'd', 'a']], token_embedder.vocab)
+        exact_losses = exact_decoder.per_instance_losses(agenda, decoder_input)
+
+        # the sampled softmax is only used in training mode
+        sampled_decoder.eval()
+        assert_tensor_equal(sampled_decoder.per_instance_losses(agenda, decoder_input), exact_losses)
+
+        sampled_decoder.train()
+        with random_seed(0):
+            sampled_losses = sampled_decoder.per_instance_losses(agenda, decoder_input)
+        assert np.all(np.isfinite(sampled_losses.data.cpu().numpy()))
+
+    def test_sample_candidates(self):
+        targets = np.array([3, 3, 9, 0])
+        with random_seed(0):
+            candidates, log_q = TrainDecoder._sample_candidates(targets, 10, 5)
+        assert np.all(np.in1d(targets, candidates))
+        assert np.array_equal(candidates, np.unique(candidates))
+        assert np.all(log_q <= 0)
+
+
+def test_batch_concatenator():
+    a = SequenceBatch(GPUVariable(torch.ones(1, 2, 3)), GPUVariable(torch.ones(1, 2)))
+    b = SequenceBatch(GPUVariable(torch.ones(2, 1, 3)), GPUVariable(torch.ones(2, 1)))
+    c = BatchConcatenator()([a, b])
+    assert c.values.size() == (3, 2, 3)
+    assert np.array_equal(c.mask.data.cpu().numpy(), [[1, 1], [1, 0], [1, 0]])
+
+
+def test_batch_shared():
+    shared = BatchShared(GPUVariable(torch.ones(4, 3)))
+    batch = [GPUVariable(torch.arange(0, 2).view(2, 1)), shared]
+
+    selected = BatchSelector(np.array([1]))(batch)
+    duplicated = BeamDuplicator(3)(batch)
+    assert selected[1] is shared and duplicated[1] is shared
+    assert np.array_equal(duplicated[0].data.cpu().numpy().ravel(), [0, 0, 0, 1, 1, 1])
+
+    assert BatchConcatenator()([batch, batch])[1] is shared
+    with pytest.raises(ValueError):
+        BatchConcatenator()([batch, [batch[0], BatchShared(shared.value)]])
+
+
+class TestSampleDecoder(object):
+    def test_sampling_weights(self):
+        probs = torch.FloatTensor([[0.5, 0.3, 0.15, 0.05]])
+        weights = lambda **kwargs: SampleDecoder.sampling_weights(probs, **kwargs).numpy()
+
+        assert np.allclose(weights(), [[0.5, 0.3, 0.15, 0.05]])
+        assert np.allclose(weights(sample_top_k=2), [[0.5, 0.3, 0., 0.]])
+        assert np.allclose(weights(top_p=0.7), [[0.5, 0.3, 0., 0.]])
+        assert np.allclose(weights(top_p=0.1), [[0.5, 0., 0., 0.]])
+
+        smoothed = weights(temperature=0.5)
+        assert np.allclose(smoothed / smoothed.sum(), temperature_smooth(probs.numpy()[0], 0.5))
+
+        with pytest.raises(ValueError):
+            weights(temperature=0.)
+
+    def test_random_seed_restores_on_error(self):
+        before = torch.get_rng_state()
+        with pytest.raises(RuntimeError):
+            with SampleDecoder._random_seed(0):
+                torch.rand(3)
+                raise RuntimeError()
+        assert_tensor_equal(torch.get_rng_state(), before)
@@ -4,8 +4,8 @@ import torch
 from gtd.ml.torch.utils import GPUVariable
 from gtd.ml.torch.utils import assert_tensor_equal
 
-from gtd.ml.torch.seq_batch import SequenceBatch, SequenceBatchElement
-from gtd.ml.vocab import SimpleVocab
+from gtd.ml.torch.seq_batch import SequenceBatch, SequenceBatchElement, seq_batch_validation
+from gtd.ml.vocab import SimpleVocab, Vocab
 
 
 class TestSequenceBatch(object):
@@ -38,11 +38,41 @@ class TestSequenceBatch(object):
                                 [0, 0, 0, 0],
                             ], dtype=np.float32))
 
+    def test_from_sequences_base_vocab(self, sequences, vocab):
+        class DictVocab(Vocab):
+            def __init__(self, word2index):
+                self._word2index = word2index
+
+            def word2index(self, w):
+                return self._word2index[w]
+
+            def index2word(self, i):
+                raise NotImplementedError()
+
+        seq_batch = SequenceBatch.from_sequences(sequences, DictVocab({'a': 1, 'b': 2, 'c': 3}))
+        expected = SequenceBatch.from_sequences(sequences, vocab)
+        assert_tensor_equal(seq_batch.values, expected.values)
+
     def test_min_seq_length(self, vocab):
         seq_batch = SequenceBatch.from_sequences([[], [], []], vocab, min_seq_length=2)
         assert_tensor_equal(seq_batch.values, np.zeros((3, 2)))
         assert_tensor_equal(seq_batch.mask, np.zeros((3, 2)))
 
+    def test_from_indices(self, sequences, vocab):
+        indices = [np.array(vocab.words2indices(seq)) for seq in sequences]
+        seq_batch = SequenceBatch.from_indices(indices, min_seq_length=5)
+        expected = SequenceBatch.from_sequences(sequences, vocab, min_seq_length=5)
+        assert_tensor_equal(seq_batch.values, expected.values)
+        assert_tensor_equal(seq_batch.mask, expected.mask)
+
+    def test_validation_switch(self):
+        non_binary_mask = GPUVariable(torch.FloatTensor([[1, 0.5]]))
+        with seq_batch_validation(False):
+            SequenceBatch(non_binary_mask, non_binary_mask)  # should not raise any errors
+
+        with pytest.raises(ValueError):
+            SequenceBatch(non_binary_mask, non_binary_mask)
+
     def test_mask_validation(self):
         mask = GPUVariable(torch.FloatTensor([[1, 0, 0, 0],
                                               [1, 1, 0, 0],
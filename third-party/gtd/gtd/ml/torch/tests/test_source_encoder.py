@@ -1,11 +1,14 @@
 import numpy as np
 import pytest
+import torch
+from torch import optim
+from torch.nn import LSTMCell
 
 from gtd.ml.torch.recurrent import AdditionCell
 from gtd.ml.torch.seq_batch import SequenceBatch
-from gtd.ml.torch.source_encoder import BidirectionalSourceEncoder
+from gtd.ml.torch.source_encoder import BidirectionalSourceEncoder, MultiLayerSourceEncoder
 from gtd.ml.torch.token_embedder import TokenEmbedder
-from gtd.ml.torch.utils import assert_tensor_equal
+from gtd.ml.torch.utils import assert_tensor_equal, random_seed
 from gtd.ml.vocab import SimpleVocab
 from gtd.utils import Bunch
 
@@ -61,3 +64,75 @@ class TestBidirectionalSourceEncoder(object):
         assert_tensor_equal(forward, [[6], [16], [0]])
         assert_tensor_equal(backward, [[6], [16], [0]])
 
+
+class TestFusedMultiLayerSourceEncoder(object):
+    @pytest.fixture
+    def input_embeds_list(self):
+        sequences = [
+            [1, 2, 3],
+            [8, 4, 2, 1, 1],
+            [],
+        ]
+        vocab = SimpleVocab([1, 2, 3, 4, 5, 6, 7, 8])
+        with random_seed(0):
+            array = np.random.normal(size=(len(vocab), 3)).astype(np.float32)
+        token_embedder = TokenEmbedder(Bunch(vocab=vocab, array=array))
+        # an extra all-masked time step at the end
+        seq_embeds = token_embedder.embed_seq_batch(SequenceBatch.from_sequences(sequences, vocab, min_seq_length=6))
+        return seq_embeds.split()
+
+    def test_matches_unfused(self, input_embeds_list):
+        with random_seed(0):
+            encoder = MultiLayerSourceEncoder(3, 4, 3, LSTMCell)
+            # perturb the initial states, which are initialized to zero
+            for param in encoder.parameters():
+                param.data.normal_()
+        fused_encoder = MultiLayerSourceEncoder(3, 4, 3, LSTMCell, fused=True)
+        fused_encoder.load_state_dict(MultiLayerSourceEncoder.fuse_state_dict(encoder.state_dict()))
+
+        output = encoder(input_embeds_list)
+        fused_output = fused_encoder(input_embeds_list)
+
+        for states, fused_states in zip(output, fused_output):
+            assert len(states) == len(fused_states)
+            for state, fused_state in zip(states, fused_states):
+                assert_tensor_equal(state.values, fused_state.values, decimal=5)
+                assert_tensor_equal(state.mask, fused_state.mask)
+        for final_state, fused_final_state in zip(output.final_states, fused_output.final_states):
+            assert_tensor_equal(final_state, fused_final_state, decimal=5)
+
+    def test_fuse_state_dict(self):
+        encoder = MultiLayerSourceEncoder(3, 4, 2, LSTMCell)
+        fused_encoder = MultiLayerSourceEncoder(3, 4, 2, LSTMCell, fused=True)
+        fused = MultiLayerSourceEncoder.fuse_state_dict(encoder.state_dict())
+        assert sorted(fused.keys()) == sorted(fused_encoder.state_dict().keys())
+        assert fused['encoder_layer_1.h0'].size() == (2, 2)
+        # already fused keys are unchanged
+        assert MultiLayerSourceEncoder.fuse_state_dict(fused).keys() == fused.keys()
+
+    def test_fuse_optimizer_state_dict(self, input_embeds_list):
+        encoder = MultiLayerSourceEncoder(3, 4, 2, LSTMCell)
+        fused_encoder = MultiLayerSourceEncoder(3, 4, 2, LSTMCell, fused=True)
+        unfused_names = [name for name, _ in encoder.named_parameters()]
+        assert fused_encoder.unfused_parameter_names() == unfused_names
+
+        optimizer = optim.Adam(encoder.parameters())
+        forward_states, backward_states = encoder(input_embeds_list)
+        (forward_states[-1].values.sum() + backward_states[0].values.sum()).backward()
+        optimizer.step()
+
+        fused_names = [name for name, _ in fused_encoder.named_parameters()]
+        fused_state = MultiLayerSourceEncoder.fuse_optimizer_state_dict(optimizer.state_dict(), unfused_names,
+                                                                        fused_names)
+        fused_optimizer = optim.Adam(fused_encoder.parameters())
+        fused_optimizer.load_state_dict(fused_state)
+
+        params = dict(encoder.named_parameters())
+        fused_params = dict(fused_encoder.named_parameters())
+        state = lambda name: optimizer.state[params[name]]['exp_avg']
+        fused_state = lambda name: fused_optimizer.state[fused_params[name]]['exp_avg']
+        assert_tensor_equal(fused_state('encoder_layer_1.lstm.weight_ih_l0_reverse'),
+                            state('encoder_layer_1.backward_encoder.rnn_cell.weight_ih'))
+        assert_tensor_equal(fused_state('encoder_layer_0.h0'),
+                            torch.stack([state('encoder_layer_0.forward_encoder.h0'),
+                                         state('encoder_layer_0.backward_encoder.h0')]))
@@ -1,7 +1,13 @@
 import pytest
 import torch
 
-from gtd.ml.torch.utils import expand_dims_for_broadcast, assert_tensor_equal, is_binary
+import numpy as np
+
+from torch.autograd import Variable
+from torch.nn import Parameter
+
+from gtd.ml.torch.utils import expand_dims_for_broadcast, assert_tensor_equal, is_binary, token_budget_batches, \
+    BatchSchedule, clip_grad_norm_finite, finite_grads
 
 
 def test_expand_dims_for_broadcast():
@@ -25,4 +31,51 @@ def test_is_binary():
     t3 = torch.FloatTensor([0, 0.1, 0.2, 0])
     assert is_binary(t1)
     assert not is_binary(t2)
-    assert not is_binary(t3)
\ No newline at end of file
+    assert not is_binary(t3)
+
+
+def test_token_budget_batches():
+    sizes = np.array([[5, 1], [1, 1], [2, 2], [1, 0], [9, 9]])
+    batches = token_budget_batches(sizes, max_tokens=12)
+
+    assert sorted(np.concatenate(batches).tolist()) == range(5)
+    assert [b.tolist() for b in batches] == [[3, 1, 2], [0], [4]]  # [4] alone exceeds the budget
+
+    capped = token_budget_batches(sizes, max_tokens=12, max_batch_size=2)
+    assert [b.tolist() for b in capped] == [[3, 1], [2], [0], [4]]
+
+
+def test_batch_schedule():
+    schedule = BatchSchedule(5, seed=0)
+    first_epoch = list(schedule.epoch_batches())
+    assert sorted(first_epoch) == range(5)
+    assert (schedule.epoch, schedule.cursor) == (1, 0)
+
+    # resume in the middle of the second epoch
+    full = BatchSchedule(5, seed=0, epoch=1)
+    resumed = BatchSchedule(5, seed=0, epoch=1, cursor=2)
+    assert list(resumed.epoch_batches()) == list(full.epoch_batches())[2:]
+
+
+def test_clip_grad_norm_finite():
+    params = [Parameter(torch.zeros(2)), Parameter(torch.zeros(1)), Parameter(torch.zeros(3))]
+    params[0].grad = Variable(torch.FloatTensor([3, 0]))
+    params[1].grad = Variable(torch.FloatTensor([4]))
+    # params[2] has no gradient
+
+    norm, finite = clip_grad_norm_finite(params, 2.5)
+    assert finite and np.isclose(norm, 5.)
+    assert_tensor_equal(params[0].grad, [1.5, 0])
+    assert_tensor_equal(params[1].grad, [2])
+
+    # the squared norm exceeds the float32 range, but the gradients are finite, so they are clipped
+    params[0].grad.data.fill_(3e19)
+    norm, finite = clip_grad_norm_finite(params, 1.)
+    assert finite and np.isclose(norm, 3e19 * 2 ** 0.5)
+    assert finite_grads(params)
+    assert_tensor_equal(params[0].grad, [2 ** -0.5, 2 ** -0.5])
+
+    params[1].grad.data[0] = float('nan')
+    norm, finite = clip_grad_norm_finite(params, 2.5)
+    assert not finite
+    assert not finite_grads(params)
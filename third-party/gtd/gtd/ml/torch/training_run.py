@@ -1,9 +1,8 @@
 from datetime import datetime
-import numpy as np
-from torch.nn.utils import clip_grad_norm
 
 from gtd.ml.training_run import TrainingRun
 from gtd.ml.torch.checkpoints import Checkpoints
+from gtd.ml.torch.utils import finite_grads, clip_grad_norm_finite
 from gtd.utils import cached_property
 
 
@@ -14,7 +13,10 @@ class TorchTrainingRun(TrainingRun):
 
     @cached_property
     def checkpoints(self):
-        return Checkpoints(self.workspace.checkpoints)
+        eval_config = self.config.eval
+        return Checkpoints(self.workspace.checkpoints, keep_last=eval_config.get('keep_checkpoints', 0),
+                           keep_every=eval_config.get('keep_checkpoint_every', 0),
+                           background=eval_config.get('async_checkpoints', False))
 
     @classmethod
     def _finite_grads(cls, parameters):
@@ -26,11 +28,7 @@ class TorchTrainingRun(TrainingRun):
         Return:
             bool
         """
-        for param in parameters:
-            if param.grad is None: continue
-            if not np.isfinite(param.grad.data.sum()):
-                return False
-        return True
+        return finite_grads(parameters)
 
     @classmethod
     def _take_grad_step(cls, train_state, loss, max_grad_norm=float('inf')):
@@ -50,23 +48,21 @@ class TorchTrainingRun(TrainingRun):
         optimizer.zero_grad()
         loss.backward()
 
-        # clip according to the max allowed grad norm
-        grad_norm = clip_grad_norm(model.parameters(), max_grad_norm, norm_type=2)
+        # clip according to the max allowed grad norm, and check that the grads are finite
+        grad_norm, finite = clip_grad_norm_finite(model.parameters(), max_grad_norm)
         # (this returns the gradient norm BEFORE clipping)
 
         # track the gradient norm over time
         train_state.track_grad_norms(grad_norm)
 
-        finite_grads = cls._finite_grads(model.parameters())
-
         # take a step if the grads are finite
-        if finite_grads:
+        if finite:
             optimizer.step()
 
         # increment step count
         train_state.increment_train_steps()
 
-        return finite_grads
+        return finite
 
     def _update_metadata(self, train_state):
         self.metadata['last_seen'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
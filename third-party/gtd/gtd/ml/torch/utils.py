@@ -1,5 +1,6 @@
 import random
 from contextlib import contextmanager
+from itertools import izip
 
 import numpy as np
 from numpy.testing import assert_array_almost_equal
@@ -115,6 +116,150 @@ def similar_size_batches(examples, batch_size, size=lambda x: len(x.target_words
     return batches
 
 
+def token_budget_batches(sizes, max_tokens, max_batch_size=None):
+    """Group examples into batches of similar shape, with a cap on the number of padded tokens per batch.
+
+    Each example has a length per field (e.g. source, target and edit sets). Every field is padded to its longest
+    length within the batch, so a batch costs batch_size * sum(max field lengths) tokens. Examples are sorted by
+    their total length (then by each field), and batches are filled greedily in that order. Short examples thus
+    form large batches, and long examples small ones.
+
+    An example that exceeds max_tokens on its own forms a batch by itself.
+
+    Args:
+        sizes (np.ndarray): of shape (num_examples, num_fields), the length of each field of each example
+        max_tokens (int): max padded tokens per batch
+        max_batch_size (int): max examples per batch. If None, only max_tokens applies.
+
+    Returns:
+        list[np.ndarray]: example indices of each batch
+    """
+    assert max_tokens >= 1
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(len(sizes), -1)
+    order = np.lexsort(tuple(sizes.T[::-1]) + (sizes.sum(axis=1),))  # the last key is the primary one
+
+    batches = []
+    start = 0
+    batch_max = None
+    for pos, size in enumerate(sizes[order].tolist()):
+        new_max = size if batch_max is None else [max(a, b) for a, b in izip(batch_max, size)]
+        batch_size = pos - start + 1
+        too_big = batch_size * sum(new_max) > max_tokens or (max_batch_size is not None and batch_size > max_batch_size)
+        if too_big and pos > start:
+            batches.append(order[start:pos])
+            start = pos
+            new_max = size
+        batch_max = new_max
+
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+class BatchSchedule(object):
+    """A deterministic, resumable order over a fixed list of batches.
+
+    Every epoch visits the batches in a random permutation, which only depends on the seed and the epoch number.
+    So the position in training data is fully described by (epoch, cursor), and can be restored from them.
+    """
+
+    def __init__(self, num_batches, seed, epoch=0, cursor=0):
+        """
+
+        Args:
+            num_batches (int)
+            seed (int)
+            epoch (int): epoch to start from
+            cursor (int): number of batches of that epoch which were already consumed
+        """
+        assert num_batches >= 1
+        self.num_batches = num_batches
+        self.seed = seed
+        self.epoch = epoch
+        self.cursor = cursor
+
+    def order(self, epoch):
+        """The batch permutation of an epoch.
+
+        Returns:
+            np.ndarray: of shape (num_batches,)
+        """
+        return np.random.RandomState([self.seed, epoch]).permutation(self.num_batches)
+
+    def epoch_batches(self):
+        """Yield the remaining batch indices of the current epoch, then move on to the next epoch.
+
+        The cursor advances as each index is yielded.
+        """
+        order = self.order(self.epoch)
+        while self.cursor < self.num_batches:
+            i = order[self.cursor]
+            self.cursor += 1
+            yield i
+
+        self.epoch += 1
+        self.cursor = 0
+
+
+def _grad_norms(parameters):
+    """Return a 1D DoubleTensor holding the 2-norm of the gradient of each parameter that has one (or None if none do).
+
+    The norms stay on the device, so computing them does not sync with the host. Each norm is reduced by torch over
+    the gradient itself, without copying it. Only the per-parameter norms are cast to double, so that combining
+    them does not overflow to inf when the gradients are large but finite. A norm is NaN or inf if its gradient
+    contains a NaN or inf.
+    """
+    norms = [param.grad.data.view(-1).norm(2, 0) for param in parameters if param.grad is not None]
+    if len(norms) == 0:
+        return None
+    return torch.cat(norms).double()
+
+
+def finite_grads(parameters):
+    """Check that all parameter gradients are finite, with a single host sync.
+
+    Parameters without gradients are ignored.
+
+    Args:
+        parameters (Iterable[Parameter])
+
+    Returns:
+        bool
+    """
+    norms = _grad_norms(parameters)
+    return norms is None or np.isfinite(norms.sum())
+
+
+def clip_grad_norm_finite(parameters, max_norm):
+    """Clip the global 2-norm of the gradients to max_norm, and check that they are finite.
+
+    Equivalent to torch.nn.utils.clip_grad_norm followed by finite_grads, but both come from a single reduction, so
+    there is only one host sync. A NaN or inf gradient makes the norm non-finite, in which case the gradients are
+    left untouched. Per-parameter norms are combined in double precision, so a huge but finite norm is still clipped.
+
+    Args:
+        parameters (Iterable[Parameter])
+        max_norm (float): may be inf, to just measure the norm
+
+    Returns:
+        (float, bool): the gradient norm BEFORE clipping, and whether the gradients are finite
+    """
+    parameters = list(parameters)
+    norms = _grad_norms(parameters)
+    if norms is None:
+        return 0., True
+
+    total_norm = (norms * norms).sum() ** 0.5  # the only host sync
+    finite = bool(np.isfinite(total_norm))
+    if finite:
+        clip_coef = max_norm / (total_norm + 1e-6)
+        if clip_coef < 1:
+            for param in parameters:
+                if param.grad is not None:
+                    param.grad.data.mul_(clip_coef)
+    return total_norm, finite
+
+
 def print_module_parameters(m, depth=0):
     """Print out all parameters of a module."""
     tabs = '\t' * depth
@@ -1,6 +1,9 @@
 import codecs
+import hashlib
+import os
 from abc import ABCMeta, abstractmethod
 from collections import Mapping
+from os.path import join, exists
 
 import numpy as np
 
@@ -20,6 +23,9 @@ class Vocab(object):
     def index2word(self, i):
         pass
 
+    def words2indices(self, words):
+        return [self.word2index(w) for w in words]
+
 
 class SimpleVocab(Vocab, EqualityMixin):
     """A simple vocabulary object."""
@@ -135,6 +141,12 @@ class WordVocab(SimpleVocab):
         except KeyError:
             return sup.word2index(self.UNK)
 
+    def words2indices(self, words):
+        """Map a list of words to integers, like word2index but without a method call per word."""
+        word2index = self._word2index
+        unk = word2index[self.UNK]
+        return [word2index.get(w.lower(), unk) for w in words]
+
 
 class SimpleEmbeddings(Mapping):
     def __init__(self, array, vocab):
@@ -168,17 +180,75 @@ class SimpleEmbeddings(Mapping):
         return self.array.shape[1]
 
     @classmethod
-    def from_file(cls, file_path, embed_dim, vocab_size=None):
+    def from_file(cls, file_path, embed_dim, vocab_size=None, cache=True):
         """Load word embeddings.
 
         Args:
             file_path (str)
             embed_dim (int): expected embed_dim
             vocab_size (int): max # of words in the vocab. If not specified, uses all available vectors in file.
+            cache (bool): keep a binary copy of the loaded embeddings in a directory next to file_path, and load
+                from it when possible (see _cache_paths). The array is then memory-mapped (read-only).
         """
         if vocab_size is None:
             vocab_size = num_lines(file_path)
 
+        if cache:
+            array_path, vocab_path = cls._cache_paths(file_path, embed_dim, vocab_size)
+            if exists(array_path) and exists(vocab_path):
+                with codecs.open(vocab_path, 'r', encoding='utf-8') as f:
+                    words = [line[:-1] for line in f]  # strip newline
+                return cls(np.load(array_path, mmap_mode='r'), SimpleVocab(words))
+
+        embeddings = cls._parse_file(file_path, embed_dim, vocab_size)
+        if cache:
+            try:
+                embeddings._save_cache(array_path, vocab_path)
+            except (IOError, OSError) as e:
+                print 'Could not cache embeddings: {}'.format(e)
+        return embeddings
+
+    @classmethod
+    def _cache_paths(cls, file_path, embed_dim, vocab_size):
+        """Paths of the cached array and vocab of an embeddings file.
+
+        The cache is keyed by a fingerprint of the file, vocab_size and embed_dim. To keep lookups fast on
+        multi-GB files, the fingerprint hashes the file size and its first and last MB, rather than the whole file.
+
+        Returns:
+            (str, str): array path (.npy) and vocab path
+        """
+        chunk_size = 2 ** 20
+        file_hash = hashlib.md5(str(os.path.getsize(file_path)))
+        with open(file_path, 'rb') as f:
+            file_hash.update(f.read(chunk_size))
+            f.seek(max(os.path.getsize(file_path) - chunk_size, 0))
+            file_hash.update(f.read(chunk_size))
+
+        cache_dir = file_path + '.cache'
+        key = '{}-{}-{}'.format(file_hash.hexdigest(), vocab_size, embed_dim)
+        return join(cache_dir, key + '.npy'), join(cache_dir, key + '.vocab.txt')
+
+    def _save_cache(self, array_path, vocab_path):
+        """Write the array and vocab to the cache. Each file is renamed into place once complete."""
+        cache_dir = os.path.dirname(array_path)
+        if not exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # the vocab is written last, so that a complete cache entry always has both files
+        with open(array_path + '.tmp', 'wb') as f:
+            np.save(f, self.array)
+        os.rename(array_path + '.tmp', array_path)
+
+        with codecs.open(vocab_path + '.tmp', 'w', encoding='utf-8') as f:
+            for word in self.vocab:
+                f.write(word)
+                f.write(u'\n')
+        os.rename(vocab_path + '.tmp', vocab_path)
+
+    @classmethod
+    def _parse_file(cls, file_path, embed_dim, vocab_size):
+        """Parse a text embeddings file (one word and its vector per line)."""
         words = []
         embeds = []
         with codecs.open(file_path, 'r', encoding='utf-8') as f:
@@ -186,7 +256,7 @@ class SimpleEmbeddings(Mapping):
             for i, line in enumerate(lines):
                 if i == vocab_size: break
                 tokens = line.split()
-                word, embed = tokens[0], np.array([float(tok) for tok in tokens[1:]], dtype=np.float32)
+                word, embed = tokens[0], np.array(tokens[1:], dtype=np.float32)
                 if len(embed) != embed_dim:
                     raise ValueError('expected {} dims, got {} dims'.format(embed_dim, len(embed)))
                 words.append(word)
@@ -1,10 +1,11 @@
+import math
 from unittest import TestCase
 from os.path import join
 
 import pytest
 from gtd.text import PhraseMatcher
 from gtd.utils import FileMemoized, SimpleExecutor, as_batches, Failure, NestedDict, EqualityMixinSlots, \
-    memoize_with_key_fxn, DictMemoized, ranks, truncated, ClassCounter
+    memoize_with_key_fxn, DictMemoized, ranks, truncated, ClassCounter, batch_bleu, bleu, index_tokens
 
 
 def test_as_batches():
@@ -30,6 +31,33 @@ def test_ranks():
     assert ranks(scores, ascending=False) == [3, 5, 4, 1, 2]
 
 
+class TestBleu(object):
+    pairs = [
+        ('the cat sat on the mat', 'the cat sat on the mat', 1.),
+        ('', '', 1.),
+        ('a', '', 0.),
+        ('a b c d', 'a b', 0.3679),  # brevity penalty exp(1 - 4/2)
+        ('a b', 'b a', 0.),  # no matching bigram
+        ('a a a', 'a a a a', 0.63),  # clipped counts: (3/4 * 2/3 * 1/2) ** (1/3)
+    ]
+
+    def test_sentence(self):
+        references, predictions = index_tokens([ref.split() for ref, _, _ in self.pairs],
+                                               [pred.split() for _, pred, _ in self.pairs])
+        assert list(batch_bleu(references, predictions).sentence) == [score for _, _, score in self.pairs]
+        assert [bleu(ref.split(), pred.split()) for ref, pred, _ in self.pairs] == \
+               [score for _, _, score in self.pairs]
+
+    def test_corpus(self):
+        references, predictions = index_tokens([ref.split() for ref, _, _ in self.pairs[:4]],
+                                               [pred.split() for _, pred, _ in self.pairs[:4]])
+        # n-gram precisions over the corpus: 8/10, 6/8, 4/7, 3/6 (each pair counts at least 1 n-gram for each n)
+        # brevity penalty: exp(1 - 11/8)
+        expected = round(math.exp(1. - 11. / 8) * (8. / 10 * 6. / 8 * 4. / 7 * 3. / 6) ** 0.25, 4)
+        assert batch_bleu(references, predictions).corpus == expected
+        assert batch_bleu([[0, 1]], [[1, 0]]).corpus == 0.
+
+
 class TestUtils(TestCase):
 
     def test_phrase_matcher(self):
@@ -13,7 +13,7 @@ import types
 import json
 import warnings
 from abc import ABCMeta, abstractmethod, abstractproperty
-from collections import OrderedDict, defaultdict, MutableMapping, Mapping
+from collections import OrderedDict, defaultdict, MutableMapping, Mapping, namedtuple
 from contextlib import contextmanager
 
 import numpy as np
@@ -986,23 +986,159 @@ def softmax(logits):
 def bleu(reference, predict):
     """Compute sentence-level bleu score.
 
+    Equals NLTK's sentence_bleu with emulate_multibleu=True, using uniform weights on up to 4-gram precisions
+    (see batch_bleu).
+
     Args:
         reference (list[str])
         predict (list[str])
     """
-    from nltk.translate import bleu_score
+    references, predictions = index_tokens([reference], [predict])
+    return float(batch_bleu(references, predictions).sentence[0])
 
-    if len(predict) == 0:
-        if len(reference) == 0:
-            return 1.0
-        else:
-            return 0.0
 
-    # TODO(kelvin): is this quite right?
-    # use a maximum of 4-grams. If 4-grams aren't present, use only lower n-grams.
-    n = min(4, len(reference), len(predict))
-    weights = tuple([1. / n] * n)  # uniform weight on n-gram precisions
-    return bleu_score.sentence_bleu([reference], predict, weights, emulate_multibleu=True)
+def index_tokens(*sequence_lists):
+    """Replace the tokens of several lists of sequences by integer ids, shared by all lists.
+
+    The ids are only meaningful within one call, e.g. to compute BLEU with batch_bleu.
+
+    Args:
+        *sequence_lists (list[list[object]]): sequences of hashable tokens
+
+    Returns:
+        tuple[list[list[int]]]: one list of id sequences per argument
+    """
+    ids = {}
+    to_ids = lambda seq: [ids.setdefault(token, len(ids)) for token in seq]
+    return tuple([to_ids(seq) for seq in sequences] for sequences in sequence_lists)
+
+
+_NGRAM_HASH_BASE = 1000003  # multiplier of the polynomial n-gram hash (int64 overflow wraps around)
+
+
+def _ngram_hashes(sequences, n):
+    """Hash every n-gram of a batch of integer sequences, together with the index of its sequence.
+
+    Equal n-grams of the same sequence get equal hashes. Distinct ones collide with negligible probability.
+
+    Args:
+        sequences (list[list[int]])
+        n (int)
+
+    Returns:
+        hashes (np.ndarray): int64 array, one entry per n-gram (n-grams of sequence 0 first, then 1, ...)
+        seq_indices (np.ndarray): index of the sequence of each n-gram
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    num_ngrams = np.maximum(lengths - n + 1, 0)
+    total = int(num_ngrams.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    tokens = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences if len(seq) > 0])
+    seq_indices = np.repeat(np.arange(len(sequences)), num_ngrams)
+    # position in tokens of the first token of each n-gram
+    ngram_starts = np.cumsum(num_ngrams) - num_ngrams
+    starts = (np.cumsum(lengths) - lengths)[seq_indices] + np.arange(total) - ngram_starts[seq_indices]
+
+    hashes = seq_indices.copy()
+    for k in range(n):
+        hashes = hashes * _NGRAM_HASH_BASE + tokens[starts + k]
+    return hashes, seq_indices
+
+
+def _clipped_ngram_matches(references, predictions, n):
+    """For each (reference, prediction) pair, count the n-grams of prediction that match reference.
+
+    Each n-gram counts at most as many times as it occurs in the reference (as in BLEU's modified precision).
+
+    Returns:
+        np.ndarray: int64 array of shape (len(predictions),)
+    """
+    pred_hashes, pred_indices = _ngram_hashes(predictions, n)
+    ref_hashes, _ = _ngram_hashes(references, n)
+    matches = np.zeros(len(predictions), dtype=np.int64)
+    if len(pred_hashes) == 0 or len(ref_hashes) == 0:
+        return matches
+
+    pred_keys, first, pred_counts = np.unique(pred_hashes, return_index=True, return_counts=True)
+    ref_keys, ref_counts = np.unique(ref_hashes, return_counts=True)
+    positions = np.minimum(np.searchsorted(ref_keys, pred_keys), len(ref_keys) - 1)
+    in_ref = ref_keys[positions] == pred_keys
+    clipped = np.where(in_ref, np.minimum(pred_counts, ref_counts[positions]), 0)
+    np.add.at(matches, pred_indices[first], clipped)
+    return matches
+
+
+class BleuScores(namedtuple('BleuScores', ['sentence', 'corpus'])):
+    """BLEU scores of a batch of (reference, prediction) pairs.
+
+    Attributes:
+        sentence (np.ndarray): float array of the sentence-level BLEU of each pair (see bleu)
+        corpus (float): corpus-level BLEU of all pairs
+    """
+    pass
+
+
+def batch_bleu(references, predictions, max_n=4):
+    """Compute sentence-level and corpus-level BLEU of many (reference, prediction) pairs at once.
+
+    Sequences are lists of integer ids (see index_tokens), and n-grams are counted with vectorized hashing.
+    Scores match NLTK's sentence_bleu and corpus_bleu with emulate_multibleu=True (one reference per prediction):
+    - a score is 0 if any of its n-gram precisions is 0, and scores are rounded to 4 decimals.
+    - a sentence score uses uniform weights on n-gram precisions up to n = min(max_n, len(reference),
+        len(prediction)). It is 1 if both sequences are empty, and 0 if only one is.
+    - the corpus score uses uniform weights on n-gram precisions up to max_n, with n-gram counts and lengths
+        summed over all pairs.
+
+    Args:
+        references (list[list[int]])
+        predictions (list[list[int]])
+        max_n (int): use a maximum of max_n-grams
+
+    Returns:
+        BleuScores
+    """
+    assert len(references) == len(predictions)
+    ref_lengths = np.array([len(seq) for seq in references], dtype=np.int64)
+    pred_lengths = np.array([len(seq) for seq in predictions], dtype=np.int64)
+    # use a maximum of max_n-grams. If they aren't present, use only lower n-grams.
+    orders = np.minimum(np.minimum(ref_lengths, pred_lengths), max_n)
+    weights = 1. / np.maximum(orders, 1)  # uniform weight on n-gram precisions
+
+    log_precisions = np.zeros(len(predictions))
+    no_match = orders == 0
+    corpus_log_precision = 0.
+    corpus_no_match = len(predictions) == 0
+    for n in range(1, max_n + 1):
+        matches = _clipped_ngram_matches(references, predictions, n)
+        counts = np.maximum(pred_lengths - n + 1, 1)  # like NLTK, a precision's denominator is at least 1
+
+        used = orders >= n
+        no_match |= used & (matches == 0)
+        precisions = np.where(matches > 0, matches, 1) / counts.astype(np.float64)
+        log_precisions += np.where(used, weights * np.log(precisions), 0.)
+
+        total_matches = matches.sum()
+        corpus_no_match |= total_matches == 0
+        if total_matches > 0:
+            corpus_log_precision += np.log(float(total_matches) / counts.sum()) / max_n
+
+    # brevity penalty
+    safe_pred_lengths = np.maximum(pred_lengths, 1).astype(np.float64)
+    brevity = np.where(pred_lengths > ref_lengths, 1., np.exp(1. - ref_lengths / safe_pred_lengths))
+    sentence = np.round(brevity * np.exp(log_precisions), 4)  # round like emulate_multibleu
+    sentence[no_match] = 0.
+    sentence[(pred_lengths == 0) & (ref_lengths == 0)] = 1.
+
+    if corpus_no_match:
+        corpus = 0.
+    else:
+        ref_length, pred_length = ref_lengths.sum(), pred_lengths.sum()
+        corpus_brevity = 1. if pred_length > ref_length else np.exp(1. - float(ref_length) / pred_length)
+        corpus = round(corpus_brevity * np.exp(corpus_log_precision), 4)
+
+    return BleuScores(sentence, corpus)
 
 
 class ComparableMixin(object):